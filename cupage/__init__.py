@@ -34,28 +34,54 @@ __copyright__ = 'Copyright © 2009-2014  James Rowe'
 
 import configparser
 import datetime
+import heapq
 import json
 import logging
 import os
+import pickle
 import re
 import socket
-import ssl
-import tempfile
-import http.client as httplib
-from typing import Dict, List, Optional, Union
-
-import httplib2
+import threading
+import time
+from collections import Counter, defaultdict, deque
+from http import HTTPStatus
+from operator import attrgetter
+from types import MappingProxyType
+from typing import (TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator,
+                    List, Mapping, Optional, Set, Tuple, Union)
 
 from click import echo
 from jnrbase.human_time import parse_timedelta
-from jnrbase import colourise, json_datetime
-from lxml import html
+from jnrbase import colourise
+
+from . import metrics, utils
+from .cache import FileCache
+from .database import open_database
+from .matches import Matches
+from .pool import ConnectionPool
+from .scheduler import (HOST_SECTION, AsyncHostGate, HostLimits, host_key)
 
-from . import utils
+if TYPE_CHECKING:  # pragma: no cover
+    import aiohttp
 
 #: User agent to use for HTTP requests
 USER_AGENT = f'cupage/{__version__} (https://github.com/JNRowe/cupage/)'
 
+#: Page size above which ``find_default_matches`` parses incrementally
+STREAM_THRESHOLD = 1024 * 1024
+
+#: ``match_type`` values that use :meth:`Site.package_re`
+PACKAGE_TYPES = ('gem', 'tar', 'zip')
+
+#: Number of release times to keep for adaptive scheduling
+RELEASE_HISTORY = 10
+
+#: Default bounds for adaptive check frequency
+ADAPTIVE_BOUNDS = ('1d', '1w')
+
+#: Format of pickled site definitions, see :meth:`Sites.load`
+DEFINITIONS_FORMAT = 2
+
 #: Site specific configuration data
 SITES = {
     'bitbucket': {
@@ -157,9 +183,37 @@ SITES = {
     },
 }
 
+#: Shared option records, see :func:`shared_options`
+_OPTIONS = {}
+
+
+def shared_options(options: Dict[str, Any]) -> Mapping[str, Any]:
+    """Find shared read-only record for site options.
+
+    Sites built from the same :data:`SITES` template usually have identical
+    options, so a single record is shared between them.
+
+    Args:
+        options: Options for a site’s ``match_func``
+
+    Returns:
+        Read-only view of options
+    """
+    key = (tuple(options), tuple(options.values()))
+    try:
+        return _OPTIONS[key]
+    except KeyError:
+        return _OPTIONS.setdefault(key, MappingProxyType(dict(options)))
+    except TypeError:
+        return MappingProxyType(dict(options))
+
 
 class Site:
     """Simple object for representing a web site."""
+    __slots__ = ('name', 'url', 'match_func', 'options', 'match', 'selector',
+                 'checked', 'frequency', 'robots', '_matches', 'releases',
+                 'adaptive', 'validators', 'digest', 'unchanged')
+
     def __init__(self,
                  name: str,
                  url: str,
@@ -168,7 +222,12 @@ class Site:
                  frequency: Optional[int] = None,
                  robots: bool = True,
                  checked: Optional[datetime.datetime] = None,
-                 matches: List[str] = None) -> None:
+                 matches: List[str] = None,
+                 releases: Optional[List[datetime.datetime]] = None,
+                 adaptive: Optional[Tuple[datetime.timedelta,
+                                          datetime.timedelta]] = None,
+                 validators: Optional[Dict[str, str]] = None,
+                 digest: Optional[str] = None) -> None:
         """Initialise a new ``Site`` object.
 
         Args:
@@ -180,22 +239,41 @@ class Site:
             robots: Whether to respect a host’s :file:`robots.txt`
             checked: Last checked date
             matches: Previous matches
+            releases: Times at which new matches were found
+            adaptive: Minimum and maximum check frequency, if it should be
+                learned from :attr:`releases`
+            validators: Cache validators from the last full response
+            digest: Digest of the last response body that was matched
         """
         self.name = name
         self.url = url
         self.match_func = match_func
-        self.options = options if options else {}
+        self.options = options = shared_options(options if options else {})
         re_verbose = 're_verbose' in options
         if options.get('match_type') == 're':
             self.match = re.compile(options['match'],
                                     flags=re.VERBOSE if re_verbose else 0)
-        elif options.get('match_type') in ('gem', 'tar', 'zip'):
+        elif options.get('match_type') in PACKAGE_TYPES:
             self.match = self.package_re(self.name, options['match_type'],
                                          re_verbose)
+        if options.get('select'):
+            try:
+                self.selector = utils.compile_selector(
+                    options.get('selector', 'css'), options['select'])
+            except ValueError as error:
+                raise ValueError(f'{error} for {name}')
+        else:
+            self.selector = None
         self.checked = checked
         self.frequency = frequency
         self.robots = robots
         self.matches = matches if matches else []
+        self.releases = releases if releases else []
+        self.adaptive = adaptive
+        self.validators = validators if validators else {}
+        self.digest = digest
+        #: Whether the last check skipped matching an unchanged body
+        self.unchanged = False
 
     def __repr__(self) -> str:
         """String representation for use in REPL."""
@@ -208,58 +286,141 @@ class Site:
         ]
         if self.checked:
             ret.append(f' last checked {self.checked}')
-        if self.frequency:
+        if self.adaptive:
+            ret.append(' with an adaptive check frequency of '
+                       f'{self.interval}')
+        elif self.frequency:
             ret.append(f' with a check frequency of {self.frequency}')
         if self.matches:
             ret.append('\n    ')
-            ret.append(', '.join(utils.sort_packages(self.matches)))
+            ret.append(', '.join(self.matches))
         else:
             ret.append('\n    No matches')
         return ''.join(ret)
 
+    @property
+    def matches(self) -> Matches:
+        """Previous matches, stored compactly."""
+        return self._matches
+
+    @matches.setter
+    def matches(self, matches: Iterable[str]) -> None:
+        self._matches = Matches(matches)
+
+    @property
+    def interval(self) -> Optional[datetime.timedelta]:
+        """Effective check frequency.
+
+        For adaptive sites this is learned from the gaps between
+        :attr:`releases`, see :func:`utils.adaptive_frequency`, falling back
+        to :attr:`frequency` or the minimum bound until there is enough
+        history.
+        """
+        if not self.adaptive:
+            return self.frequency
+        minimum, maximum = self.adaptive
+        learned = utils.adaptive_frequency(self.releases, utils.utcnow(),
+                                           minimum, maximum)
+        if learned:
+            return learned
+        return min(max(self.frequency or minimum, minimum), maximum)
+
+    @property
+    def fingerprint(self) -> str:
+        """Digest of the options that affect a site’s matches."""
+        import hashlib
+
+        data = json.dumps([self.url, self.match_func, dict(self.options)],
+                          sort_keys=True, default=str)
+        return hashlib.sha1(data.encode()).hexdigest()[:16]
+
+    def content_digest(self, content: bytes) -> str:
+        """Digest of a response body.
+
+        The digest includes :attr:`fingerprint`, so it no longer matches after
+        the site’s options are changed.
+
+        Args:
+            content: Response body
+        """
+        import hashlib
+
+        if isinstance(content, str):
+            content = content.encode()
+        digest = hashlib.blake2b(self.fingerprint.encode(), digest_size=16)
+        digest.update(content)
+        return digest.hexdigest()
+
+    def request_headers(self) -> Dict[str, str]:
+        """Headers for a check request.
+
+        Stored :attr:`validators` are sent as conditional headers, so
+        a server can reply with ``304 Not Modified`` without needing the
+        response body in a local cache.  They are ignored if the site’s
+        options have changed since they were stored.
+        """
+        headers = {'User-Agent': USER_AGENT}
+        if self.validators.get('fingerprint') == self.fingerprint:
+            if 'etag' in self.validators:
+                headers['If-None-Match'] = self.validators['etag']
+            if 'modified' in self.validators:
+                headers['If-Modified-Since'] = self.validators['modified']
+        return headers
+
+    def due(self, force: bool = False) -> bool:
+        """Check whether site is due for checking.
+
+        Args:
+            force: Ignore configured check frequency
+        """
+        interval = self.interval
+        if not force and interval and self.checked:
+            next_check = self.checked + interval
+            if utils.utcnow() < next_check:
+                colourise.pwarn(
+                    f'{self.name} is not due for check until {next_check}')
+                return False
+        return True
+
     def check(self,
-              cache: Optional[str] = None,
+              cache: Optional[Union[str, FileCache]] = None,
               timeout: Optional[int] = None,
               force: bool = False,
-              no_write: bool = False) -> List[str]:
+              no_write: bool = False,
+              pool: Optional[ConnectionPool] = None,
+              robots: Optional[utils.RobotsCache] = None) -> List[str]:
         """Check site for updates.
 
         Args:
-            cache: :class:`httplib2.Http` cache location
+            cache: :class:`httplib2.Http` cache location or object
             timeout: Timeout value for :class:`httplib2.Http`
             force: Ignore configured check frequency
             no_write: Do not write to cache, useful for testing
+            pool: Connection pool to use, overrides ``cache``, ``timeout``
+                and ``no_write``
+            robots: Cache of :file:`robots.txt` data
         """
-        if not force and self.frequency and self.checked:
-            next_check = self.checked + self.frequency
-            if datetime.datetime.utcnow() < next_check:
-                colourise.pwarn(
-                    f'{self.name} is not due for check until {next_check}')
-                return
-        http = httplib2.Http(cache=cache,
-                             timeout=timeout,
-                             ca_certs=utils.CA_CERTS)
-        # hillbilly monkeypatch to allow us to still read the cache, but make
-        # writing a NOP
-        if no_write:
-            http.cache.set = lambda *_: True
-
-        if cache and not os.path.exists(f'{cache}/CACHEDIR.TAG'):
-            with open(f'{cache}/CACHEDIR.TAG', 'w') as f:
-                f.writelines([
-                    'Signature: 8a477f597d28d172789f06886806bc55\n',
-                    '# This file is a cache directory tag created by cupage.\n',
-                    '# For information about cache directory tags, see:\n',
-                    '#   http://www.brynosaurus.com/cachedir/\n',
-                ])
+        import ssl
+
+        import httplib2
+
+        self.unchanged = False
+        if not self.due(force):
+            return
+        if not pool:
+            pool = ConnectionPool(cache, timeout, no_write)
 
         if self.robots and not os.getenv('CUPAGE_IGNORE_ROBOTS_TXT'):
-            if not utils.robots_test(http, self.url, self.name, USER_AGENT):
+            with metrics.phase('robots'):
+                allowed = utils.robots_test(pool, self.url, self.name,
+                                            USER_AGENT, robots)
+            if not allowed:
                 return False
 
         try:
-            headers, content = http.request(self.url,
-                                            headers={'User-Agent': USER_AGENT})
+            with metrics.phase('fetch'):
+                headers, content = pool.request(
+                    self.url, headers=self.request_headers())
         except httplib2.ServerNotFoundError:
             colourise.pfail(f'Domain name lookup failed for {self.name}')
             return False
@@ -270,37 +431,150 @@ class Site:
             colourise.pfail(f'Socket timed out on {self.name}')
             return False
 
+        if headers.status == HTTPStatus.NOT_MODIFIED:
+            cache_result = 'not_modified'
+        else:
+            cache_result = 'hit' if headers.fromcache else 'miss'
+        metrics.note(status=headers.status, bytes=len(content),
+                     cache=cache_result)
+        return self.process(headers.status, headers, content,
+                            headers.get('content-location', self.url))
+
+    async def check_async(self,
+                          session: 'aiohttp.ClientSession',
+                          force: bool = False,
+                          robots: Optional[utils.RobotsCache] = None
+                          ) -> List[str]:
+        """Check site for updates using :mod:`asyncio`.
+
+        This is the equivalent of :meth:`check` for use with
+        :meth:`Sites.check_async`, and requires aiohttp_.
+
+        .. _aiohttp: https://pypi.org/project/aiohttp/
+
+        Args:
+            session: Session to make requests with
+            force: Ignore configured check frequency
+            robots: Cache of :file:`robots.txt` data
+        """
+        import asyncio
+
+        import aiohttp
+
+        self.unchanged = False
+        if not self.due(force):
+            return
+
+        if self.robots and not os.getenv('CUPAGE_IGNORE_ROBOTS_TXT'):
+            with metrics.phase('robots'):
+                allowed = await utils.robots_test_async(
+                    session, self.url, self.name, USER_AGENT, robots)
+            if not allowed:
+                return False
+
+        try:
+            with metrics.phase('fetch'):
+                async with session.get(
+                        self.url, headers=self.request_headers()) as resp:
+                    content = await resp.read()
+        except aiohttp.ClientSSLError as error:
+            colourise.pfail(f'SSL error {self.name} ({error})')
+            return False
+        except aiohttp.ClientConnectorError as error:
+            if isinstance(error.os_error, socket.gaierror):
+                colourise.pfail(f'Domain name lookup failed for {self.name}')
+            else:
+                colourise.pfail(f'Connection failed for {self.name} ({error})')
+            return False
+        except asyncio.TimeoutError:
+            colourise.pfail(f'Socket timed out on {self.name}')
+            return False
+        except aiohttp.ClientError as error:
+            colourise.pfail(f'Request failed for {self.name} ({error})')
+            return False
+
+        metrics.note(status=resp.status, bytes=len(content),
+                     cache='not_modified'
+                     if resp.status == HTTPStatus.NOT_MODIFIED else 'miss')
+        # Only processing is profiled, as fetches yield to other tasks
+        with utils.profile_site(self.name):
+            return self.process(resp.status, resp.headers, content,
+                                str(resp.url))
+
+    def process(self, status: int, headers: Dict[str, str], content: bytes,
+                location: str) -> List[str]:
+        """Process response from a site check.
+
+        If the body is identical to the last one processed, as recorded in
+        :attr:`digest`, matching is skipped and :attr:`unchanged` is set.
+
+        Args:
+            status: HTTP status code
+            headers: Response headers
+            content: Response body
+            location: Final location of content, after redirects
+        """
+        self.unchanged = False
         charset = utils.charset_from_headers(headers)
 
-        if not headers.get('content-location', self.url) == self.url:
-            colourise.pwarn(
-                f'{self.name} moved to {headers["content-location"]}')
-        if headers.status == httplib.NOT_MODIFIED:
+        if not location == self.url:
+            colourise.pwarn(f'{self.name} moved to {location}')
+        if status == HTTPStatus.NOT_MODIFIED:
+            self.checked = utils.utcnow()
             return
-        elif headers.status in (httplib.FORBIDDEN, httplib.NOT_FOUND):
+        elif status in (HTTPStatus.FORBIDDEN, HTTPStatus.NOT_FOUND):
             colourise.pfail(
-                '{self}.name returned {httplib.responses[headers.status]!r}')
+                f'{self.name} returned {HTTPStatus(status).phrase!r}')
             return False
 
-        matches = getattr(self, f'find_{self.match_func}_matches')(content,
-                                                                   charset)
-        new_matches = [s for s in matches if s not in self.matches]
-        self.matches = matches
-        self.checked = datetime.datetime.utcnow()
+        now = utils.utcnow()
+        digest = self.content_digest(content)
+        if self.checked and digest == self.digest:
+            self.unchanged = True
+            new_matches = []
+        else:
+            with metrics.phase('match'):
+                matches = getattr(self, f'find_{self.match_func}_matches')(
+                    content, charset)
+            matches = utils.sort_packages(matches)
+            new_matches = self.matches.difference(matches)
+            # The first check finds existing releases, so says nothing of
+            # cadence
+            if new_matches and self.checked:
+                self.releases = (self.releases + [now])[-RELEASE_HISTORY:]
+            self.matches = matches
+            self.digest = digest
+        self.checked = now
+        self.validators = {
+            key: headers[header]
+            for key, header in (('etag', 'etag'),
+                                ('modified', 'last-modified'))
+            if headers.get(header)
+        }
+        if self.validators:
+            self.validators['fingerprint'] = self.fingerprint
         return new_matches
 
     def find_default_matches(self, content: str, charset: str) -> List[str]:
         """Extract matches from content.
 
+        Pages larger than :data:`STREAM_THRESHOLD` are parsed incrementally
+        when the selector allows it, see :func:`utils.stream_select`.
+
         Args:
             content: Content to search
             charset: Character set for content
         """
-        doc = html.fromstring(content)
-        if self.options['selector'] == 'css':
-            selected = doc.cssselect(self.options['select'])
-        elif self.options['selector'] == 'xpath':
-            selected = doc.xpath(self.options['select'])
+        if len(content) > STREAM_THRESHOLD \
+                and utils.streamable(self.options['selector'],
+                                     self.options['select']):
+            # Parsing is interleaved with matching, so is timed with it
+            selected = utils.stream_select(content, self.selector)
+        else:
+            from lxml import html
+            with metrics.phase('parse'):
+                doc = html.fromstring(content)
+            selected = self.selector(doc)
         # We use a set to remove duplicates the lazy way
         matches = set()
         for sel in selected:
@@ -310,6 +584,26 @@ class Site:
                 matches.add(groups[0] if groups else match.group())
         return sorted(list(matches))
 
+    def find_anchor_matches(self, content: bytes, charset: str) -> List[str]:
+        """Extract matches from link targets, without parsing the content.
+
+        This is used in place of :meth:`find_default_matches` for sites
+        that set ``match_func`` to ``anchor``.  The selector isn’t applied,
+        so every link in the page is matched, but links within comments are
+        skipped.
+
+        Args:
+            content: Content to search
+            charset: Character set for content
+        """
+        matches = set()
+        for href in utils.scan_hrefs(content, charset):
+            match = self.match.search(href)
+            if match:
+                groups = match.groups()
+                matches.add(groups[0] if groups else match.group())
+        return sorted(matches)
+
     def find_google_code_matches(self, content: str,
                                  charset: str) -> List[str]:
         """Extract matches from Google Code content.
@@ -318,8 +612,8 @@ class Site:
             content: Content to search
             charset: Character set for content
         """
-        content = content.encode(charset)
-        doc = json.loads(content)
+        with metrics.phase('parse'):
+            doc = json.loads(content)
         return sorted(tag['filename'] for tag in doc['downloads'])
 
     def find_github_matches(self, content: str, charset: str) -> List[str]:
@@ -329,8 +623,8 @@ class Site:
             content: Content to search
             charset: Character set for content
         """
-        content = content.encode(charset)
-        doc = json.loads(content)
+        with metrics.phase('parse'):
+            doc = json.loads(content)
         return sorted(tag['name'] for tag in doc)
 
     def find_hackage_matches(self, content: str, charset: str) -> List[str]:
@@ -340,8 +634,11 @@ class Site:
             content: Content to search
             charset: Character set for content
         """
-        doc = html.fromstring(content)
-        data = doc.cssselect('table tr')[0][1]
+        from lxml import html
+
+        with metrics.phase('parse'):
+            doc = html.fromstring(content)
+        data = utils.compile_selector('css', 'table tr')(doc)[0][1]
         return sorted(x.text for x in data.getchildren())
 
     def find_rubygems_matches(self, content: str, charset: str) -> List[str]:
@@ -351,8 +648,8 @@ class Site:
             content: Content to search
             charset: Character set for content
         """
-        content = content.encode(charset)
-        data = json.loads(content)
+        with metrics.phase('parse'):
+            data = json.loads(content)
         return sorted(rel['number'] for rel in data)
 
     def find_sourceforge_matches(self, content: str,
@@ -365,9 +662,12 @@ class Site:
         """
         # We use lxml.html here to sidestep part of the stupidity of RSS 2.0,
         # if a usable format on sf comes along we’ll switch to it.
-        doc = html.fromstring(content)
+        from lxml import html
+
+        with metrics.phase('parse'):
+            doc = html.fromstring(content)
         matches = set()
-        for x in doc.cssselect('item link'):
+        for x in utils.compile_selector('css', 'item link')(doc):
             if '/download' in x.tail:
                 matches.add(x.tail.split('/')[-2])
         return sorted(list(matches))
@@ -396,7 +696,39 @@ class Site:
             options: Site options from config file
             data: Stored data from database file
         """
+        return Site(**Site.parse_options(name, options),
+                    **Site.parse_state(data))
+
+    @staticmethod
+    def parse_state(data: Dict[str, str]) -> Dict[str, Any]:
+        """Decode stored site data.
+
+        Args:
+            data: Stored data from database file
+
+        Returns:
+            Keyword arguments for ``Site``
+        """
+        return {
+            'checked': utils.parse_datetime(data.get('checked')),
+            'matches': data.get('matches'),
+            'releases': [utils.parse_datetime(release)
+                         for release in data.get('releases') or []],
+            'validators': data.get('validators'),
+            'digest': data.get('digest'),
+        }
+
+    @staticmethod
+    def parse_options(name: str, options: Dict[str, str]) -> Dict[str, Any]:
+        """Validate site options from config file.
 
+        Args:
+            name: Site name from config file
+            options: Site options from config file
+
+        Returns:
+            Keyword arguments for ``Site``, excluding stored state
+        """
         if 'site' in options:
             try:
                 site_opts = SITES[options['site']]
@@ -427,7 +759,7 @@ class Site:
                 're_verbose': get_val('re_verbose', False),
                 'match': get_val('match', '').format(**options),
             }  # pylint: disable=disable=star-args
-            robots = options.getboolean('robots')
+            robots = get_val('robots', 'true')
         elif 'url' in options:
             match_func = options.get('match_func', 'default')
             url = options['url']
@@ -442,30 +774,127 @@ class Site:
             if match_options['match_type'] == 're' \
                     and not match_options['match']:
                 raise ValueError(f'missing match option for {name}')
-            robots = options.getboolean('robots')
+            robots = options.get('robots', 'true')
         else:
             raise ValueError(f'site or url not specified for {name}')
+        try:
+            robots = configparser.ConfigParser.BOOLEAN_STATES[robots.lower()]
+        except KeyError:
+            raise ValueError(f'Invalid robots option for {name}')
         frequency = options.get('frequency')
         if frequency:
             frequency = parse_timedelta(frequency)
-        site = Site(name, url, match_func, match_options, frequency, robots,
-                    data.get('checked'), data.get('matches'))
-        return site
+        adaptive = options.get('adaptive', 'false')
+        try:
+            adaptive = configparser.ConfigParser.BOOLEAN_STATES[
+                adaptive.lower()]
+        except KeyError:
+            raise ValueError(f'Invalid adaptive option for {name}')
+        if adaptive:
+            try:
+                adaptive = tuple(
+                    parse_timedelta(options.get(key, default))
+                    for key, default in zip(
+                        ('min_frequency', 'max_frequency'), ADAPTIVE_BOUNDS))
+            except ValueError:
+                raise ValueError(f'Invalid adaptive bounds for {name}')
+            if adaptive[0] > adaptive[1]:
+                raise ValueError(f'Invalid adaptive bounds for {name}')
+        else:
+            adaptive = None
+        return {
+            'name': name,
+            'url': url,
+            'match_func': match_func,
+            'options': match_options,
+            'frequency': frequency,
+            'robots': robots,
+            'adaptive': adaptive,
+        }
 
     @property
     def state(self) -> Dict[str, Union[List[str], datetime.datetime]]:
         """Return ``Site`` state for database storage."""
-        return {'matches': self.matches, 'checked': self.checked}
+        return {
+            'matches': list(self.matches),
+            'checked': self.checked,
+            'releases': self.releases,
+            'validators': self.validators,
+            'digest': self.digest,
+        }
 
 
 class Sites(list):
     """``Site`` bundle wrapper."""
-    def load(self, config_file: str, database: Optional[str] = None) -> None:
+    def __init__(self, *args) -> None:
+        """Initialise a new ``Sites`` object.
+
+        Args:
+            args: Initial ``Site`` objects, as for :class:`list`
+        """
+        super().__init__(*args)
+        #: Per-host request limit overrides from config file
+        self.hosts = {}
+        #: Count of ``unchanged`` pages that weren’t parsed
+        self.stats = Counter()
+        #: Time taken by the last check of each site, in seconds
+        self.durations = {}
+        self._saved = {}
+        self._deferred = {}
+        self._data = {}
+        self._database = None
+        self._partial = False
+
+    def load(self,
+             config_file: str,
+             database: Optional[str] = None,
+             pages: Optional[Iterable[str]] = None,
+             cache: Optional[str] = None) -> None:
         """Read sites from a user’s config file and database.
 
+        When ``pages`` is given only the named sites are parsed, other
+        sections are parsed on first access via :meth:`get`.  Database
+        records for sites that are never parsed are left untouched.
+
+        If ``cache`` is given, validated site definitions are stored there and
+        reused until the config file changes or ``cupage`` is upgraded.
+
         Args:
             config_file: Config file to read
             database: Database file to read
+            pages: Only parse sites with the given names
+            cache: Location of compiled config cache
+        """
+        if pages:
+            pages = set(pages)
+        if database:
+            self._database = open_database(database)
+            self._partial = bool(pages) and self._database.selective
+            self._data = self._database.load(pages if self._partial else None)
+
+        if cache:
+            definitions = self._cached_definitions(config_file, cache)
+        else:
+            definitions = self._read_config(config_file)
+
+        for name, definition in definitions.items():
+            if pages and name not in pages:
+                self._deferred[name] = definition
+            else:
+                self._build(definition)
+
+    def _read_config(
+            self, config_file: str
+    ) -> Dict[str, configparser.SectionProxy]:
+        """Read site sections from config file.
+
+        Host sections are stored in :attr:`hosts`.
+
+        Args:
+            config_file: Config file to read
+
+        Returns:
+            Site sections, keyed by the name their site will use
         """
         conf = configparser.ConfigParser()
         conf.read(config_file)
@@ -473,31 +902,445 @@ class Sites(list):
             logging.debug('Config file %r is empty', config_file)
             raise IOError('Error reading config file')
 
-        data = {}
-        if database and os.path.exists(database):
-            data = json_datetime.load(open(database))
-        elif database:
-            logging.debug('Database file %r doesn’t exist', database)
-
+        sections = {}
         for name in conf.sections():
-            options = {}
-            for opt in conf.options(name):
-                options[opt] = conf.get(name, opt)
-            self.append(Site.parse(name, options, data.get(name, {})))
+            if name.startswith(HOST_SECTION):
+                self.hosts[name[len(HOST_SECTION):]] = dict(conf[name])
+                continue
+            section = conf[name]
+            transform = SITES.get(section.get('site'), {}).get('transform')
+            sections[transform(name) if transform else name] = section
+        # Check host sections now, rather than when sites are checked
+        HostLimits(overrides=self.hosts)
+        return sections
+
+    def _cached_definitions(self, config_file: str,
+                            cache: str) -> Dict[str, Dict[str, Any]]:
+        """Read validated site definitions, using a cache when possible.
+
+        The cache is keyed on the config file’s location, size and
+        modification time, along with the ``cupage`` version.  When it is
+        stale every site is validated, and the cache is rewritten.
+
+        Args:
+            config_file: Config file to read
+            cache: Location of compiled config cache
+
+        Returns:
+            Keyword arguments for ``Site``, keyed by site name
+        """
+        stat = os.stat(config_file)
+        key = (_version.dotted, DEFINITIONS_FORMAT,
+               os.path.abspath(config_file), stat.st_size, stat.st_mtime_ns)
+        try:
+            with open(cache, 'rb') as f:
+                cached_key, self.hosts, definitions = pickle.load(f)
+            if cached_key == key:
+                return definitions
+        except (OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass
+        logging.debug('Config cache %r is stale', cache)
+
+        self.hosts = {}
+        definitions = {}
+        for section in self._read_config(config_file).values():
+            definition = Site.parse_options(section.name, dict(section))
+            # Compile matchers now, so invalid definitions are never cached
+            Site(**definition)
+            definitions[definition['name']] = definition
+
+        import tempfile
+
+        directory = os.path.dirname(cache)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile(prefix='.', dir=directory,
+                                         delete=False) as temp:
+            pickle.dump((key, self.hosts, definitions), temp,
+                        pickle.HIGHEST_PROTOCOL)
+        os.rename(temp.name, cache)
+        return definitions
+
+    def _build(self, definition: Union[configparser.SectionProxy,
+                                       Dict[str, Any]]) -> Site:
+        """Create a ``Site``, and add it to ``Sites``.
+
+        Args:
+            definition: Site section from config file, or validated keyword
+                arguments for ``Site``
+        """
+        if isinstance(definition, configparser.SectionProxy):
+            definition = Site.parse_options(definition.name, dict(definition))
+        name = definition['name']
+        if self._partial and name not in self._data:
+            self._data.update(self._database.load([name]))
+        # The stored record is rebuilt from the site when saving
+        data = self._data.pop(name, {})
+        site = Site(**definition, **Site.parse_state(data))
+        self._saved[site.name] = self._snapshot(site)
+        self.append(site)
+        return site
+
+    def get(self, name: str) -> Optional[Site]:
+        """Fetch site by name, parsing it first if necessary.
+
+        Args:
+            name: Site name
+
+        Returns:
+            Matching ``Site``, or ``None`` if there is no such site
+        """
+        if name in self._deferred:
+            return self._build(self._deferred.pop(name))
+        for site in self:
+            if site.name == name:
+                return site
+        return None
+
+    def urls(self) -> Set[str]:
+        """Find locations fetched when checking every site.
+
+        This includes sites that haven’t been parsed yet, and the
+        :file:`robots.txt` for each site.
+        """
+        urls = {site.url for site in self}
+        for definition in self._deferred.values():
+            if isinstance(definition, configparser.SectionProxy):
+                definition = Site.parse_options(definition.name,
+                                                dict(definition))
+            urls.add(definition['url'])
+        return urls | {utils.robots_url(url) for url in urls} - {None}
 
     def save(self, database: str) -> None:
         """Save ``Sites`` to the user’s database.
 
+        The database format is chosen by
+        :func:`~cupage.database.open_database`.  For SQLite databases only
+        sites whose state has changed since :meth:`load` are written.
+        Stored records for sites that were never parsed are written back
+        unchanged, and records for sites that are no longer in the config
+        file are dropped.
+
         Args:
             database: Database file to write
         """
-        data = {}
+        states = {
+            name: data
+            for name, data in self._data.items() if name in self._deferred
+        }
+        changed = []
         for site in self:
-            data[site.name] = site.state
-
-        directory, _ = os.path.split(database)
-        temp = tempfile.NamedTemporaryFile(prefix='.',
-                                           dir=directory,
-                                           delete=False)
-        json_datetime.dump(data, temp)
-        os.rename(temp.name, database)
+            states[site.name] = site.state
+            if self._snapshot(site) != self._saved.get(site.name):
+                changed.append(site)
+
+        open_database(database).save(
+            states, [site.name for site in changed],
+            {site.name for site in self} | self._deferred.keys())
+        for site in changed:
+            self._saved[site.name] = self._snapshot(site)
+
+    @staticmethod
+    def _snapshot(site: Site) -> Dict[str, Any]:
+        """Copy site state, for detecting changes in :meth:`save`.
+
+        The site’s :class:`~cupage.matches.Matches` are immutable, so they
+        are shared rather than copied.
+
+        Args:
+            site: Site to copy state from
+        """
+        return dict(site.state, matches=site.matches)
+
+    def check(self,
+              cache: Optional[Union[str, FileCache]] = None,
+              timeout: Optional[int] = None,
+              force: bool = False,
+              no_write: bool = False,
+              pages: Optional[List[str]] = None,
+              jobs: int = 1,
+              robots: Optional[utils.RobotsCache] = None,
+              limits: Optional[HostLimits] = None,
+              recorder: Optional[metrics.Recorder] = None
+              ) -> Iterator[Tuple[Site, Optional[List[str]]]]:
+        """Check sites for updates.
+
+        Sites are checked concurrently using a pool of ``jobs`` threads, but
+        results are always yielded in site name order.  Each ``Site`` is only
+        ever touched by a single worker, so state updates are complete before
+        the pool is shut down and :meth:`save` can be called.
+
+        Connections are shared between all checks in a run via
+        :attr:`pool`, which can be inspected for connection reuse statistics
+        afterwards.  :file:`robots.txt` data is also shared, and if
+        ``robots`` isn’t given a new cache is used for the run.
+
+        Requests are throttled per host according to ``limits``.  Work is
+        only handed to the thread pool when a site’s host can accept another
+        request, so checks for other hosts continue while one is throttled.
+
+        Args:
+            cache: :class:`httplib2.Http` cache location or object
+            timeout: Timeout value for :class:`httplib2.Http`
+            force: Ignore configured check frequency
+            no_write: Do not write to cache, useful for testing
+            pages: Only check sites with the given names
+            jobs: Number of sites to check concurrently
+            robots: Cache of :file:`robots.txt` data
+            limits: Per-host request limits
+            recorder: Recorder for check metrics
+
+        Returns:
+            ``Site`` and result of :meth:`Site.check` pairs
+        """
+        from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                        wait)
+
+        selected = sorted(
+            (site for site in self if not pages or site.name in pages),
+            key=attrgetter('name'))
+
+        if not limits:
+            limits = HostLimits(overrides=self.hosts)
+        self.pool = ConnectionPool(cache, timeout, no_write, limits)
+        gate = self.pool.gate
+        if not robots:
+            robots = utils.RobotsCache()
+
+        def check_site(site: Site) -> Optional[List[str]]:
+            start = time.monotonic()
+            try:
+                with metrics.site_context(recorder, site.name), \
+                        utils.profile_site(site.name):
+                    return site.check(force=force, pool=self.pool,
+                                      robots=robots)
+            finally:
+                self.durations[site.name] = time.monotonic() - start
+
+        queues = defaultdict(deque)
+        for index, site in enumerate(selected):
+            queues[host_key(site.url)].append(index)
+        active = Counter()
+        running = {}
+        results = {}
+        reported = 0
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                while queues or running:
+                    wake = None
+                    for host in list(queues):
+                        concurrency, spacing = limits.for_host(host)
+                        while host in queues and len(running) < jobs \
+                                and active[host] < concurrency:
+                            delay = gate.wait_time(host)
+                            if delay:
+                                wake = (delay if wake is None else
+                                        min(wake, delay))
+                                break
+                            index = queues[host].popleft()
+                            if not queues[host]:
+                                del queues[host]
+                            active[host] += 1
+                            future = executor.submit(check_site,
+                                                     selected[index])
+                            running[future] = (index, host)
+                            # Spaced requests are submitted as they become
+                            # due, rather than waiting in worker threads
+                            if spacing:
+                                break
+                    if running:
+                        done, _ = wait(running,
+                                       timeout=wake,
+                                       return_when=FIRST_COMPLETED)
+                    else:
+                        done = ()
+                        time.sleep(wake)
+                    for future in done:
+                        index, host = running.pop(future)
+                        active[host] -= 1
+                        results[index] = future.result()
+                        self._count(selected[index])
+                    while reported in results:
+                        yield selected[reported], results.pop(reported)
+                        reported += 1
+        finally:
+            self.pool.close()
+
+    def _count(self, site: Site) -> None:
+        """Update :attr:`stats` after a site check.
+
+        Args:
+            site: Site that was checked
+        """
+        if site.unchanged:
+            self.stats['unchanged'] += 1
+
+    def watch(self,
+              cache: Optional[Union[str, FileCache]] = None,
+              timeout: Optional[int] = None,
+              no_write: bool = False,
+              jobs: int = 1,
+              robots: Optional[utils.RobotsCache] = None,
+              limits: Optional[HostLimits] = None,
+              frequency: datetime.timedelta = datetime.timedelta(days=1),
+              stop: Optional[threading.Event] = None,
+              idle: Optional[Callable[[], None]] = None
+              ) -> Iterator[Tuple[Site, Optional[List[str]]]]:
+        """Check sites continuously, as they become due.
+
+        Sites are kept in a heap ordered by the time of their next check, and
+        the loop sleeps until the earliest is due.  Due sites are checked
+        using a pool of ``jobs`` threads, and results are yielded as soon as
+        each check completes so they can be persisted incrementally.
+
+        Each site is rescheduled for its check frequency after the check
+        completes, regardless of whether it succeeded.
+
+        Args:
+            cache: :class:`httplib2.Http` cache location or object
+            timeout: Timeout value for :class:`httplib2.Http`
+            no_write: Do not write to cache, useful for testing
+            jobs: Number of sites to check concurrently
+            robots: Cache of :file:`robots.txt` data
+            limits: Per-host request limits
+            frequency: Check frequency for sites that don’t set one
+            stop: Event to end checking, running checks are completed but
+                their results aren’t yielded
+            idle: Function to call when no checks are running, before
+                waiting for the next site to become due
+
+        Returns:
+            ``Site`` and result of :meth:`Site.check` pairs
+        """
+        from concurrent.futures import (FIRST_COMPLETED, ThreadPoolExecutor,
+                                        wait)
+
+        if not limits:
+            limits = HostLimits(overrides=self.hosts)
+        self.pool = ConnectionPool(cache, timeout, no_write, limits)
+        if not robots:
+            robots = utils.RobotsCache()
+        if not stop:
+            stop = threading.Event()
+
+        def due_time(site: Site) -> float:
+            if not site.checked:
+                return 0
+            return (site.checked + (site.interval or frequency)).timestamp()
+
+        queue = [(due_time(site), site.name, site) for site in self]
+        heapq.heapify(queue)
+        running = {}
+        try:
+            with ThreadPoolExecutor(max_workers=jobs) as executor:
+                while not stop.is_set():
+                    now = time.time()
+                    while queue and queue[0][0] <= now \
+                            and len(running) < jobs:
+                        site = heapq.heappop(queue)[2]
+                        future = executor.submit(site.check, force=True,
+                                                 pool=self.pool, robots=robots)
+                        running[future] = site
+                    if queue and len(running) < jobs:
+                        delay = queue[0][0] - now
+                    else:
+                        delay = None
+                    if not running:
+                        if idle:
+                            idle()
+                        stop.wait(delay)
+                        continue
+                    done, _ = wait(running, timeout=delay,
+                                   return_when=FIRST_COMPLETED)
+                    for future in done:
+                        site = running.pop(future)
+                        interval = site.interval or frequency
+                        heapq.heappush(queue,
+                                       (time.time() + interval.total_seconds(),
+                                        site.name, site))
+                        try:
+                            result = future.result()
+                        except Exception as error:
+                            # A broken site mustn’t stop the daemon
+                            colourise.pfail(
+                                f'Check failed for {site.name} ({error})')
+                            result = False
+                        self._count(site)
+                        if not stop.is_set():
+                            yield site, result
+        finally:
+            self.pool.close()
+
+    async def check_async(self,
+                          timeout: Optional[int] = None,
+                          force: bool = False,
+                          pages: Optional[List[str]] = None,
+                          jobs: int = 100,
+                          robots: Optional[utils.RobotsCache] = None,
+                          limits: Optional[HostLimits] = None,
+                          recorder: Optional[metrics.Recorder] = None
+                          ) -> List[Tuple[Site, Optional[List[str]]]]:
+        """Check sites for updates using :mod:`asyncio`.
+
+        All requests are made from a single thread, with at most ``jobs``
+        connections open at any one time.  Unlike :meth:`check` this doesn’t
+        use a :class:`httplib2.Http` cache.
+
+        ``limits`` are applied to each site check as a whole, rather than to
+        its individual requests.
+
+        This requires aiohttp_.
+
+        .. _aiohttp: https://pypi.org/project/aiohttp/
+
+        Args:
+            timeout: Timeout for connecting, and for each read
+            force: Ignore configured check frequency
+            pages: Only check sites with the given names
+            jobs: Maximum number of concurrent site checks
+            robots: Cache of :file:`robots.txt` data
+            limits: Per-host request limits
+            recorder: Recorder for check metrics
+
+        Returns:
+            ``Site`` and result of :meth:`Site.check_async` pairs, in site
+            name order
+        """
+        import asyncio
+        import ssl
+
+        import aiohttp
+
+        selected = sorted(
+            (site for site in self if not pages or site.name in pages),
+            key=attrgetter('name'))
+        if not robots:
+            robots = utils.RobotsCache()
+        if not limits:
+            limits = HostLimits(overrides=self.hosts)
+        gate = AsyncHostGate(limits)
+        # Checks wait for a slot before making any requests, so time spent
+        # queued doesn’t count towards their timeouts
+        slots = asyncio.Semaphore(jobs)
+
+        async def check_site(site: Site) -> Optional[List[str]]:
+            async with gate.acquire(host_key(site.url), slots):
+                start = time.monotonic()
+                try:
+                    with metrics.site_context(recorder, site.name):
+                        return await site.check_async(session, force, robots)
+                finally:
+                    self.durations[site.name] = time.monotonic() - start
+
+        connector = aiohttp.TCPConnector(limit=jobs,
+                                         ssl=ssl.create_default_context(
+                                             cafile=utils.ca_certs()))
+        async with aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(
+                    sock_connect=timeout, sock_read=timeout)) as session:
+            results = await asyncio.gather(
+                *(check_site(site) for site in selected))
+        for site in selected:
+            self._count(site)
+        return list(zip(selected, results))
@@ -0,0 +1,519 @@
+#
+"""benchmark - Performance benchmarks for cupage."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime
+import fnmatch
+import json
+import os
+import platform
+from contextlib import contextmanager
+from typing import (Callable, ContextManager, Dict, Iterator, List, Optional,
+                    Tuple)
+
+from . import Site, Sites, _version, utils
+from .matches import Matches
+
+#: Result file format version
+FORMAT = 1
+
+#: Site counts and page sizes in bytes for each benchmark scale
+SCALES = {
+    'quick': ((10, 1000), (1024, 100 * 1024)),
+    'full': ((10, 100, 1000, 10000, 100000),
+             (1024, 100 * 1024, 1024 ** 2, 10 * 1024 ** 2)),
+}
+
+#: Registered benchmarks, with the scale axis they use
+BENCHMARKS = {}
+
+
+def benchmark(name: str, axis: Optional[str] = None) -> Callable:
+    """Register a benchmark.
+
+    The decorated function should be a context manager that yields the
+    callable to time, so setup and cleanup aren’t measured.
+
+    Args:
+        name: Name for results
+        axis: Scale axis, ``sites`` or ``size``, to parametrise benchmark with
+    """
+    def decorator(func: Callable) -> Callable:
+        func = contextmanager(func)
+        BENCHMARKS[name] = (func, axis)
+        return func
+
+    return decorator
+
+
+def size_label(size: int) -> str:
+    """Format size for benchmark names.
+
+    Args:
+        size: Size in bytes
+    """
+    for unit in ('', 'K', 'M'):
+        if size < 1024 or unit == 'M':
+            break
+        size //= 1024
+    return f'{size}{unit}B'
+
+
+def versions(count: int) -> Iterator[str]:
+    """Generate version strings.
+
+    Args:
+        count: Number of versions to generate
+    """
+    for i in range(count):
+        yield f'{i // 1000}.{i // 10 % 100}.{i % 10}'
+
+
+def fill(render: Callable[[str], str], size: int) -> List[str]:
+    """Render entries until their total length reaches ``size``.
+
+    Args:
+        render: Function to render an entry from a version string
+        size: Target total length
+    """
+    entries = []
+    total = 0
+    for version in versions(size):
+        entry = render(version)
+        entries.append(entry)
+        total += len(entry)
+        if total >= size:
+            break
+    return entries
+
+
+def listing_page(size: int, name: str = 'foo') -> bytes:
+    """Generate a directory listing page.
+
+    Args:
+        size: Approximate page size in bytes
+        name: Package name for files
+    """
+    def render(version: str) -> str:
+        lines = []
+        for ext in ('tar.gz', 'tar.gz.asc', 'zip'):
+            filename = f'{name}-{version}.{ext}'
+            lines.append(f'<tr><td><a href="{filename}">{filename}</a></td>'
+                         f'<td>2014-01-01 12:00</td><td>42K</td></tr>\n')
+        return ''.join(lines)
+
+    return (f'<html><head><title>Index of /{name}</title></head><body>\n'
+            '<table>\n' + ''.join(fill(render, size)) +
+            '</table></body></html>\n').encode()
+
+
+def github_page(size: int, name: str = 'foo') -> bytes:
+    """Generate a GitHub tags API response.
+
+    Args:
+        size: Approximate page size in bytes
+        name: Repository name
+    """
+    base = f'https://api.github.com/repos/user/{name}'
+
+    def render(version: str) -> str:
+        return json.dumps({
+            'name': f'v{version}',
+            'zipball_url': f'{base}/zipball/v{version}',
+            'tarball_url': f'{base}/tarball/v{version}',
+            'commit': {
+                'sha': version.replace('.', '').zfill(40),
+                'url': f'{base}/commits/v{version}',
+            },
+        })
+
+    return f'[{", ".join(fill(render, size))}]'.encode()
+
+
+def rubygems_page(size: int, name: str = 'foo') -> bytes:
+    """Generate a rubygems versions API response.
+
+    Args:
+        size: Approximate page size in bytes
+        name: Gem name
+    """
+    def render(version: str) -> str:
+        return json.dumps({
+            'number': version,
+            'created_at': '2014-01-01T12:00:00.000Z',
+            'platform': 'ruby',
+            'summary': f'The {name} gem',
+            'prerelease': False,
+        })
+
+    return f'[{", ".join(fill(render, size))}]'.encode()
+
+
+def google_code_page(size: int, name: str = 'foo') -> bytes:
+    """Generate a Google Code archive downloads response.
+
+    Args:
+        size: Approximate page size in bytes
+        name: Project name
+    """
+    def render(version: str) -> str:
+        return json.dumps({
+            'filename': f'{name}-{version}.tar.gz',
+            'summary': f'{name} {version}',
+            'labels': ['Featured', 'Type-Source'],
+        })
+
+    return f'{{"downloads": [{", ".join(fill(render, size))}]}}'.encode()
+
+
+def hackage_page(size: int, name: str = 'foo') -> bytes:
+    """Generate a hackage package page.
+
+    Args:
+        size: Approximate page size in bytes
+        name: Package name
+    """
+    def render(version: str) -> str:
+        return f'<a href="/package/{name}-{version}">{version}</a>, '
+
+    return ('<html><body><table><tr><th>Versions</th><td>' +
+            ''.join(fill(render, size)) +
+            '</td></tr></table></body></html>\n').encode()
+
+
+def sourceforge_page(size: int, name: str = 'foo') -> bytes:
+    """Generate a sourceforge files RSS feed.
+
+    Args:
+        size: Approximate page size in bytes
+        name: Project name
+    """
+    def render(version: str) -> str:
+        return (f'<item><title>/{name}-{version}.tar.gz</title><link>'
+                f'https://sourceforge.net/projects/{name}/files/'
+                f'{name}-{version}.tar.gz/download</link></item>\n')
+
+    return ('<?xml version="1.0"?><rss><channel>\n' +
+            ''.join(fill(render, size)) + '</channel></rss>\n').encode()
+
+
+def sites_config(count: int) -> str:
+    """Generate a config file.
+
+    Sites cycle through the common configuration styles.
+
+    Args:
+        count: Number of sites
+    """
+    templates = [
+        'site = pypi',
+        'site = github\nuser = user',
+        'url = http://example.com/{name}/\nselect = td a',
+        'url = http://example.com/{name}/\nselect = table td > a\n'
+        'match_type = re\nmatch = {name}-[\\d.]+\\.tar\\.gz',
+    ]
+    return ''.join(
+        f'[pkg{i:06d}]\n{templates[i % len(templates)]}\n\n'.format(
+            name=f'pkg{i:06d}') for i in range(count))
+
+
+def sites_state(sites: Sites) -> None:
+    """Add typical check state to sites.
+
+    Args:
+        sites: Sites to update
+    """
+    checked = datetime.datetime(2014, 1, 1, tzinfo=datetime.timezone.utc)
+    for site in sites:
+        site.checked = checked
+        site.matches = [f'{site.name}-{v}.tar.gz' for v in versions(10)]
+        site.validators = {'etag': '"1234"', 'fingerprint': site.fingerprint}
+        site.digest = '0' * 32
+
+
+def page_site(match_func: str, options: Dict[str, str]) -> Site:
+    """Create site for matcher benchmarks.
+
+    Args:
+        match_func: Matcher to use
+        options: Site options from config file
+    """
+    site = Site.parse('foo', dict(options, url='http://example.com/'), {})
+    site.match_func = match_func
+    return site
+
+
+def matcher(match_func: str,
+            page: Callable[[int], bytes],
+            options: Optional[Dict[str, str]] = None) -> Callable:
+    """Build benchmark for a ``find_*_matches`` method.
+
+    Args:
+        match_func: Matcher to benchmark
+        page: Function to generate page content of a given size
+        options: Site options from config file
+    """
+    def bench(size: int) -> Iterator[Callable]:
+        site = page_site(match_func, options or {'select': 'td a'})
+        content = page(size)
+        find = getattr(site, f'find_{match_func}_matches')
+        yield lambda: find(content, 'utf-8')
+
+    return bench
+
+
+benchmark('Site.find_default_matches', 'size')(
+    matcher('default', listing_page, {'select': 'table td > a'}))
+benchmark('Site.find_anchor_matches', 'size')(matcher('anchor', listing_page))
+benchmark('Site.find_github_matches', 'size')(matcher('github', github_page))
+benchmark('Site.find_google_code_matches', 'size')(
+    matcher('google_code', google_code_page))
+benchmark('Site.find_hackage_matches', 'size')(
+    matcher('hackage', hackage_page))
+benchmark('Site.find_rubygems_matches', 'size')(
+    matcher('rubygems', rubygems_page))
+benchmark('Site.find_sourceforge_matches', 'size')(
+    matcher('sourceforge', sourceforge_page))
+
+
+@benchmark('utils.sort_packages', 'sites')
+def sort_packages(count: int) -> Iterator[Callable]:
+    """Sort package names, without cached version keys."""
+    packages = [f'foo-{v}.tar.gz' for v in versions(count)]
+    packages.reverse()
+
+    def func():
+        utils.version_key.cache_clear()
+        utils.sort_packages(packages)
+
+    yield func
+
+
+@benchmark('Matches.difference', 'sites')
+def matches_difference(count: int) -> Iterator[Callable]:
+    """Find new matches, with one new release."""
+    packages = [f'foo-{v}.tar.gz' for v in versions(count + 1)]
+    stored = Matches(packages[:-1])
+    yield lambda: stored.difference(packages)
+
+
+@benchmark('utils.charset_from_headers')
+def charset_from_headers() -> Iterator[Callable]:
+    """Parse charset from response headers."""
+    headers = {'content-type': 'text/html; charset=utf-8'}
+    yield lambda: utils.charset_from_headers(headers)
+
+
+@benchmark('Site.parse')
+def site_parse() -> Iterator[Callable]:
+    """Build site from config options and stored state."""
+    options = {'url': 'http://example.com/foo/', 'select': 'td a'}
+    state = {
+        'checked': '2014-01-01T12:00:00+00:00',
+        'matches': [f'foo-{v}.tar.gz' for v in versions(10)],
+    }
+    yield lambda: Site.parse('foo', dict(options), state)
+
+
+@benchmark('Sites.load', 'sites')
+def sites_load(count: int) -> Iterator[Callable]:
+    """Read config file and database."""
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        config = os.path.join(directory, 'sites.conf')
+        database = os.path.join(directory, 'sites.db')
+        with open(config, 'w') as f:
+            f.write(sites_config(count))
+        sites = Sites()
+        sites.load(config)
+        sites_state(sites)
+        sites.save(database)
+        yield lambda: Sites().load(config, database)
+
+
+@benchmark('Sites.load:cached', 'sites')
+def sites_load_cached(count: int) -> Iterator[Callable]:
+    """Read config file and database, using cached definitions."""
+    import tempfile
+
+    with tempfile.TemporaryDirectory() as directory:
+        config = os.path.join(directory, 'sites.conf')
+        database = os.path.join(directory, 'sites.db')
+        cache = os.path.join(directory, 'config.pickle')
+        with open(config, 'w') as f:
+            f.write(sites_config(count))
+        sites = Sites()
+        sites.load(config, cache=cache)
+        sites_state(sites)
+        sites.save(database)
+        yield lambda: Sites().load(config, database, cache=cache)
+
+
+def sites_save(extension: str) -> Callable:
+    """Build benchmark for :meth:`Sites.save`.
+
+    Args:
+        extension: Database file extension, selecting the backend
+    """
+    def bench(count: int) -> Iterator[Callable]:
+        import tempfile
+
+        with tempfile.TemporaryDirectory() as directory:
+            config = os.path.join(directory, 'sites.conf')
+            database = os.path.join(directory, f'sites{extension}')
+            with open(config, 'w') as f:
+                f.write(sites_config(count))
+            sites = Sites()
+            sites.load(config)
+            sites_state(sites)
+
+            def func():
+                # Force all sites to be written
+                sites._saved.clear()
+                sites.save(database)
+
+            yield func
+
+    return bench
+
+
+benchmark('Sites.save:json', 'sites')(sites_save('.db'))
+benchmark('Sites.save:sqlite', 'sites')(sites_save('.sqlite'))
+
+
+def cases(scale: str = 'quick',
+          patterns: Optional[List[str]] = None
+          ) -> Iterator[Tuple[str, ContextManager]]:
+    """Generate benchmark cases.
+
+    Args:
+        scale: Scale from :data:`SCALES`
+        patterns: Only include cases with names matching these glob patterns
+
+    Returns:
+        Case name and benchmark context manager pairs
+    """
+    counts, sizes = SCALES[scale]
+    for name, (func, axis) in BENCHMARKS.items():
+        if axis == 'sites':
+            params = [(f'{name}/{count}', count) for count in counts]
+        elif axis == 'size':
+            params = [(f'{name}/{size_label(size)}', size)
+                      for size in sizes]
+        else:
+            params = [(name, None)]
+        for case, param in params:
+            if patterns and not any(
+                    fnmatch.fnmatchcase(case, pattern)
+                    for pattern in patterns):
+                continue
+            yield case, func() if param is None else func(param)
+
+
+def measure(func: Callable, repeat: int = 5) -> Dict[str, float]:
+    """Time callable.
+
+    The number of calls per timing is chosen with
+    :meth:`timeit.Timer.autorange`, so each timing takes at least 0.2
+    seconds.
+
+    Args:
+        func: Callable to time
+        repeat: Number of timings to take
+
+    Returns:
+        Fastest and median time per call in seconds, and the number of calls
+        per timing
+    """
+    import statistics
+    import timeit
+
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange()
+    timings = [elapsed] + timer.repeat(repeat - 1, number)
+    timings = [timing / number for timing in timings]
+    return {
+        'min': min(timings),
+        'median': statistics.median(timings),
+        'number': number,
+        'repeat': repeat,
+    }
+
+
+def run(scale: str = 'quick',
+        patterns: Optional[List[str]] = None,
+        repeat: int = 5,
+        progress: Optional[Callable[[str, Dict[str, float]], None]] = None
+        ) -> Dict:
+    """Run benchmarks.
+
+    Args:
+        scale: Scale from :data:`SCALES`
+        patterns: Only run cases with names matching these glob patterns
+        repeat: Number of timings to take for each case
+        progress: Function to call with each case’s name and result
+
+    Returns:
+        Results document, suitable for storing as |JSON|
+    """
+    results = {}
+    for case, bench in cases(scale, patterns):
+        with bench as func:
+            results[case] = measure(func, repeat)
+        if progress:
+            progress(case, results[case])
+    return {
+        'format': FORMAT,
+        'version': _version.dotted,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'date': utils.utcnow().isoformat(),
+        'scale': scale,
+        'results': results,
+    }
+
+
+def compare(baseline: Dict, current: Dict, threshold: float = 0.1
+            ) -> List[Tuple[str, float, float, bool]]:
+    """Compare benchmark results.
+
+    Median timings are compared, and cases missing from either result are
+    skipped.
+
+    Args:
+        baseline: Results document to compare against
+        current: Results document to check
+        threshold: Fractional slow down that is treated as a regression
+
+    Returns:
+        Case name, baseline and current median times, and whether the change
+        is a regression
+    """
+    for results in (baseline, current):
+        if results.get('format') != FORMAT:
+            raise ValueError('Unsupported benchmark results format')
+    rows = []
+    for case, result in current['results'].items():
+        if case not in baseline['results']:
+            continue
+        before = baseline['results'][case]['median']
+        after = result['median']
+        rows.append((case, before, after, after > before * (1 + threshold)))
+    return rows
@@ -0,0 +1,368 @@
+#
+"""cache - Page cache management for cupage."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import re
+import threading
+from collections import Counter
+from contextlib import suppress
+from typing import Iterable, List, Optional, Tuple
+
+#: Names of :mod:`httplib2` cache entries, see :func:`httplib2.safename`
+ENTRY_RE = re.compile(r'.*,[0-9a-f]{32}$')
+
+#: Prefixes marking compressed cache entries, :mod:`httplib2` entries never
+#: start with a NUL
+COMPRESSION_MAGIC = {
+    'zlib': b'\0zlib\0',
+    'lzma': b'\0lzma\0',
+}
+
+
+def cache_key(url: str) -> str:
+    """Find the cache entry name for a URL.
+
+    Args:
+        url: Location to find entry for
+    """
+    import httplib2
+
+    return httplib2.safename(httplib2.urlnorm(url)[-1])
+
+
+def tag_directory(directory: str) -> None:
+    """Mark directory as a cache, if it isn’t already.
+
+    See http://www.brynosaurus.com/cachedir/ for details.
+
+    Args:
+        directory: Cache location
+    """
+    if not os.path.exists(f'{directory}/CACHEDIR.TAG'):
+        with open(f'{directory}/CACHEDIR.TAG', 'w') as f:
+            f.writelines([
+                'Signature: 8a477f597d28d172789f06886806bc55\n',
+                '# This file is a cache directory tag created by cupage.\n',
+                '# For information about cache directory tags, see:\n',
+                '#   http://www.brynosaurus.com/cachedir/\n',
+            ])
+
+
+class FileCache:
+    """Directory backed cache for :class:`httplib2.Http`.
+
+    This is compatible with :class:`httplib2.FileCache`, but entries are
+    touched when read so :meth:`CacheManager.prune` can evict the least
+    recently used entries first.
+    """
+    def __init__(self, directory: str, no_write: bool = False) -> None:
+        """Initialise a new ``FileCache`` object.
+
+        Args:
+            directory: Cache location
+            no_write: Only read from the cache, useful for testing
+        """
+        self.directory = directory
+        self.no_write = no_write
+        if not no_write:
+            os.makedirs(directory, exist_ok=True)
+            tag_directory(directory)
+
+    def __repr__(self) -> str:
+        """String representation for use in REPL."""
+        return (f'{self.__class__.__name__}({self.directory!r}, '
+                f'{self.no_write!r})')
+
+    def path(self, key: str) -> str:
+        """Location of cache entry.
+
+        Args:
+            key: Cache key from :mod:`httplib2`
+        """
+        import httplib2
+
+        return os.path.join(self.directory, httplib2.safename(key))
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Read cache entry.
+
+        Args:
+            key: Cache key from :mod:`httplib2`
+        """
+        path = self.path(key)
+        try:
+            with open(path, 'rb') as f:
+                value = f.read()
+        except OSError:
+            return None
+        if not self.no_write:
+            with suppress(OSError):
+                os.utime(path)
+        return value
+
+    def set(self, key: str, value: bytes) -> None:
+        """Write cache entry.
+
+        Args:
+            key: Cache key from :mod:`httplib2`
+            value: Data to store
+        """
+        if self.no_write:
+            return
+        with open(self.path(key), 'wb') as f:
+            f.write(value)
+
+    def delete(self, key: str) -> None:
+        """Remove cache entry.
+
+        Args:
+            key: Cache key from :mod:`httplib2`
+        """
+        if self.no_write:
+            return
+        with suppress(FileNotFoundError):
+            os.remove(self.path(key))
+
+
+def compress(method: str, data: bytes, level: Optional[int] = None) -> bytes:
+    """Compress data for storage.
+
+    Args:
+        method: Compression method, from :data:`COMPRESSION_MAGIC`
+        data: Data to compress
+        level: Compression level, defaults to method’s default
+
+    Returns:
+        Compressed data, including the prefix for ``method``
+    """
+    if method == 'zlib':
+        import zlib
+        data = zlib.compress(data, -1 if level is None else level)
+    elif method == 'lzma':
+        import lzma
+        data = lzma.compress(data, preset=level)
+    else:
+        raise ValueError(f'Unknown compression method {method!r}')
+    return COMPRESSION_MAGIC[method] + data
+
+
+def decompress(data: bytes) -> bytes:
+    """Decompress stored data.
+
+    Args:
+        data: Data to decompress, uncompressed data is returned unchanged
+
+    Returns:
+        Original data
+
+    Raises:
+        ValueError: Corrupt or unknown compressed data
+    """
+    if not data.startswith(b'\0'):
+        return data
+    for method, magic in COMPRESSION_MAGIC.items():
+        if data.startswith(magic):
+            break
+    else:
+        raise ValueError('Unknown compression method')
+    data = data[len(magic):]
+    if method == 'zlib':
+        import zlib
+        try:
+            return zlib.decompress(data)
+        except zlib.error as error:
+            raise ValueError(f'Invalid zlib data ({error})')
+    import lzma
+    try:
+        return lzma.decompress(data)
+    except lzma.LZMAError as error:
+        raise ValueError(f'Invalid lzma data ({error})')
+
+
+class CompressedFileCache(FileCache):
+    """Directory backed cache storing compressed entries.
+
+    Uncompressed entries, such as those written by :class:`FileCache`, are
+    still read so an existing cache can be used.
+    """
+    def __init__(self,
+                 directory: str,
+                 method: str = 'zlib',
+                 level: Optional[int] = None,
+                 no_write: bool = False) -> None:
+        """Initialise a new ``CompressedFileCache`` object.
+
+        Args:
+            directory: Cache location
+            method: Compression method, from :data:`COMPRESSION_MAGIC`
+            level: Compression level, defaults to method’s default
+            no_write: Only read from the cache, useful for testing
+        """
+        if method not in COMPRESSION_MAGIC:
+            raise ValueError(f'Unknown compression method {method!r}')
+        super().__init__(directory, no_write)
+        self.method = method
+        self.level = level
+        #: Total ``raw`` and ``stored`` bytes for entries written
+        self.stats = Counter()
+        self._lock = threading.Lock()
+
+    def __repr__(self) -> str:
+        """String representation for use in REPL."""
+        return (f'{self.__class__.__name__}({self.directory!r}, '
+                f'{self.method!r}, {self.level!r}, {self.no_write!r})')
+
+    def get(self, key: str) -> Optional[bytes]:
+        """Read cache entry.
+
+        Corrupt entries are treated as missing.
+
+        Args:
+            key: Cache key from :mod:`httplib2`
+        """
+        value = super().get(key)
+        if value is None:
+            return None
+        try:
+            return decompress(value)
+        except ValueError:
+            return None
+
+    def set(self, key: str, value: bytes) -> None:
+        """Write compressed cache entry.
+
+        Args:
+            key: Cache key from :mod:`httplib2`
+            value: Data to store
+        """
+        if self.no_write:
+            return
+        stored = compress(self.method, value, self.level)
+        super().set(key, stored)
+        with self._lock:
+            self.stats['raw'] += len(value)
+            self.stats['stored'] += len(stored)
+
+    @property
+    def ratio(self) -> float:
+        """Size of written entries relative to their uncompressed size."""
+        if not self.stats['raw']:
+            return 0.0
+        return self.stats['stored'] / self.stats['raw']
+
+
+class CacheManager:
+    """Size and content management for a page cache directory.
+
+    Only files named like :mod:`httplib2` cache entries are handled, so
+    :file:`CACHEDIR.TAG` and cupage’s own data files are left in place.
+    """
+    def __init__(self, directory: str) -> None:
+        """Initialise a new ``CacheManager`` object.
+
+        Args:
+            directory: Cache location
+        """
+        self.directory = directory
+
+    def __repr__(self) -> str:
+        """String representation for use in REPL."""
+        return f'{self.__class__.__name__}({self.directory!r})'
+
+    def entries(self) -> List[os.DirEntry]:
+        """Find cache entries.
+
+        Returns:
+            Cache entries, least recently used first
+        """
+        if not os.path.isdir(self.directory):
+            return []
+        with os.scandir(self.directory) as it:
+            entries = [
+                entry for entry in it
+                if entry.is_file() and ENTRY_RE.match(entry.name)
+            ]
+        return sorted(entries, key=lambda entry: entry.stat().st_mtime)
+
+    def stats(self) -> Tuple[int, int]:
+        """Summarise cache usage.
+
+        Returns:
+            Number of entries, and their total size in bytes
+        """
+        entries = self.entries()
+        return len(entries), sum(entry.stat().st_size for entry in entries)
+
+    def _remove(self, entries: Iterable[os.DirEntry]) -> Tuple[int, int]:
+        """Remove cache entries.
+
+        Args:
+            entries: Entries to remove
+
+        Returns:
+            Number of entries removed, and bytes freed
+        """
+        count = size = 0
+        for entry in entries:
+            with suppress(FileNotFoundError):
+                entry_size = entry.stat().st_size
+                os.remove(entry.path)
+                count += 1
+                size += entry_size
+        return count, size
+
+    def prune(self,
+              max_bytes: Optional[int] = None,
+              max_entries: Optional[int] = None,
+              urls: Optional[Iterable[str]] = None) -> Tuple[int, int]:
+        """Remove orphaned entries, and evict entries to fit limits.
+
+        Args:
+            max_bytes: Maximum total size of entries
+            max_entries: Maximum number of entries
+            urls: Locations still in use, entries for other URLs are removed
+
+        Returns:
+            Number of entries removed, and bytes freed
+        """
+        entries = self.entries()
+        orphans = []
+        if urls is not None:
+            keep = {cache_key(url) for url in urls}
+            orphans = [entry for entry in entries if entry.name not in keep]
+            entries = [entry for entry in entries if entry.name in keep]
+
+        evict = 0
+        if max_entries is not None:
+            evict = max(evict, len(entries) - max_entries)
+        if max_bytes is not None:
+            size = sum(entry.stat().st_size for entry in entries)
+            while evict < len(entries) and size > max_bytes:
+                size -= entries[evict].stat().st_size
+                evict += 1
+        return self._remove(orphans + entries[:evict])
+
+    def clear(self) -> Tuple[int, int]:
+        """Remove all cache entries.
+
+        Returns:
+            Number of entries removed, and bytes freed
+        """
+        return self._remove(self.entries())
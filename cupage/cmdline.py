@@ -23,11 +23,14 @@ import errno
 import logging
 import os
 import re
+import signal
 import socket
+import threading
+import time
 
 from configparser import ConfigParser, DuplicateSectionError, ParsingError
 from operator import attrgetter
-from typing import List
+from typing import Dict, List, Optional
 
 import click
 
@@ -38,6 +41,15 @@ from jnrbase import colourise
 import cupage
 
 from . import (_version, utils)
+from .cache import CacheManager, CompressedFileCache, FileCache
+from .scheduler import HostLimits
+
+#: Default number of concurrent site checks for each ``check`` engine
+DEFAULT_JOBS = {'threads': 1, 'async': 100}
+
+#: Longest time in seconds that ``daemon`` holds results before saving them,
+#: for database formats that are rewritten in full
+SAVE_INTERVAL = 60
 
 
 class FrequencyParamType(click.ParamType):
@@ -64,13 +76,71 @@ class FrequencyParamType(click.ParamType):
         return value
 
 
-def load_sites(config: str, database: str, pages: List[str]) -> cupage.Sites:
+class ProfileParamType(click.ParamType):
+    """Profiling specification parameter handler."""
+
+    name = 'profile'
+
+    def convert(self, value: str, param: click.Argument,
+                ctx: click.Context) -> str:
+        """Check given profiling specification is valid.
+
+        Args:
+            value: Value given to flag
+            param: Parameter being processed
+            ctx: Current command context
+
+        Returns:
+            Profiling specification for :func:`~cupage.utils.maybe_profile`
+        """
+        try:
+            utils.parse_profile(value)
+        except ValueError as error:
+            self.fail(str(error))
+        return value
+
+
+class SizeParamType(click.ParamType):
+    """Size parameter handler."""
+
+    name = 'size'
+
+    #: Multipliers for size suffixes
+    units = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3}
+
+    def convert(self, value: str, param: click.Argument,
+                ctx: click.Context) -> int:
+        """Check given size is valid.
+
+        Args:
+            value: Value given to flag
+            param: Parameter being processed
+            ctx: Current command context
+
+        Returns:
+            Size in bytes
+        """
+        if isinstance(value, int):
+            return value
+        match = re.fullmatch(r'(\d+)\s*([kmg]?)b?', value.strip().lower())
+        if not match:
+            self.fail('Invalid size value')
+        return int(match.group(1)) * self.units[match.group(2)]
+
+
+def load_sites(config: str,
+               database: str,
+               pages: List[str],
+               lazy: bool = True,
+               cache: Optional[str] = None) -> cupage.Sites:
     """Load site data.
 
     Args:
         config: Location of config file
         database: Location of database file
         pages: Pages to check
+        lazy: Only parse definitions for ``pages``, if given
+        cache: Location of compiled config cache
 
     Returns:
         Imported site data
@@ -80,9 +150,9 @@ def load_sites(config: str, database: str, pages: List[str]) -> cupage.Sites:
 
     sites = cupage.Sites()
     try:
-        sites.load(config, database)
+        sites.load(config, database, pages if lazy else None, cache)
     except IOError as e:
-        colourise.pfail(e.message)
+        colourise.pfail(str(e))
         return errno.EIO
     except ValueError:
         colourise.pfail('Error reading database file')
@@ -92,7 +162,7 @@ def load_sites(config: str, database: str, pages: List[str]) -> cupage.Sites:
         return errno.ENOENT
 
     # Check all named pages exist in config
-    site_names = [s['name'] for s in sites]
+    site_names = [s.name for s in sites]
     for page in pages:
         if page not in site_names:
             raise ValueError(f'Invalid site argument {page!r}')
@@ -100,6 +170,59 @@ def load_sites(config: str, database: str, pages: List[str]) -> cupage.Sites:
     return sites
 
 
+def open_cache(cache: str,
+               compression: str,
+               level: Optional[int] = None,
+               no_write: bool = False) -> FileCache:
+    """Open page cache.
+
+    Args:
+        cache: Location of cache directory
+        compression: Compression method for entries, or ``none``
+        level: Compression level for entries
+        no_write: Only read from the cache
+
+    Returns:
+        Page cache
+    """
+    if compression == 'none':
+        return FileCache(cache, no_write)
+    return CompressedFileCache(cache, compression, level, no_write)
+
+
+def report_compression(cache: FileCache) -> None:
+    """Display compression ratio for entries written this run.
+
+    Args:
+        cache: Page cache used for run
+    """
+    if isinstance(cache, CompressedFileCache) and cache.stats['raw']:
+        click.echo(f'{cache.stats["raw"]} bytes of page data cached in '
+                   f'{cache.stats["stored"]} bytes ({cache.ratio:.0%})')
+
+
+def report(site: cupage.Site, matches: Optional[List[str]],
+           verbose: bool) -> None:
+    """Display result of a site check.
+
+    Args:
+        site: Site that was checked
+        matches: New matches found by the check
+        verbose: Whether to display verbose output
+    """
+    if verbose:
+        click.echo(site)
+        click.echo(f'Checked {site.name}')
+    if matches:
+        if verbose:
+            click.echo(f'{site.name} has new matches')
+        for match in matches:
+            colourise.psuccess(match)
+    else:
+        if verbose:
+            click.echo(f'{site.name} has no new matches')
+
+
 @click.group(epilog='Please report bugs to '
              'https://github.com/JNRowe/cupage/issues')
 @click.version_option(_version.dotted)
@@ -112,8 +235,14 @@ def load_sites(config: str, database: str, pages: List[str]) -> cupage.Sites:
               'verbose',
               flag_value=False,
               help='Output only matches and errors.')
+@click.option('--profile',
+              type=ProfileParamType(),
+              envvar='CUPAGE_PROFILE',
+              metavar='MODE:FILE',
+              help='Profile execution, with mode from '
+              f'{", ".join(utils.PROFILE_MODES)}.')
 @click.pass_context
-def cli(ctx: click.Context, verbose: bool):
+def cli(ctx: click.Context, verbose: bool, profile: Optional[str]):
     """A tool to check for updates on web pages.
 
     \f
@@ -121,8 +250,11 @@ def cli(ctx: click.Context, verbose: bool):
     Args:
         ctx: Current command context
         verbose: Whether to display verbose output
+        profile: Profiling specification
     """
     ctx.obj = ROAttrDict(verbose=verbose)
+    if profile:
+        ctx.with_resource(utils.maybe_profile(profile))
 
 
 @cli.command()
@@ -194,6 +326,207 @@ def add(config: str, site: str, url: str, match_type: str, match: str,
         conf.write(f)
 
 
+@cli.group(name='benchmark')
+def benchmark_group():
+    """Measure performance of cupage internals."""
+
+
+@benchmark_group.command(name='run')
+@click.option('-o',
+              '--output',
+              type=click.File('w'),
+              help='File to write JSON results to.')
+@click.option('--scale',
+              type=click.Choice(['quick', 'full']),
+              default='quick',
+              help='Range of site counts and page sizes to benchmark.')
+@click.option('-r',
+              '--repeat',
+              type=click.IntRange(min=1),
+              default=5,
+              help='Number of timings to take for each benchmark.')
+@click.option('-b',
+              '--baseline',
+              type=click.File(),
+              help='Results file to compare against.')
+@click.option('--threshold',
+              type=click.FloatRange(min=0),
+              default=10,
+              help='Slow down percentage to report as a regression.')
+@click.argument('patterns', nargs=-1)
+def benchmark_run(output: Optional[click.File], scale: str, repeat: int,
+                  baseline: Optional[click.File], threshold: float,
+                  patterns: List[str]):
+    """Run benchmarks.
+
+    \f
+
+    Args:
+        output: File to write results to
+        scale: Range of site counts and page sizes to benchmark
+        repeat: Number of timings to take for each benchmark
+        baseline: Results file to compare against
+        threshold: Slow down percentage to report as a regression
+        patterns: Only run benchmarks with names matching these patterns
+    """
+    import json
+
+    from . import benchmark
+
+    def progress(case: str, result: Dict[str, float]):
+        click.echo(f'{case:<44} {result["median"] * 1000:12.3f} ms')
+
+    results = benchmark.run(scale, patterns, repeat, progress)
+    if output:
+        json.dump(results, output, indent=4)
+        output.write('\n')
+    if baseline:
+        compare_results(json.load(baseline), results, threshold)
+
+
+@benchmark_group.command(name='compare')
+@click.option('--threshold',
+              type=click.FloatRange(min=0),
+              default=10,
+              help='Slow down percentage to report as a regression.')
+@click.argument('baseline', type=click.File())
+@click.argument('current', type=click.File())
+def benchmark_compare(threshold: float, baseline: click.File,
+                      current: click.File):
+    """Compare benchmark results.
+
+    \f
+
+    Args:
+        threshold: Slow down percentage to report as a regression
+        baseline: Results file to compare against
+        current: Results file to check
+    """
+    import json
+
+    compare_results(json.load(baseline), json.load(current), threshold)
+
+
+@benchmark_group.command(name='load')
+@click.option('-n',
+              '--sites',
+              type=click.IntRange(min=1),
+              default=1000,
+              help='Number of sites to check.')
+@click.option('-p',
+              '--passes',
+              type=click.IntRange(min=1),
+              default=2,
+              help='Number of times to check all sites.')
+@click.option('-j',
+              '--jobs',
+              type=click.IntRange(min=1),
+              default=16,
+              help='Number of sites to check concurrently.')
+@click.option('-e',
+              '--engine',
+              type=click.Choice(['threads', 'async']),
+              default='threads',
+              help='Method used to fetch pages.')
+@click.option('--page-size',
+              type=SizeParamType(),
+              default='16K',
+              help='Approximate size of served pages.')
+@click.option('--latency',
+              type=click.FloatRange(min=0),
+              default=0,
+              help='Mean server response delay in seconds.')
+@click.option('--error-rate',
+              type=click.FloatRange(0, 1),
+              default=0,
+              help='Fraction of page requests that fail.')
+@click.option('--not-modified',
+              type=click.FloatRange(0, 1),
+              default=0.5,
+              help='Fraction of conditional requests answered with 304.')
+@click.option('--seed', type=int, help='Seed for server behaviour.')
+@click.option('-o',
+              '--output',
+              type=click.File('w'),
+              help='File to write JSON results to.')
+def benchmark_load(sites: int, passes: int, jobs: int, engine: str,
+                   page_size: int, latency: float, error_rate: float,
+                   not_modified: float, seed: Optional[int],
+                   output: Optional[click.File]):
+    """Check sites served by a local stand-in server.
+
+    \f
+
+    Args:
+        sites: Number of sites to check
+        passes: Number of times to check all sites
+        jobs: Number of sites to check concurrently
+        engine: Method used to fetch pages
+        page_size: Approximate size of served pages
+        latency: Mean server response delay in seconds
+        error_rate: Fraction of page requests that fail
+        not_modified: Fraction of conditional requests answered with 304
+        seed: Seed for server behaviour
+        output: File to write results to
+    """
+    import json
+
+    from . import loadtest
+
+    results = loadtest.run(sites, passes, jobs, engine, page_size=page_size,
+                           latency=latency, error_rate=error_rate,
+                           not_modified=not_modified, seed=seed)
+    for number, result in enumerate(results['passes'], 1):
+        server = result['server']
+        click.echo(
+            f'Pass {number}: {result["sites"]} sites in '
+            f'{result["elapsed"]:.2f}s ({result["rate"]:.1f} sites/s), '
+            f'p50 {result["p50"] * 1000:.1f} ms, '
+            f'p99 {result["p99"] * 1000:.1f} ms')
+        click.echo(
+            f'    {server.get("requests", 0)} requests, '
+            f'{server.get("not_modified", 0)} not modified, '
+            f'{server.get("errors", 0)} errors, '
+            f'{result["failures"]} failed sites, '
+            f'{result["unchanged"]} unchanged pages')
+    if results['peak_rss']:
+        click.echo(f'Peak RSS {results["peak_rss"] / 1024 ** 2:.1f} MiB')
+    if output:
+        json.dump(results, output, indent=4)
+        output.write('\n')
+
+
+def compare_results(baseline: Dict, current: Dict, threshold: float) -> None:
+    """Display benchmark comparison.
+
+    Args:
+        baseline: Results document to compare against
+        current: Results document to check
+        threshold: Slow down percentage to report as a regression
+
+    Raises:
+        click.exceptions.Exit: When there are regressions
+    """
+    from . import benchmark
+
+    try:
+        rows = benchmark.compare(baseline, current, threshold / 100)
+    except ValueError as error:
+        raise click.BadParameter(str(error))
+    regressions = 0
+    for case, before, after, regression in rows:
+        line = (f'{case:<44} {before * 1000:12.3f} {after * 1000:12.3f} ms '
+                f'({after / before - 1:+.0%})')
+        if regression:
+            colourise.pfail(line)
+            regressions += 1
+        else:
+            click.echo(line)
+    if regressions:
+        colourise.pfail(f'{regressions} regressions found')
+        raise click.exceptions.Exit(1)
+
+
 @cli.command(hidden=True)
 def bug_data():
     """Produce data for cupage bug reports."""
@@ -205,7 +538,9 @@ def bug_data():
     click.echo('* `python` version: {}'.format(sys.version.replace('\n', '|')))
     click.echo()
 
-    for m in ['click', 'cssselect', 'httplib2', 'jnrbase', 'lxml']:
+    for m in [
+            'aiohttp', 'click', 'cssselect', 'httplib2', 'jnrbase', 'lxml'
+    ]:
         if m not in sys.modules:  # pragma: no cover
             try:
                 import_module(m)
@@ -216,6 +551,99 @@ def bug_data():
         click.echo(f'* {link}: {ver}')
 
 
+@cli.group(name='cache')
+def cache_group():
+    """Manage the page cache."""
+
+
+@cache_group.command(name='stats')
+@click.option('-c',
+              '--cache',
+              type=click.Path(file_okay=False),
+              default=os.path.expanduser('~/.cupage/'),
+              help='Directory to store page cache.')
+def cache_stats(cache: str):
+    """Display page cache usage.
+
+    \f
+
+    Args:
+        cache: Location of cache directory
+    """
+    count, size = CacheManager(cache).stats()
+    click.echo(f'{count} entries using {size} bytes')
+
+
+@cache_group.command(name='prune')
+@click.option('-f',
+              '--config',
+              type=click.Path(exists=True, dir_okay=False),
+              default=os.path.expanduser('~/.cupage.conf'),
+              help='Config file to read page definitions from.')
+@click.option('-c',
+              '--cache',
+              type=click.Path(file_okay=False),
+              default=os.path.expanduser('~/.cupage/'),
+              help='Directory to store page cache.')
+@click.option('--cache-size',
+              type=SizeParamType(),
+              envvar='CUPAGE_CACHE_SIZE',
+              help='Maximum size of page cache, for example 50M.')
+@click.option('--cache-entries',
+              type=click.IntRange(min=0),
+              envvar='CUPAGE_CACHE_ENTRIES',
+              help='Maximum number of page cache entries.')
+@click.pass_obj
+def cache_prune(globs: ROAttrDict, config: str, cache: str,
+                cache_size: Optional[int], cache_entries: Optional[int]):
+    """Remove unused and least recently used cache entries.
+
+    Entries for locations that aren’t used by the config file are removed,
+    including those for redirect targets and for other config files that
+    share the cache.
+
+    \f
+
+    Args:
+        globs: Global options object
+        config: Location of config file
+        cache: Location of cache directory
+        cache_size: Maximum size of page cache in bytes
+        cache_entries: Maximum number of page cache entries
+    """
+    # Only site locations are needed, so the database isn’t read
+    sites = cupage.Sites()
+    try:
+        sites.load(config, cache=os.path.join(cache, 'config.pickle'))
+    except (IOError, ParsingError):
+        raise IOError('Error processing config')
+    count, size = CacheManager(cache).prune(cache_size, cache_entries,
+                                            sites.urls())
+    if globs.verbose:
+        click.echo(f'Removed {count} entries ({size} bytes)')
+
+
+@cache_group.command(name='clear')
+@click.option('-c',
+              '--cache',
+              type=click.Path(file_okay=False),
+              default=os.path.expanduser('~/.cupage/'),
+              help='Directory to store page cache.')
+@click.pass_obj
+def cache_clear(globs: ROAttrDict, cache: str):
+    """Remove all page cache entries.
+
+    \f
+
+    Args:
+        globs: Global options object
+        cache: Location of cache directory
+    """
+    count, size = CacheManager(cache).clear()
+    if globs.verbose:
+        click.echo(f'Removed {count} entries ({size} bytes)')
+
+
 @cli.command()
 @click.option('-f',
               '--config',
@@ -226,7 +654,7 @@ def bug_data():
               '--database',
               type=click.Path(dir_okay=False, writable=True),
               help='Database to store page data to(default based on '
-              '--config value.)')
+              '--config value, use a .sqlite extension for SQLite.)')
 @click.option('-c',
               '--cache',
               type=click.Path(file_okay=False, writable=True),
@@ -242,12 +670,73 @@ def bug_data():
               metavar='30',
               default=30,
               help='Timeout for network operations.')
+@click.option('-j',
+              '--jobs',
+              type=click.IntRange(min=1),
+              metavar='1',
+              help='Number of sites to check concurrently (default 1, or '
+              '100 with the async engine).')
+@click.option('-e',
+              '--engine',
+              default='threads',
+              type=click.Choice(['threads', 'async']),
+              help='Method used to fetch pages.')
+@click.option('--robots-ttl',
+              type=FrequencyParamType(),
+              default='1d',
+              help='Lifetime of robots.txt data when not set by the host.')
+@click.option('--host-concurrency',
+              type=click.IntRange(min=1),
+              metavar='4',
+              default=4,
+              help='Maximum concurrent requests to each host.')
+@click.option('--host-delay',
+              type=click.FloatRange(min=0),
+              metavar='0',
+              default=0,
+              help='Minimum seconds between requests to each host.')
+@click.option('--cache-size',
+              type=SizeParamType(),
+              envvar='CUPAGE_CACHE_SIZE',
+              help='Maximum size of page cache, for example 50M.')
+@click.option('--cache-entries',
+              type=click.IntRange(min=0),
+              envvar='CUPAGE_CACHE_ENTRIES',
+              help='Maximum number of page cache entries.')
+@click.option('--prune-orphans/--no-prune-orphans',
+              help='Remove page cache entries for locations the config file '
+              'doesn’t use, including redirect targets and entries for other '
+              'config files.')
+@click.option('--cache-compression',
+              type=click.Choice(['none', 'zlib', 'lzma']),
+              envvar='CUPAGE_CACHE_COMPRESSION',
+              default='none',
+              help='Compression method for page cache entries.')
+@click.option('--cache-level',
+              type=click.IntRange(0, 9),
+              envvar='CUPAGE_CACHE_LEVEL',
+              help='Compression level for page cache entries.')
+@click.option('--metrics-file',
+              type=click.Path(dir_okay=False, writable=True),
+              envvar='CUPAGE_METRICS_FILE',
+              help='File to write check metrics to, use a .prom extension '
+              'for Prometheus text format.')
 @click.argument('pages', nargs=-1)
 @click.pass_obj
 def check(globs: ROAttrDict, config: str, database: str, cache: str, write:
-          bool, force: bool, timeout: int, pages: List[str]):
+          bool, force: bool, timeout: int, jobs: Optional[int], engine: str,
+          robots_ttl: str, host_concurrency: int, host_delay: float,
+          cache_size: Optional[int], cache_entries: Optional[int],
+          prune_orphans: bool, cache_compression: str,
+          cache_level: Optional[int], metrics_file: Optional[str],
+          pages: List[str]):
     """Check sites for updates.
 
+    Least recently used page cache entries are removed after checking to fit
+    within --cache-size and --cache-entries.  Entries for locations that
+    aren’t used by the config file are only removed with --prune-orphans, or
+    by the “cache prune” command.
+
     \f
 
     Args:
@@ -259,9 +748,23 @@ def check(globs: ROAttrDict, config: str, database: str, cache: str, write:
         force: Force update regardless of ``frequency`` setting
         frequency: Update frequency
         timeout: Network timeout in seconds
+        jobs: Number of sites to check concurrently, see
+            :data:`DEFAULT_JOBS`
+        engine: Method used to fetch pages
+        robots_ttl: Default lifetime for cached :file:`robots.txt` data
+        host_concurrency: Maximum concurrent requests to each host
+        host_delay: Minimum seconds between requests to each host
+        cache_size: Maximum size of page cache in bytes
+        cache_entries: Maximum number of page cache entries
+        prune_orphans: Remove page cache entries for unused locations
+        cache_compression: Compression method for page cache entries
+        cache_level: Compression level for page cache entries
+        metrics_file: File to write check metrics to
         pages: Pages to check
     """
-    sites = load_sites(config, database, pages)
+    sites = load_sites(
+        config, database, pages,
+        cache=os.path.join(cache, 'config.pickle') if write else None)
     if not isinstance(sites, cupage.Sites):
         raise IOError('Error processing config or database')
 
@@ -271,20 +774,185 @@ def check(globs: ROAttrDict, config: str, database: str, cache: str, write:
                 os.path.splitext(config)[0], os.path.extsep)
         atexit.register(sites.save, database)
 
-    for site in sorted(sites, key=attrgetter('name')):
-        if not pages or site.name in pages:
-            if globs.verbose:
-                click.echo(site)
-                click.echo(f'Checking {site.name}…')
-            matches = site.check(cache, timeout, force, not write)
-            if matches:
-                if globs.verbose:
-                    click.echo(f'{site.name} has new matches')
-                for match in utils.sort_packages(matches):
-                    colourise.psuccess(match)
-            else:
-                if globs.verbose:
-                    click.echo(f'{site.name} has no new matches')
+    robots = utils.RobotsCache(parse_timedelta(robots_ttl),
+                               os.path.join(cache, 'robots.json'))
+    if write:
+        atexit.register(robots.save)
+    limits = HostLimits(host_concurrency, host_delay, sites.hosts)
+
+    recorder = cupage.metrics.Recorder() if metrics_file else None
+    if jobs is None:
+        jobs = DEFAULT_JOBS[engine]
+    if engine == 'async':
+        import asyncio
+        results = asyncio.run(
+            sites.check_async(timeout, force, pages, jobs, robots, limits,
+                              recorder))
+    else:
+        results = sites.check(
+            open_cache(cache, cache_compression, cache_level, not write),
+            timeout, force, not write, pages, jobs, robots, limits, recorder)
+    for site, matches in results:
+        report(site, matches, globs.verbose)
+    if globs.verbose and engine == 'threads':
+        stats = sites.pool.stats
+        click.echo(f'{stats["requests"]} requests, {stats["reused"]} over '
+                   f'reused connections ({sites.pool.reuse_ratio:.0%})')
+        report_compression(sites.pool.cache)
+    if globs.verbose:
+        click.echo(f'{sites.stats["unchanged"]} unchanged pages not parsed')
+    # Orphaned entries are only removed on request, as the cache may be
+    # shared with other configs and holds entries for redirect targets
+    if write and (prune_orphans or cache_size is not None
+                  or cache_entries is not None):
+        count, size = CacheManager(cache).prune(
+            cache_size, cache_entries, sites.urls() if prune_orphans else None)
+        if globs.verbose and count:
+            click.echo(f'Removed {count} cache entries ({size} bytes)')
+    if recorder:
+        recorder.write(metrics_file)
+
+
+@cli.command()
+@click.option('-f',
+              '--config',
+              type=click.Path(exists=True, dir_okay=False),
+              default=os.path.expanduser('~/.cupage.conf'),
+              help='Config file to read page definitions from.')
+@click.option('-d',
+              '--database',
+              type=click.Path(dir_okay=False, writable=True),
+              help='Database to store page data to(default based on '
+              '--config value, use a .sqlite extension for SQLite.)')
+@click.option('-c',
+              '--cache',
+              type=click.Path(file_okay=False, writable=True),
+              default=os.path.expanduser('~/.cupage/'),
+              help='Directory to store page cache.')
+@click.option('-t',
+              '--timeout',
+              type=click.INT,
+              metavar='30',
+              default=30,
+              help='Timeout for network operations.')
+@click.option('-j',
+              '--jobs',
+              type=click.IntRange(min=1),
+              metavar='1',
+              default=1,
+              help='Number of sites to check concurrently.')
+@click.option('--frequency',
+              type=FrequencyParamType(),
+              default='1d',
+              help='Check frequency for sites that don’t set one.')
+@click.option('--robots-ttl',
+              type=FrequencyParamType(),
+              default='1d',
+              help='Lifetime of robots.txt data when not set by the host.')
+@click.option('--host-concurrency',
+              type=click.IntRange(min=1),
+              metavar='4',
+              default=4,
+              help='Maximum concurrent requests to each host.')
+@click.option('--host-delay',
+              type=click.FloatRange(min=0),
+              metavar='0',
+              default=0,
+              help='Minimum seconds between requests to each host.')
+@click.option('--cache-compression',
+              type=click.Choice(['none', 'zlib', 'lzma']),
+              envvar='CUPAGE_CACHE_COMPRESSION',
+              default='none',
+              help='Compression method for page cache entries.')
+@click.option('--cache-level',
+              type=click.IntRange(0, 9),
+              envvar='CUPAGE_CACHE_LEVEL',
+              help='Compression level for page cache entries.')
+@click.argument('pages', nargs=-1)
+@click.pass_obj
+def daemon(globs: ROAttrDict, config: str, database: str, cache: str,
+           timeout: int, jobs: int, frequency: str, robots_ttl: str,
+           host_concurrency: int, host_delay: float, cache_compression: str,
+           cache_level: Optional[int], pages: List[str]):
+    """Check sites continuously as they become due.
+
+    \f
+
+    Args:
+        globs: Global options object
+        config: Location of config file
+        database: Location of database file
+        cache: Location of cache directory
+        timeout: Network timeout in seconds
+        jobs: Number of sites to check concurrently
+        frequency: Check frequency for sites that don’t set one
+        robots_ttl: Default lifetime for cached :file:`robots.txt` data
+        host_concurrency: Maximum concurrent requests to each host
+        host_delay: Minimum seconds between requests to each host
+        cache_compression: Compression method for page cache entries
+        cache_level: Compression level for page cache entries
+        pages: Pages to check
+    """
+    sites = load_sites(config, database, pages,
+                       cache=os.path.join(cache, 'config.pickle'))
+    if not isinstance(sites, cupage.Sites):
+        raise IOError('Error processing config or database')
+    if database is None:
+        database = '{}{}db'.format(os.path.splitext(config)[0], os.path.extsep)
+
+    robots = utils.RobotsCache(parse_timedelta(robots_ttl),
+                               os.path.join(cache, 'robots.json'))
+    limits = HostLimits(host_concurrency, host_delay, sites.hosts)
+
+    stop = threading.Event()
+    for signum in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signum, lambda *_: stop.set())
+
+    # SQLite databases only write changed sites, but other formats are
+    # rewritten in full so results are saved in batches
+    selective = cupage.database.open_database(database).selective
+    last_save = time.monotonic()
+    pending = False
+
+    def flush():
+        nonlocal last_save, pending
+        if pending:
+            sites.save(database)
+            last_save = time.monotonic()
+            pending = False
+
+    page_cache = open_cache(cache, cache_compression, cache_level)
+    for site, matches in sites.watch(page_cache, timeout, jobs=jobs,
+                                     robots=robots, limits=limits,
+                                     frequency=parse_timedelta(frequency),
+                                     stop=stop, idle=flush):
+        report(site, matches, globs.verbose)
+        pending = True
+        if selective or time.monotonic() - last_save >= SAVE_INTERVAL:
+            flush()
+    sites.save(database)
+    robots.save()
+    if globs.verbose:
+        report_compression(page_cache)
+
+
+@cli.command()
+@click.argument('source', type=click.Path(exists=True, dir_okay=False))
+@click.argument('dest', type=click.Path(dir_okay=False, writable=True))
+@click.pass_obj
+def migrate(globs: ROAttrDict, source: str, dest: str):
+    """Copy page data between database formats.
+
+    \f
+
+    Args:
+        globs: Global options object
+        source: Database to read
+        dest: Database to write
+    """
+    count = cupage.database.migrate(source, dest)
+    if globs.verbose:
+        click.echo(f'Copied {count} sites from {source} to {dest}')
 
 
 @cli.command(name='list')
@@ -297,7 +965,7 @@ def check(globs: ROAttrDict, config: str, database: str, cache: str, write:
               '--database',
               type=click.Path(dir_okay=False, writable=True),
               help='Database to store page data to(default based on '
-              '--config value.)')
+              '--config value, use a .sqlite extension for SQLite.)')
 @click.option('-m',
               '--match',
               type=re.compile,
@@ -314,7 +982,7 @@ def list_conf(config: str, database: str, match: str, pages: List[str]):
         match: Display sites matching the given regular expression
         pages: Pages to check
     """
-    sites = load_sites(config, database, pages)
+    sites = load_sites(config, database, pages, lazy=not match)
     for site in sorted(sites, key=attrgetter('name')):
         if not pages and not match:
             click.echo(site)
@@ -386,8 +1054,7 @@ def main() -> int:
                         datefmt='%Y-%m-%dT%H:%M:%S%z')
 
     try:
-        with utils.maybe_profile():
-            cli()
+        cli()
     except socket.error as error:
         colourise.pfail(error.strerror or str(error))
         return errno.EADDRNOTAVAIL
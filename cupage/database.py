@@ -0,0 +1,228 @@
+#
+"""database - Site state storage for cupage."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import logging
+import os
+from typing import TYPE_CHECKING, Dict, Iterable, Optional, Union
+
+from . import utils
+
+if TYPE_CHECKING:  # pragma: no cover
+    import sqlite3
+
+#: File extensions that select the SQLite backend
+SQLITE_EXTENSIONS = ('.sqlite', '.sqlite3')
+
+#: Header for SQLite database files
+SQLITE_MAGIC = b'SQLite format 3\0'
+
+
+class JSONDatabase:
+    """Site state stored in a single |JSON| file.
+
+    This is the original storage format, and the whole file is rewritten on
+    every save.
+    """
+    #: Whether :meth:`load` can read a subset of sites
+    selective = False
+
+    def __init__(self, path: str) -> None:
+        """Initialise a new ``JSONDatabase`` object.
+
+        Args:
+            path: Database file location
+        """
+        self.path = path
+
+    def __repr__(self) -> str:
+        """String representation for use in REPL."""
+        return f'{self.__class__.__name__}({self.path!r})'
+
+    def load(self, names: Optional[Iterable[str]] = None) -> Dict[str, Dict]:
+        """Read state for all sites.
+
+        Args:
+            names: Ignored, the whole file is always read
+        """
+        if not os.path.exists(self.path):
+            logging.debug('Database file %r doesn’t exist', self.path)
+            return {}
+        with open(self.path) as f:
+            return json.load(f)
+
+    def save(self,
+             states: Dict[str, Dict],
+             changed: Optional[Iterable[str]] = None,
+             names: Optional[Iterable[str]] = None) -> None:
+        """Write state for all sites.
+
+        Args:
+            states: State for each site
+            changed: Names of sites that have changed, unused in this backend
+            names: Names of all current sites, unused in this backend as
+                only ``states`` are written
+        """
+        import tempfile
+
+        from jnrbase import json_datetime
+
+        directory, _ = os.path.split(self.path)
+        with tempfile.NamedTemporaryFile('w',
+                                         prefix='.',
+                                         dir=directory,
+                                         delete=False) as temp:
+            json_datetime.dump(states, temp)
+        os.rename(temp.name, self.path)
+
+
+class SQLiteDatabase:
+    """Site state stored in a SQLite database.
+
+    Each site is stored in its own row, and only changed sites are written
+    back.  The ``checked`` time is also held in an indexed column, so sites
+    can be queried by age without decoding their state.
+    """
+    #: Whether :meth:`load` can read a subset of sites
+    selective = True
+
+    def __init__(self, path: str) -> None:
+        """Initialise a new ``SQLiteDatabase`` object.
+
+        Args:
+            path: Database file location
+        """
+        self.path = path
+
+    def __repr__(self) -> str:
+        """String representation for use in REPL."""
+        return f'{self.__class__.__name__}({self.path!r})'
+
+    def connect(self) -> 'sqlite3.Connection':
+        """Open database, creating the schema if necessary."""
+        import sqlite3
+
+        conn = sqlite3.connect(self.path)
+        with conn:
+            conn.execute("""CREATE TABLE IF NOT EXISTS sites (
+                                name TEXT PRIMARY KEY,
+                                checked TEXT,
+                                state TEXT NOT NULL
+                            )""")
+            conn.execute('CREATE INDEX IF NOT EXISTS sites_checked '
+                         'ON sites (checked)')
+        return conn
+
+    def load(self, names: Optional[Iterable[str]] = None) -> Dict[str, Dict]:
+        """Read state for sites.
+
+        Args:
+            names: Only read the named sites, defaults to all sites
+        """
+        if not os.path.exists(self.path):
+            logging.debug('Database file %r doesn’t exist', self.path)
+            return {}
+        query = 'SELECT name, checked, state FROM sites'
+        params = ()
+        if names is not None:
+            params = tuple(names)
+            query += f' WHERE name IN ({", ".join("?" * len(params))})'
+        conn = self.connect()
+        try:
+            return {
+                name: dict(json.loads(state), checked=checked)
+                for name, checked, state in conn.execute(query, params)
+            }
+        finally:
+            conn.close()
+
+    def save(self,
+             states: Dict[str, Dict],
+             changed: Optional[Iterable[str]] = None,
+             names: Optional[Iterable[str]] = None) -> None:
+        """Write state for changed sites.
+
+        Args:
+            states: State for each site
+            changed: Names of sites that have changed, defaults to all sites
+            names: Names of all current sites, rows for other sites are
+                removed.  Defaults to keeping all rows
+        """
+        from jnrbase import json_datetime
+
+        if changed is None:
+            changed = states.keys()
+        rows = []
+        for name in changed:
+            state = dict(states[name])
+            checked = utils.parse_datetime(state.pop('checked', None))
+            rows.append((name, checked.isoformat() if checked else None,
+                         json_datetime.dumps(state, indent=None)))
+        if not rows and names is None:
+            return
+        conn = self.connect()
+        try:
+            with conn:
+                conn.executemany(
+                    'INSERT OR REPLACE INTO sites (name, checked, state) '
+                    'VALUES (?, ?, ?)', rows)
+                if names is not None:
+                    names = set(names)
+                    cursor = conn.execute('SELECT name FROM sites')
+                    stale = [(name, ) for name, in cursor
+                             if name not in names]
+                    conn.executemany('DELETE FROM sites WHERE name = ?',
+                                     stale)
+        finally:
+            conn.close()
+
+
+def open_database(path: str) -> Union[JSONDatabase, SQLiteDatabase]:
+    """Open site state database.
+
+    SQLite is used for files with an extension from
+    :data:`SQLITE_EXTENSIONS`, or existing files that contain a SQLite
+    database.  Otherwise the |JSON| format is used.
+
+    Args:
+        path: Database file location
+    """
+    if os.path.splitext(path)[1] in SQLITE_EXTENSIONS:
+        return SQLiteDatabase(path)
+    if os.path.exists(path):
+        with open(path, 'rb') as f:
+            if f.read(len(SQLITE_MAGIC)) == SQLITE_MAGIC:
+                return SQLiteDatabase(path)
+    return JSONDatabase(path)
+
+
+def migrate(source: str, dest: str) -> int:
+    """Copy all site state from one database to another.
+
+    Args:
+        source: Database to read
+        dest: Database to write
+
+    Returns:
+        Number of sites copied
+    """
+    states = open_database(source).load()
+    open_database(dest).save(states)
+    return len(states)
@@ -0,0 +1,371 @@
+#
+"""loadtest - End-to-end load testing for cupage."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import json
+import math
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextlib import redirect_stderr
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, List, Optional
+
+from . import Sites, _version, benchmark, utils
+from .scheduler import HostLimits
+
+#: Site kinds served, with their config file options
+KINDS = {
+    'listing': 'url = {base}/listing/{name}/\nselect = td a',
+    'github': 'url = {base}/github/{name}/tags\nmatch_func = github\n'
+              'select = a',
+    'rubygems': 'url = {base}/rubygems/{name}.json\n'
+                'match_func = rubygems\nselect = a',
+}
+
+#: Page generators for each site kind
+PAGES = {
+    'listing': benchmark.listing_page,
+    'github': benchmark.github_page,
+    'rubygems': benchmark.rubygems_page,
+}
+
+PATH_RE = re.compile(r'/(?P<kind>listing|github|rubygems)/(?P<name>[^/.]+)')
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """Serve synthetic pages in place of real sites."""
+    protocol_version = 'HTTP/1.1'
+    # Headers and body are written separately, so avoid delayed ACK stalls
+    disable_nagle_algorithm = True
+
+    def do_GET(self) -> None:
+        """Handle GET requests."""
+        server = self.server
+        if server.latency:
+            time.sleep(server.random.uniform(0, 2 * server.latency))
+        if self.path == '/_stats':
+            self.send_body(json.dumps(server.stats).encode(),
+                           'application/json')
+            return
+        server.count('requests')
+        if self.path == '/robots.txt':
+            self.send_body(b'User-agent: *\nAllow: /\n', 'text/plain')
+            return
+        match = PATH_RE.match(self.path)
+        if not match:
+            server.count('errors')
+            self.send_error(404)
+            return
+        if server.random.random() < server.error_rate:
+            server.count('errors')
+            self.send_error(404)
+            return
+        etag = f'"{match["kind"]}-{match["name"]}"'
+        if self.headers.get('If-None-Match') == etag \
+                and server.random.random() < server.not_modified:
+            server.count('not_modified')
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        content_type = ('text/html' if match['kind'] == 'listing' else
+                        'application/json')
+        self.send_body(server.page(match['kind'], match['name']),
+                       f'{content_type}; charset=utf-8', etag)
+
+    def send_body(self, body: bytes, content_type: str,
+                  etag: Optional[str] = None) -> None:
+        """Send successful response.
+
+        Args:
+            body: Response body
+            content_type: Response content type
+            etag: Entity tag for response
+        """
+        self.send_response(200)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        if etag:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args) -> None:
+        """Suppress request logging."""
+
+
+class StandInServer(ThreadingHTTPServer):
+    """Local HTTP server with configurable behaviour.
+
+    Requests are answered after a random delay averaging ``latency``
+    seconds.  A fraction of page requests fail with 404 errors, and a
+    fraction of conditional requests are answered with 304 responses.
+    """
+    daemon_threads = True
+    # Many checks connect at once, and dropped SYNs stall for a second
+    request_queue_size = 1024
+
+    def __init__(self,
+                 page_size: int = 16 * 1024,
+                 latency: float = 0,
+                 error_rate: float = 0,
+                 not_modified: float = 0,
+                 seed: Optional[int] = None) -> None:
+        """Initialise a new ``StandInServer`` object.
+
+        The server listens on a random port on the loopback interface.
+
+        Args:
+            page_size: Approximate size of generated pages in bytes
+            latency: Mean delay before responses in seconds
+            error_rate: Fraction of page requests that fail
+            not_modified: Fraction of conditional requests answered with 304
+            seed: Random number generator seed
+        """
+        super().__init__(('127.0.0.1', 0), StandInHandler)
+        self.page_size = page_size
+        self.latency = latency
+        self.error_rate = error_rate
+        self.not_modified = not_modified
+        self.random = random.Random(seed)
+        #: Counts of ``requests``, ``errors`` and ``not_modified`` responses
+        self.stats = Counter()
+        self._lock = threading.Lock()
+        self.page = lru_cache(maxsize=4096)(self._page)
+
+    @property
+    def base(self) -> str:
+        """Base URL for server."""
+        return f'http://127.0.0.1:{self.server_address[1]}'
+
+    def count(self, key: str) -> None:
+        """Update :attr:`stats`.
+
+        Args:
+            key: Counter to increment
+        """
+        with self._lock:
+            self.stats[key] += 1
+
+    def _page(self, kind: str, name: str) -> bytes:
+        """Generate page.
+
+        Args:
+            kind: Site kind, from :data:`PAGES`
+            name: Package name
+        """
+        return PAGES[kind](self.page_size, name)
+
+
+def serve(connection, **kwargs) -> None:
+    """Run :class:`StandInServer` until the ``connection`` is closed.
+
+    The server’s base URL is sent over ``connection`` once it is listening.
+
+    Args:
+        connection: Pipe to parent process
+        kwargs: Arguments for :class:`StandInServer`
+    """
+    server = StandInServer(**kwargs)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    connection.send(server.base)
+    try:
+        connection.recv()
+    except EOFError:
+        pass
+    server.shutdown()
+
+
+def sites_config(count: int, base: str) -> str:
+    """Generate config file for stand-in server.
+
+    Args:
+        count: Number of sites
+        base: Base URL for server
+    """
+    kinds = list(KINDS)
+    return ''.join(
+        f'[pkg{i:06d}]\n'
+        + KINDS[kinds[i % len(kinds)]].format(base=base, name=f'pkg{i:06d}')
+        + '\n\n' for i in range(count))
+
+
+def percentile(values: List[float], percent: float) -> float:
+    """Find percentile using the nearest-rank method.
+
+    Args:
+        values: Values to search
+        percent: Percentile to find
+    """
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[max(0, math.ceil(percent / 100 * len(values)) - 1)]
+
+
+def peak_rss() -> Optional[int]:
+    """Find peak resident set size for this process.
+
+    Returns:
+        Peak size in bytes, or ``None`` when unsupported
+    """
+    try:
+        import resource
+    except ImportError:  # pragma: no cover
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes, but macOS uses bytes
+    return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def check_pass(config: str, database: str, cache: str, jobs: int,
+               engine: str, timeout: Optional[int]) -> Dict:
+    """Load, check and save sites.
+
+    Args:
+        config: Location of config file
+        database: Location of database file
+        cache: Location of cache directory
+        jobs: Number of sites to check concurrently
+        engine: Method used to fetch pages
+        timeout: Network timeout in seconds
+
+    Returns:
+        Timing and result summary for pass
+    """
+    start = time.monotonic()
+    sites = Sites()
+    sites.load(config, database)
+    robots = utils.RobotsCache()
+    limits = HostLimits(jobs)
+    # Failing sites are counted rather than reported
+    with open(os.devnull, 'w') as devnull, redirect_stderr(devnull):
+        if engine == 'async':
+            import asyncio
+            results = asyncio.run(
+                sites.check_async(timeout, True, None, jobs, robots, limits))
+        else:
+            results = list(
+                sites.check(cache, timeout, True, False, None, jobs, robots,
+                            limits))
+    sites.save(database)
+    elapsed = time.monotonic() - start
+    durations = list(sites.durations.values())
+    return {
+        'sites': len(results),
+        'elapsed': elapsed,
+        'rate': len(results) / elapsed,
+        'p50': percentile(durations, 50),
+        'p99': percentile(durations, 99),
+        'failures': sum(1 for _, matches in results if matches is False),
+        'unchanged': sites.stats['unchanged'],
+    }
+
+
+def run(count: int = 1000,
+        passes: int = 2,
+        jobs: int = 16,
+        engine: str = 'threads',
+        timeout: Optional[int] = 30,
+        page_size: int = 16 * 1024,
+        latency: float = 0,
+        error_rate: float = 0,
+        not_modified: float = 0,
+        seed: Optional[int] = None) -> Dict:
+    """Run load test against a stand-in server.
+
+    The server runs in a separate process, so it doesn’t compete with the
+    checks for the interpreter.  Each pass loads the sites, checks them all
+    and saves the results, so later passes make conditional requests.
+
+    Args:
+        count: Number of sites
+        passes: Number of times to check all sites
+        jobs: Number of sites to check concurrently
+        engine: Method used to fetch pages
+        timeout: Network timeout in seconds
+        page_size: Approximate size of generated pages in bytes
+        latency: Mean server delay in seconds
+        error_rate: Fraction of page requests that fail
+        not_modified: Fraction of conditional requests answered with 304
+        seed: Random number generator seed for server
+
+    Returns:
+        Results document, suitable for storing as |JSON|
+    """
+    import multiprocessing
+    import tempfile
+    import urllib.request
+
+    parent, child = multiprocessing.Pipe()
+    server = multiprocessing.Process(target=serve,
+                                     args=(child, ),
+                                     kwargs={
+                                         'page_size': page_size,
+                                         'latency': latency,
+                                         'error_rate': error_rate,
+                                         'not_modified': not_modified,
+                                         'seed': seed,
+                                     },
+                                     daemon=True)
+    server.start()
+    try:
+        base = parent.recv()
+        results = []
+        with tempfile.TemporaryDirectory() as directory:
+            config = os.path.join(directory, 'sites.conf')
+            with open(config, 'w') as f:
+                f.write(sites_config(count, base))
+            for _ in range(passes):
+                with urllib.request.urlopen(f'{base}/_stats') as response:
+                    before = Counter(json.load(response))
+                result = check_pass(config,
+                                    os.path.join(directory, 'sites.db'),
+                                    os.path.join(directory, 'cache'), jobs,
+                                    engine, timeout)
+                with urllib.request.urlopen(f'{base}/_stats') as response:
+                    result['server'] = dict(
+                        Counter(json.load(response)) - before)
+                results.append(result)
+    finally:
+        parent.send(None)
+        server.join()
+    return {
+        'version': _version.dotted,
+        'date': utils.utcnow().isoformat(),
+        'options': {
+            'count': count,
+            'jobs': jobs,
+            'engine': engine,
+            'page_size': page_size,
+            'latency': latency,
+            'error_rate': error_rate,
+            'not_modified': not_modified,
+        },
+        'passes': results,
+        'peak_rss': peak_rss(),
+    }
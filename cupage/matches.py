@@ -0,0 +1,157 @@
+#
+"""matches - Compact storage for site matches."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import sys
+from collections.abc import Sequence
+from typing import Any, Iterable, Iterator, List, Union
+
+#: Separator between stored matches, which can’t appear in page text
+SEPARATOR = '\0'
+
+
+class Matches(Sequence):
+    """Immutable sequence of matches for a site.
+
+    Matches for a site tend to share a long prefix and suffix, such as
+    ``foo-`` and ``.tar.gz``.  These are stored once, and are interned so
+    that common suffixes are shared between sites.  The remaining parts are
+    joined in to a single string, which is far smaller than a list of
+    separate strings.
+
+    Indexing has to scan the stored string, so iterate where possible.
+    """
+    __slots__ = ('_prefix', '_suffix', '_data', '_count')
+
+    def __init__(self, matches: Iterable[str] = ()) -> None:
+        """Initialise a new ``Matches`` object.
+
+        Args:
+            matches: Matches to store, in order
+        """
+        if isinstance(matches, Matches):
+            self._prefix = matches._prefix
+            self._suffix = matches._suffix
+            self._data = matches._data
+            self._count = matches._count
+            return
+        matches = list(matches)
+        self._count = len(matches)
+        if any(SEPARATOR in match for match in matches):
+            self._prefix = self._suffix = ''
+            self._data = tuple(matches)
+            return
+        prefix = os.path.commonprefix(matches) if len(matches) > 1 else ''
+        cores = [match[len(prefix):] for match in matches]
+        suffix = os.path.commonprefix([core[::-1] for core in cores])[::-1] \
+            if len(cores) > 1 else ''
+        if suffix:
+            cores = [core[:-len(suffix)] for core in cores]
+        self._prefix = sys.intern(prefix)
+        self._suffix = sys.intern(suffix)
+        self._data = ''.join(f'{SEPARATOR}{core}' for core in cores) \
+            + SEPARATOR if cores else ''
+
+    def __repr__(self) -> str:
+        """String representation for use in REPL."""
+        return f'{self.__class__.__name__}({list(self)!r})'
+
+    def __len__(self) -> int:
+        """Number of stored matches."""
+        return self._count
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterate over matches, in order."""
+        if isinstance(self._data, tuple):
+            yield from self._data
+        elif self._count:
+            prefix, suffix = self._prefix, self._suffix
+            for core in self._data[1:-1].split(SEPARATOR):
+                yield f'{prefix}{core}{suffix}'
+
+    def __getitem__(self, index: Union[int, slice]) -> Union[str, List[str]]:
+        """Fetch match by position.
+
+        Args:
+            index: Position, or slice, of matches to return
+        """
+        return list(self)[index]
+
+    def __contains__(self, match: Any) -> bool:
+        """Check whether a match is stored.
+
+        Args:
+            match: Match to search for
+        """
+        if isinstance(self._data, tuple):
+            return match in self._data
+        if not isinstance(match, str) or not self._count:
+            return False
+        prefix, suffix = self._prefix, self._suffix
+        if len(match) < len(prefix) + len(suffix) \
+                or not match.startswith(prefix) \
+                or not match.endswith(suffix):
+            return False
+        core = match[len(prefix):len(match) - len(suffix)]
+        return f'{SEPARATOR}{core}{SEPARATOR}' in self._data
+
+    def difference(self, matches: Iterable[str]) -> List[str]:
+        """Find matches that aren’t stored.
+
+        The stored matches are hashed once, so this takes linear time
+        instead of searching the stored string for each match.
+
+        Args:
+            matches: Matches to check, in order
+
+        Returns:
+            Unknown matches, in their original order
+        """
+        if isinstance(self._data, tuple):
+            known = set(self._data)
+            return [match for match in matches if match not in known]
+        if not self._count:
+            return list(matches)
+        prefix, suffix = self._prefix, self._suffix
+        start, end = len(prefix), len(suffix)
+        known = set(self._data[1:-1].split(SEPARATOR))
+        return [
+            match for match in matches
+            if len(match) < start + end or not match.startswith(prefix)
+            or not match.endswith(suffix)
+            or match[start:len(match) - end] not in known
+        ]
+
+    def __eq__(self, other: Any) -> bool:
+        """Compare with other matches.
+
+        Args:
+            other: ``Matches``, or a list or tuple of strings
+        """
+        if isinstance(other, Matches):
+            return (self._count, self._prefix, self._suffix, self._data) \
+                == (other._count, other._prefix, other._suffix, other._data)
+        if isinstance(other, (list, tuple)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __hash__(self) -> int:
+        """Hash stored matches."""
+        return hash((self._count, self._prefix, self._suffix, self._data))
@@ -0,0 +1,296 @@
+#
+"""metrics - Site check timing and transfer metrics for cupage."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime
+import json
+import os
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager, nullcontext
+from contextvars import ContextVar
+from typing import Any, ContextManager, Dict, Iterator, List, Optional
+
+from . import _version
+
+#: Phases recorded for site checks
+PHASES = ('dns', 'robots', 'fetch', 'parse', 'match')
+
+#: Metrics for the site check running in the current context
+_current = ContextVar('cupage_metrics', default=None)
+
+_NULL = nullcontext()
+
+
+class SiteMetrics:
+    """Metrics for a single site check.
+
+    Phase timings are exclusive, so time spent in a nested phase is only
+    counted once.  For example, name lookups made while fetching
+    :file:`robots.txt` count towards ``dns`` and not ``robots``.
+    """
+    def __init__(self, name: str) -> None:
+        """Initialise a new ``SiteMetrics`` object.
+
+        Args:
+            name: Site name
+        """
+        self.name = name
+        #: Time spent in each phase, in seconds
+        self.phases = Counter()
+        #: Total time for check, in seconds
+        self.duration = 0.0
+        #: Other values recorded with :func:`note`
+        self.values = {}
+        self._stack = []
+
+    def __repr__(self) -> str:
+        """String representation for use in REPL."""
+        return f'{self.__class__.__name__}({self.name!r})'
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        """Time a phase of the check.
+
+        Args:
+            name: Phase name, from :data:`PHASES`
+        """
+        frame = [time.perf_counter(), 0.0]
+        self._stack.append(frame)
+        try:
+            yield
+        finally:
+            self._stack.pop()
+            elapsed = time.perf_counter() - frame[0]
+            self.phases[name] += elapsed - frame[1]
+            if self._stack:
+                self._stack[-1][1] += elapsed
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Convert to a dictionary for storage."""
+        return dict(self.values, duration=self.duration,
+                    phases=dict(self.phases))
+
+
+def phase(name: str) -> ContextManager:
+    """Time a phase of the current site check.
+
+    This is a no-op outside of :meth:`Recorder.site`.
+
+    Args:
+        name: Phase name, from :data:`PHASES`
+    """
+    metrics = _current.get()
+    if metrics is None:
+        return _NULL
+    return metrics.phase(name)
+
+
+def recording() -> bool:
+    """Check whether metrics are being recorded for the current context."""
+    return _current.get() is not None
+
+
+def note(**values) -> None:
+    """Record values for the current site check.
+
+    This is a no-op outside of :meth:`Recorder.site`.
+
+    Args:
+        values: Values to record, such as ``status`` or ``bytes``
+    """
+    metrics = _current.get()
+    if metrics is not None:
+        metrics.values.update(values)
+
+
+class Recorder:
+    """Collect metrics for a run of site checks."""
+    def __init__(self) -> None:
+        """Initialise a new ``Recorder`` object."""
+        #: Metrics for each checked site
+        self.sites = {}
+        self._lock = threading.Lock()
+        self._started = datetime.datetime.now(datetime.timezone.utc)
+
+    def __repr__(self) -> str:
+        """String representation for use in REPL."""
+        return f'{self.__class__.__name__}()'
+
+    @contextmanager
+    def site(self, name: str) -> Iterator[SiteMetrics]:
+        """Record metrics for a site check.
+
+        Metrics are attached to the current context, so checks running in
+        other threads or :mod:`asyncio` tasks are recorded separately.
+
+        Args:
+            name: Site name
+        """
+        metrics = SiteMetrics(name)
+        token = _current.set(metrics)
+        start = time.perf_counter()
+        try:
+            yield metrics
+        finally:
+            metrics.duration = time.perf_counter() - start
+            _current.reset(token)
+            with self._lock:
+                self.sites[name] = metrics
+
+    def summary(self) -> Dict[str, Any]:
+        """Aggregate metrics for run.
+
+        Returns:
+            Total time per phase, bytes transferred, and counts of HTTP
+            statuses and cache results
+        """
+        phases = Counter()
+        statuses = Counter()
+        caches = Counter()
+        transferred = 0
+        for metrics in self.sites.values():
+            phases.update(metrics.phases)
+            if 'status' in metrics.values:
+                statuses[str(metrics.values['status'])] += 1
+            if 'cache' in metrics.values:
+                caches[metrics.values['cache']] += 1
+            transferred += metrics.values.get('bytes', 0)
+        return {
+            'sites': len(self.sites),
+            'duration': sum(m.duration for m in self.sites.values()),
+            'phases': dict(phases),
+            'bytes': transferred,
+            'status': dict(statuses),
+            'cache': dict(caches),
+        }
+
+    def as_dict(self) -> Dict[str, Any]:
+        """Convert to a dictionary for storage."""
+        return {
+            'version': _version.dotted,
+            'date': self._started.isoformat(),
+            'summary': self.summary(),
+            'sites': {
+                name: metrics.as_dict()
+                for name, metrics in sorted(self.sites.items())
+            },
+        }
+
+    def prometheus(self) -> str:
+        """Format metrics for the node_exporter textfile collector.
+
+        Returns:
+            Metrics in the Prometheus text exposition format
+        """
+        def escape(value: str) -> str:
+            return value.replace('\\', r'\\').replace('"', r'\"') \
+                .replace('\n', r'\n')
+
+        def family(name: str, kind: str, text: str,
+                   samples: List[str]) -> List[str]:
+            return [f'# HELP {name} {text}', f'# TYPE {name} {kind}'] \
+                + samples
+
+        summary = self.summary()
+        sites = sorted(self.sites.items())
+        lines = []
+        lines += family('cupage_last_run_timestamp_seconds', 'gauge',
+                        'Start time of the last cupage run.',
+                        [f'cupage_last_run_timestamp_seconds '
+                         f'{self._started.timestamp()}'])
+        lines += family('cupage_phase_seconds', 'gauge',
+                        'Time spent in each check phase during the run.', [
+                            f'cupage_phase_seconds{{phase="{name}"}} {value}'
+                            for name, value in sorted(
+                                summary['phases'].items())
+                        ])
+        lines += family('cupage_responses', 'gauge',
+                        'Site responses by cache result during the run.', [
+                            f'cupage_responses{{cache="{name}"}} {value}'
+                            for name, value in sorted(
+                                summary['cache'].items())
+                        ])
+        lines += family('cupage_site_check_seconds', 'gauge',
+                        'Time taken by the last check of a site.', [
+                            f'cupage_site_check_seconds{{site="'
+                            f'{escape(name)}"}} {metrics.duration}'
+                            for name, metrics in sites
+                        ])
+        lines += family('cupage_site_phase_seconds', 'gauge',
+                        'Time spent in each phase of the last site check.', [
+                            f'cupage_site_phase_seconds{{site="{escape(name)}"'
+                            f',phase="{phase_name}"}} {value}'
+                            for name, metrics in sites
+                            for phase_name, value in sorted(
+                                metrics.phases.items())
+                        ])
+        lines += family('cupage_site_bytes', 'gauge',
+                        'Size of the last response body for a site.', [
+                            f'cupage_site_bytes{{site="{escape(name)}"}} '
+                            f'{metrics.values["bytes"]}'
+                            for name, metrics in sites
+                            if 'bytes' in metrics.values
+                        ])
+        lines += family('cupage_site_http_status', 'gauge',
+                        'HTTP status of the last response for a site.', [
+                            f'cupage_site_http_status{{site="{escape(name)}"}}'
+                            f' {metrics.values["status"]}'
+                            for name, metrics in sites
+                            if 'status' in metrics.values
+                        ])
+        return '\n'.join(lines) + '\n'
+
+    def write(self, path: str) -> None:
+        """Write metrics file.
+
+        Files with a ``.prom`` extension are written in the Prometheus text
+        format, and other files as |JSON|.  The file is replaced atomically,
+        as required by the node_exporter textfile collector.
+
+        Args:
+            path: Location to write metrics to
+        """
+        import tempfile
+
+        directory = os.path.dirname(os.path.abspath(path))
+        with tempfile.NamedTemporaryFile('w',
+                                         prefix='.',
+                                         dir=directory,
+                                         delete=False) as temp:
+            if path.endswith('.prom'):
+                temp.write(self.prometheus())
+            else:
+                json.dump(self.as_dict(), temp, indent=4)
+                temp.write('\n')
+        # Temporary files are private, but collectors run as other users
+        os.chmod(temp.name, 0o644)
+        os.rename(temp.name, path)
+
+
+def site_context(recorder: Optional[Recorder],
+                 name: str) -> ContextManager:
+    """Record metrics for a site check, if a ``recorder`` is given.
+
+    Args:
+        recorder: Recorder to use, or ``None`` to disable recording
+        name: Site name
+    """
+    return recorder.site(name) if recorder else _NULL
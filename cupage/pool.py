@@ -0,0 +1,143 @@
+#
+"""pool - Shared HTTP connection handling for cupage."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import socket
+import threading
+import urllib.parse as urlparse
+from collections import Counter, defaultdict
+from typing import TYPE_CHECKING, Optional, Tuple, Union
+
+from . import metrics, utils
+from .cache import FileCache
+from .scheduler import HostGate, HostLimits, host_key
+
+if TYPE_CHECKING:  # pragma: no cover
+    import httplib2
+
+
+class ConnectionPool:
+    """Pool of keep-alive HTTP connections shared across site checks.
+
+    :class:`httplib2.Http` objects keep their connections open between
+    requests, so checking many sites on the same host only pays for a single
+    connection setup.  Each ``Http`` object is only ever used by one thread
+    at a time, and requests are throttled according to the ``limits``, which
+    also caps the number of connections to a host.
+    """
+    def __init__(self,
+                 cache: Optional[Union[str, FileCache]] = None,
+                 timeout: Optional[int] = None,
+                 no_write: bool = False,
+                 limits: Optional[HostLimits] = None) -> None:
+        """Initialise a new ``ConnectionPool`` object.
+
+        Args:
+            cache: Page cache location or object, see
+                :class:`~cupage.cache.FileCache`
+            timeout: Timeout value for :class:`httplib2.Http`
+            no_write: Do not write to cache, useful for testing
+            limits: Per-host request limits
+        """
+        self.cache = cache
+        self.timeout = timeout
+        self.no_write = no_write
+        #: Per-host request throttling
+        self.gate = HostGate(limits)
+        #: Counts of ``requests`` made and ``reused`` connections
+        self.stats = Counter()
+
+        if isinstance(cache, str):
+            cache = FileCache(cache, no_write)
+        self._cache = cache
+
+        self._lock = threading.Lock()
+        self._idle = defaultdict(list)
+
+    def request(self, uri: str, method: str = 'GET',
+                **kwargs) -> Tuple['httplib2.Response', bytes]:
+        """Perform request using a pooled connection.
+
+        This accepts the same arguments as :meth:`httplib2.Http.request`, and
+        blocks until :attr:`gate` allows a request to the host.
+
+        Args:
+            uri: Location to fetch
+            method: HTTP method to use
+            kwargs: Extra arguments for :meth:`httplib2.Http.request`
+        """
+        import httplib2
+
+        scheme, authority = httplib2.urlnorm(uri)[:2]
+        key = f'{scheme}:{authority}'
+        with self.gate.acquire(host_key(uri)):
+            with self._lock:
+                if self._idle[key]:
+                    http = self._idle[key].pop()
+                else:
+                    http = httplib2.Http(cache=self._cache,
+                                         timeout=self.timeout,
+                                         ca_certs=utils.ca_certs())
+            conn = http.connections.get(key)
+            reused = conn is not None and conn.sock is not None
+            if not reused and metrics.recording():
+                self._resolve(uri)
+            try:
+                return http.request(uri, method, **kwargs)
+            finally:
+                with self._lock:
+                    self.stats['requests'] += 1
+                    if reused:
+                        self.stats['reused'] += 1
+                    self._idle[key].append(http)
+
+    @staticmethod
+    def _resolve(uri: str) -> None:
+        """Time name lookup for a new connection.
+
+        This is only used while metrics are recorded, as :mod:`httplib2`
+        resolves the name again when it connects.
+
+        Args:
+            uri: Location to be fetched
+        """
+        parts = urlparse.urlsplit(uri)
+        with metrics.phase('dns'):
+            try:
+                socket.getaddrinfo(parts.hostname, parts.port or
+                                   (443 if parts.scheme == 'https' else 80),
+                                   proto=socket.IPPROTO_TCP)
+            except (socket.gaierror, UnicodeError):
+                # Failures are reported by the request itself
+                pass
+
+    def close(self) -> None:
+        """Close all pooled connections."""
+        with self._lock:
+            for pool in self._idle.values():
+                for http in pool:
+                    http.close()
+            self._idle.clear()
+
+    @property
+    def reuse_ratio(self) -> float:
+        """Fraction of requests that were made over reused connections."""
+        if not self.stats['requests']:
+            return 0.0
+        return self.stats['reused'] / self.stats['requests']
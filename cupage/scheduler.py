@@ -0,0 +1,178 @@
+#
+"""scheduler - Per-host request scheduling for cupage."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+import time
+import urllib.parse as urlparse
+from contextlib import AsyncExitStack, asynccontextmanager, contextmanager
+from typing import (TYPE_CHECKING, AsyncIterator, Dict, Iterator, Optional,
+                    Tuple)
+
+if TYPE_CHECKING:  # pragma: no cover
+    import asyncio
+
+#: Prefix for host option sections in config files
+HOST_SECTION = 'host:'
+
+
+def host_key(url: str) -> str:
+    """Find the host a URL will be fetched from.
+
+    Args:
+        url: URL to check
+
+    Returns:
+        Lower cased host name, including port if given
+    """
+    return urlparse.urlparse(url).netloc.lower()
+
+
+class HostLimits:
+    """Per-host request limits."""
+    def __init__(self,
+                 concurrency: int = 4,
+                 delay: float = 0,
+                 overrides: Optional[Dict[str, Dict[str, str]]] = None
+                 ) -> None:
+        """Initialise a new ``HostLimits`` object.
+
+        Args:
+            concurrency: Maximum number of concurrent requests to a host
+            delay: Minimum time between starting requests to a host, in
+                seconds
+            overrides: Per-host ``concurrency`` and ``delay`` settings
+        """
+        if concurrency < 1 or delay < 0:
+            raise ValueError(f'Invalid host limits {concurrency}, {delay}')
+        self.concurrency = concurrency
+        self.delay = delay
+        self.overrides = {}
+        for host, options in (overrides or {}).items():
+            try:
+                limits = (
+                    int(options.get('concurrency', concurrency)),
+                    float(options.get('delay', delay)),
+                )
+            except ValueError:
+                raise ValueError(f'Invalid limits for host {host}')
+            if limits[0] < 1 or limits[1] < 0:
+                raise ValueError(f'Invalid limits for host {host}')
+            self.overrides[host.lower()] = limits
+
+    def __repr__(self) -> str:
+        """String representation for use in REPL."""
+        return (f'{self.__class__.__name__}({self.concurrency!r}, '
+                f'{self.delay!r}, ...)')
+
+    def for_host(self, host: str) -> Tuple[int, float]:
+        """Fetch limits for host.
+
+        Args:
+            host: Host name, as returned by :func:`host_key`
+
+        Returns:
+            Maximum concurrent requests, and minimum delay between requests
+        """
+        return self.overrides.get(host, (self.concurrency, self.delay))
+
+
+class HostGate:
+    """Enforce :class:`HostLimits` on requests from multiple threads."""
+    def __init__(self, limits: Optional[HostLimits] = None) -> None:
+        """Initialise a new ``HostGate`` object.
+
+        Args:
+            limits: Limits to apply
+        """
+        self.limits = limits if limits else HostLimits()
+        self._lock = threading.Lock()
+        self._slots = {}
+        self._next_start = {}
+
+    @contextmanager
+    def acquire(self, host: str) -> Iterator[None]:
+        """Wait until a request to ``host`` is allowed.
+
+        Args:
+            host: Host name, as returned by :func:`host_key`
+        """
+        concurrency, delay = self.limits.for_host(host)
+        with self._lock:
+            if host not in self._slots:
+                self._slots[host] = threading.BoundedSemaphore(concurrency)
+            slots = self._slots[host]
+        with slots:
+            with self._lock:
+                now = time.monotonic()
+                start = max(now, self._next_start.get(host, now))
+                self._next_start[host] = start + delay
+            if start > now:
+                time.sleep(start - now)
+            yield
+
+    def wait_time(self, host: str) -> float:
+        """Time until a new request to ``host`` could start without waiting.
+
+        Args:
+            host: Host name, as returned by :func:`host_key`
+        """
+        with self._lock:
+            return max(0, self._next_start.get(host, 0) - time.monotonic())
+
+
+class AsyncHostGate:
+    """Enforce :class:`HostLimits` on :mod:`asyncio` tasks."""
+    def __init__(self, limits: Optional[HostLimits] = None) -> None:
+        """Initialise a new ``AsyncHostGate`` object.
+
+        Args:
+            limits: Limits to apply
+        """
+        self.limits = limits if limits else HostLimits()
+        self._slots = {}
+        self._next_start = {}
+
+    @asynccontextmanager
+    async def acquire(self, host: str,
+                      slots: Optional['asyncio.Semaphore'] = None
+                      ) -> AsyncIterator[None]:
+        """Wait until access to ``host`` is allowed.
+
+        Other tasks continue to run while this one is throttled.
+
+        Args:
+            host: Host name, as returned by :func:`host_key`
+            slots: Limit shared with other hosts, which is acquired before
+                spacing requests so waiting for it doesn’t shorten the delay
+        """
+        import asyncio
+
+        concurrency, delay = self.limits.for_host(host)
+        if host not in self._slots:
+            self._slots[host] = asyncio.Semaphore(concurrency)
+        async with self._slots[host], AsyncExitStack() as stack:
+            if slots:
+                await stack.enter_async_context(slots)
+            now = time.monotonic()
+            start = max(now, self._next_start.get(host, now))
+            self._next_start[host] = start + delay
+            if start > now:
+                await asyncio.sleep(start - now)
+            yield
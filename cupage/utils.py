@@ -18,64 +18,427 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import datetime
+import html
 import os
 import re
 import socket
 import sys
-from contextlib import contextmanager
-from typing import ContextManager, Optional, List
-from urllib import robotparser
+import threading
+import weakref
+from contextlib import contextmanager, nullcontext, suppress
+from functools import lru_cache
+from typing import (TYPE_CHECKING, Callable, ContextManager, Dict, Iterator,
+                    List, Optional, Tuple, Union)
 import urllib.parse as urlparse
 
-import httplib2
 from jnrbase import colourise
 
-try:
-    # httplib2 0.8 and above support setting certs via ca_certs_locater module,
-    # making this dirty mess even dirtier
-    if [int(i) for i in httplib2.__version__.split('.')] < [0, 8]:
-        raise ImportError('no ca_certs_locater support')
-    import ca_certs_locater
-except (AssertionError, ImportError):
-    _HTTPLIB2_BUNDLE = os.path.realpath(os.path.dirname(httplib2.CA_CERTS))
-    SYSTEM_CERTS = \
-        not _HTTPLIB2_BUNDLE.startswith(os.path.dirname(httplib2.__file__))
-    CA_CERTS = None
-    if not SYSTEM_CERTS and sys.platform.startswith('linux'):
-        for cert_file in [
-                '/etc/ssl/certs/ca-certificates.crt',
-                '/etc/pki/tls/certs/ca-bundle.crt'
-        ]:
-            if os.path.exists(cert_file):
-                CA_CERTS = cert_file
-                SYSTEM_CERTS = True
-                break
-    elif not SYSTEM_CERTS and sys.platform.startswith('freebsd'):
-        if os.path.exists('/usr/local/share/certs/ca-root-nss.crt'):
-            CA_CERTS = '/usr/local/share/certs/ca-root-nss.crt'
-            SYSTEM_CERTS = True
-    elif os.path.exists(os.getenv('CURL_CA_BUNDLE', '')):
-        CA_CERTS = os.getenv('CURL_CA_BUNDLE')
-else:
-    CA_CERTS = ca_certs_locater.get()
-
-
-def sort_packages(packages: List[str]):
+from . import metrics
+
+if TYPE_CHECKING:  # pragma: no cover
+    import asyncio
+    from urllib import robotparser
+
+    import aiohttp
+    import httplib2
+    from lxml import etree
+
+
+def __getattr__(name: str):
+    """Provide lazily computed module attributes.
+
+    :data:`CA_CERTS` is still available for compatibility, but calls
+    :func:`ca_certs` on access.
+    """
+    if name == 'CA_CERTS':
+        return ca_certs()
+    raise AttributeError(f'module {__name__!r} has no attribute {name!r}')
+
+
+@lru_cache(maxsize=None)
+def ca_certs() -> Optional[str]:
+    """Find the CA certificate bundle to use for requests.
+
+    This is only probed on first use, as it requires :mod:`httplib2`.
+
+    Returns:
+        Location of certificate bundle, or ``None`` to use the default
+    """
+    import httplib2
+
+    try:
+        # httplib2 0.8 and above support setting certs via ca_certs_locater
+        # module, making this dirty mess even dirtier
+        if [int(i) for i in httplib2.__version__.split('.')] < [0, 8]:
+            raise ImportError('no ca_certs_locater support')
+        import ca_certs_locater
+    except (AssertionError, ImportError):
+        bundle = os.path.realpath(os.path.dirname(httplib2.CA_CERTS))
+        system_certs = \
+            not bundle.startswith(os.path.dirname(httplib2.__file__))
+        if not system_certs and sys.platform.startswith('linux'):
+            for cert_file in [
+                    '/etc/ssl/certs/ca-certificates.crt',
+                    '/etc/pki/tls/certs/ca-bundle.crt'
+            ]:
+                if os.path.exists(cert_file):
+                    return cert_file
+        elif not system_certs and sys.platform.startswith('freebsd'):
+            if os.path.exists('/usr/local/share/certs/ca-root-nss.crt'):
+                return '/usr/local/share/certs/ca-root-nss.crt'
+        elif os.path.exists(os.getenv('CURL_CA_BUNDLE', '')):
+            return os.getenv('CURL_CA_BUNDLE')
+        return None
+    return ca_certs_locater.get()
+
+
+def utcnow() -> datetime.datetime:
+    """Return the current time as a timezone aware UTC datetime."""
+    return datetime.datetime.now(datetime.timezone.utc)
+
+
+def parse_datetime(value: Union[None, str, datetime.datetime]
+                   ) -> Optional[datetime.datetime]:
+    """Parse stored timestamp.
+
+    Naïve timestamps, as written by older versions, are assumed to be UTC.
+
+    Args:
+        value: |ISO|-8601 formatted timestamp
+
+    Returns:
+        Timezone aware datetime, or ``None`` when ``value`` is empty
+    """
+    if not value:
+        return None
+    if isinstance(value, str):
+        if value.endswith('Z'):
+            value = value[:-1] + '+00:00'
+        value = datetime.datetime.fromisoformat(value)
+    if not value.tzinfo:
+        value = value.replace(tzinfo=datetime.timezone.utc)
+    return value
+
+
+#: Version number components, and optional pre-release suffix
+VERSION_RE = re.compile(
+    r"""(?P<release>\d+(?:\.\d+)*)
+        (?:[-_.]?(?P<pre>dev|alpha|beta|pre|rc|a|b|c)(?![a-z])[-_.]?
+           (?P<pre_num>\d*))?""", re.IGNORECASE | re.VERBOSE)
+
+#: Ordering of pre-release suffixes, final releases sort after all of them
+PRE_RELEASE_ORDER = {
+    'dev': 0,
+    'a': 1,
+    'alpha': 1,
+    'b': 2,
+    'beta': 2,
+    'c': 3,
+    'pre': 3,
+    'rc': 3,
+}
+FINAL_RELEASE = max(PRE_RELEASE_ORDER.values()) + 1
+
+
+@lru_cache(maxsize=65536)
+def version_key(package: str) -> Tuple:
+    """Generate sort key for a package’s version.
+
+    The version is the first group of dot-separated numbers that isn’t part of
+    a word, so the ``3`` in ``python3-foo-1.0.tar.gz`` is skipped.
+    Pre-release suffixes, such as those matched by
+    :meth:`~cupage.Site.package_re`, sort before the final release.  Any later
+    numbers, such as Debian revisions, are used to break ties.
+
+    Keys are cached, as the same match lists are sorted repeatedly.
+
+    Args:
+        package: Package name to process
+    """
+    found = None
+    for match in VERSION_RE.finditer(package):
+        start = match.start()
+        if start == 0 or not package[start - 1].isalnum() \
+                or (package[start - 1] in 'vV'
+                    and (start == 1 or not package[start - 2].isalpha())):
+            found = match
+            break
+    if not found:
+        return ((), FINAL_RELEASE, 0, (), package)
+    release = tuple(int(i) for i in found.group('release').split('.'))
+    if found.group('pre'):
+        pre = PRE_RELEASE_ORDER[found.group('pre').lower()]
+        pre_num = int(found.group('pre_num') or 0)
+    else:
+        pre = FINAL_RELEASE
+        pre_num = 0
+    rest = tuple(int(i) for i in re.findall(r'\d+', package[found.end():]))
+    return (release, pre, pre_num, rest, package)
+
+
+def sort_packages(packages: List[str]) -> List[str]:
     """Order package list according to version number.
 
+    See :func:`version_key` for details of the ordering.
+
     Args:
         packages: Packages to sort
     """
-    # Very ugly key function, but it handles the common case of varying
-    # component length just about “Good Enough™”
-    return sorted(packages,
-                  key=lambda s: [i for i in s if i.isdigit() or i == '.'])
+    return sorted(packages, key=version_key)
+
+
+def adaptive_frequency(releases: List[datetime.datetime],
+                       now: datetime.datetime,
+                       minimum: datetime.timedelta,
+                       maximum: datetime.timedelta,
+                       divisor: int = 4) -> Optional[datetime.timedelta]:
+    """Calculate check frequency from a site’s release history.
+
+    The expected gap between releases is the median of the observed gaps, or
+    the time since the latest release if that is longer, so sites that have
+    gone quiet are checked less often.  Checking ``divisor`` times per
+    expected gap keeps the delay in noticing a release to a fraction of the
+    release cadence.
+
+    Args:
+        releases: Times at which new matches were found, oldest first
+        now: Current time
+        minimum: Lower bound for frequency
+        maximum: Upper bound for frequency
+        divisor: Number of checks per expected release gap
+
+    Returns:
+        Check frequency, or ``None`` if there is no release history
+    """
+    if not releases:
+        return None
+    gaps = sorted(b - a for a, b in zip(releases, releases[1:]))
+    expected = now - releases[-1]
+    if gaps:
+        expected = max(expected, gaps[len(gaps) // 2])
+    return min(max(expected / divisor, minimum), maximum)
+
 
+def robots_url(url: str) -> Optional[str]:
+    """Find location of ``robots.txt`` for a URL.
 
-def robots_test(http: httplib2.Http,
+    Args:
+        url: URL to check
+
+    Returns:
+        Location of :file:`robots.txt`, or ``None`` for non-HTTP URLs
+    """
+    parsed = urlparse.urlparse(url, 'http')
+    if parsed.scheme.startswith('http'):
+        return f'{parsed.scheme}://{parsed.netloc}/robots.txt'
+    return None
+
+
+class RobotsCache:
+    """Cache of parsed ``robots.txt`` data, keyed by host.
+
+    Entries expire according to the ``Cache-Control`` or ``Expires`` headers
+    of the :file:`robots.txt` response, falling back to :attr:`ttl` when
+    neither is given.
+    """
+    def __init__(self,
+                 ttl: datetime.timedelta = datetime.timedelta(days=1),
+                 file: Optional[str] = None) -> None:
+        """Initialise a new ``RobotsCache`` object.
+
+        Args:
+            ttl: Default lifetime of cache entries
+            file: Location to persist cache to
+        """
+        self.ttl = ttl
+        self.file = file
+        self._lock = threading.Lock()
+        self._fetch_locks = {}
+        self._async_fetch_locks = weakref.WeakKeyDictionary()
+        self._entries = {}
+        self._parsers = {}
+        if file and os.path.exists(file):
+            from jnrbase import json_datetime
+            with open(file) as f:
+                self._entries = json_datetime.load(f)
+
+    def fetch_lock(self, location: str) -> threading.Lock:
+        """Lock to hold while fetching :file:`robots.txt`.
+
+        This allows threads to wait on a single request for a host, instead
+        of all fetching the same file.
+
+        Args:
+            location: Location of :file:`robots.txt`
+        """
+        with self._lock:
+            return self._fetch_locks.setdefault(location, threading.Lock())
+
+    def async_fetch_lock(self, location: str) -> 'asyncio.Lock':
+        """Lock to hold while fetching :file:`robots.txt` from a coroutine.
+
+        This is the :mod:`asyncio` equivalent of :meth:`fetch_lock`.  Locks
+        are kept for each event loop, as they can’t be shared between them.
+
+        Args:
+            location: Location of :file:`robots.txt`
+        """
+        import asyncio
+
+        loop = asyncio.get_running_loop()
+        with self._lock:
+            locks = self._async_fetch_locks.setdefault(loop, {})
+            return locks.setdefault(location, asyncio.Lock())
+
+    def get(self, location: str
+            ) -> Tuple[bool, Optional['robotparser.RobotFileParser']]:
+        """Fetch parsed :file:`robots.txt` from cache.
+
+        Args:
+            location: Location of :file:`robots.txt`
+
+        Returns:
+            Whether a valid entry was found, and parsed data if the host has
+            a usable :file:`robots.txt`
+        """
+        with self._lock:
+            entry = self._entries.get(location)
+            if not entry or not isinstance(entry['expires'],
+                                           datetime.datetime) \
+                    or entry['expires'] < utcnow():
+                return False, None
+            # json_datetime decodes null values as empty timedelta objects
+            if not entry['lines']:
+                return True, None
+            if location not in self._parsers:
+                from urllib import robotparser
+                robots = robotparser.RobotFileParser(location)
+                robots.parse(entry['lines'])
+                self._parsers[location] = robots
+            return True, self._parsers[location]
+
+    def set(self, location: str, headers: Dict[str, str],
+            lines: Optional[List[str]]) -> None:
+        """Store :file:`robots.txt` data in cache.
+
+        Args:
+            location: Location of :file:`robots.txt`
+            headers: Response headers for :file:`robots.txt` request
+            lines: Content of :file:`robots.txt`, or ``None`` if the host
+                doesn’t provide one
+        """
+        expires = cache_expiry(headers, self.ttl)
+        with self._lock:
+            self._entries[location] = {'expires': expires, 'lines': lines}
+            self._parsers.pop(location, None)
+
+    def save(self) -> None:
+        """Persist cache to :attr:`file`."""
+        if not self.file:
+            return
+        now = utcnow()
+        with self._lock:
+            data = {k: v for k, v in self._entries.items()
+                    if isinstance(v['expires'], datetime.datetime)
+                    and v['expires'] > now}
+        import tempfile
+
+        from jnrbase import json_datetime
+
+        directory, _ = os.path.split(self.file)
+        os.makedirs(directory, exist_ok=True)
+        with tempfile.NamedTemporaryFile('w',
+                                         prefix='.',
+                                         dir=directory,
+                                         delete=False) as temp:
+            json_datetime.dump(data, temp)
+        os.rename(temp.name, self.file)
+
+
+def cache_expiry(headers: Dict[str, str],
+                 default: datetime.timedelta) -> datetime.datetime:
+    """Calculate expiry time for a response from its headers.
+
+    Args:
+        headers: Response headers
+        default: Lifetime when headers don’t specify one
+
+    Returns:
+        Time at which response should be considered stale
+    """
+    now = utcnow()
+    match = re.search(r'max-age=(\d+)', headers.get('cache-control', ''))
+    if match:
+        return now + datetime.timedelta(seconds=int(match.group(1)))
+    if headers.get('expires'):
+        import email.utils
+        with suppress(TypeError, ValueError):
+            expires = email.utils.parsedate_to_datetime(headers['expires'])
+            if expires.tzinfo:
+                return expires
+    return now + default
+
+
+def robots_lines(status: int, headers: Dict[str, str],
+                 content: bytes) -> Optional[List[str]]:
+    """Extract ``robots.txt`` rules from a response.
+
+    Args:
+        status: HTTP status code for :file:`robots.txt` request
+        headers: Response headers for :file:`robots.txt` request
+        content: Content of :file:`robots.txt`
+
+    Returns:
+        Lines of :file:`robots.txt`, or ``None`` if there are no rules to
+        apply
+    """
+    # Ignore errors 4xx errors for robots.txt
+    if str(status).startswith('4'):
+        return None
+    charset = charset_from_headers(headers)
+    return content.decode(charset, 'replace').splitlines()
+
+
+def robots_allowed(url: str,
+                   name: str,
+                   robots: Optional['robotparser.RobotFileParser'],
+                   user_agent: str = '*') -> bool:
+    """Check parsed ``robots.txt`` data allows access to a URL.
+
+    Args:
+        url: URL to check
+        name: Site name being checked
+        robots: Parsed :file:`robots.txt`, if any
+        user_agent: User agent to check in :file:`robots.txt`
+    """
+    if robots and not robots.can_fetch(user_agent, url):
+        colourise.pfail(f'Can’t check {name}, blocked by robots.txt')
+        return False
+    return True
+
+
+def _robots_store(cache: Optional[RobotsCache], location: str, status: int,
+                  headers: Dict[str, str],
+                  content: bytes) -> Optional['robotparser.RobotFileParser']:
+    """Parse fetched ``robots.txt``, and add it to cache."""
+    from urllib import robotparser
+
+    lines = robots_lines(status, headers, content)
+    if cache and status < 500:
+        cache.set(location, headers, lines)
+    if lines is None:
+        return None
+    robots = robotparser.RobotFileParser(location)
+    robots.parse(lines)
+    return robots
+
+
+def robots_test(http: 'httplib2.Http',
                 url: str,
                 name: str,
-                user_agent: str = '*') -> bool:
+                user_agent: str = '*',
+                cache: Optional[RobotsCache] = None) -> bool:
     """Check whether a given URL is blocked by ``robots.txt``.
 
     Args:
@@ -83,26 +446,209 @@ def robots_test(http: httplib2.Http,
         url: URL to check
         name: Site name being checked
         user_agent: User agent to check in :file:`robots.txt`
+        cache: Cache of previously fetched :file:`robots.txt` data
     """
-    parsed = urlparse.urlparse(url, 'http')
-    if parsed.scheme.startswith('http'):
-        robots_url = '{[scheme]}://{[netloc]}/robots.txt'.format(
-            parsed._asdict())
-        robots = robotparser.RobotFileParser(robots_url)
-        try:
-            headers, content = http.request(robots_url)
-        except httplib2.ServerNotFoundError:
-            colourise.pfail(f'Domain name lookup failed for {name}')
-            return False
-        except socket.timeout:
-            colourise.pfail(f'Socket timed out on {name}')
-            return False
-        # Ignore errors 4xx errors for robots.txt
-        if not str(headers.status).startswith('4'):
-            robots.parse(content.splitlines())
-            if not robots.can_fetch(user_agent, url):
-                colourise.pfail(f'Can’t check {name}, blocked by robots.txt')
+    import httplib2
+
+    location = robots_url(url)
+    if not location:
+        return True
+    with cache.fetch_lock(location) if cache else nullcontext():
+        found, robots = cache.get(location) if cache else (False, None)
+        metrics.note(robots='cached' if found else 'fetched')
+        if not found:
+            try:
+                headers, content = http.request(location)
+            except httplib2.ServerNotFoundError:
+                colourise.pfail(f'Domain name lookup failed for {name}')
+                return False
+            except socket.timeout:
+                colourise.pfail(f'Socket timed out on {name}')
+                return False
+            robots = _robots_store(cache, location, headers.status, headers,
+                                   content)
+    return robots_allowed(url, name, robots, user_agent)
+
+
+async def robots_test_async(session: 'aiohttp.ClientSession',
+                            url: str,
+                            name: str,
+                            user_agent: str = '*',
+                            cache: Optional[RobotsCache] = None) -> bool:
+    """Check whether a given URL is blocked by ``robots.txt``.
+
+    This is the :mod:`asyncio` equivalent of :func:`robots_test`.
+
+    Args:
+        session: Session to use for requests
+        url: URL to check
+        name: Site name being checked
+        user_agent: User agent to check in :file:`robots.txt`
+        cache: Cache of previously fetched :file:`robots.txt` data
+    """
+    import asyncio
+
+    import aiohttp
+
+    location = robots_url(url)
+    if not location:
+        return True
+    # A private lock stands in for nullcontext, which can’t be used with
+    # async with before Python 3.10
+    lock = cache.async_fetch_lock(location) if cache else asyncio.Lock()
+    async with lock:
+        found, robots = cache.get(location) if cache else (False, None)
+        metrics.note(robots='cached' if found else 'fetched')
+        if not found:
+            try:
+                async with session.get(location) as resp:
+                    content = await resp.read()
+            except aiohttp.ClientConnectorError as error:
+                if isinstance(error.os_error, socket.gaierror):
+                    colourise.pfail(f'Domain name lookup failed for {name}')
+                else:
+                    colourise.pfail(f'Connection failed for {name} ({error})')
+                return False
+            except asyncio.TimeoutError:
+                colourise.pfail(f'Socket timed out on {name}')
                 return False
+            except aiohttp.ClientError as error:
+                colourise.pfail(f'Request failed for {name} ({error})')
+                return False
+            robots = _robots_store(cache, location, resp.status, resp.headers,
+                                   content)
+    return robots_allowed(url, name, robots, user_agent)
+
+
+#: Scanner for link targets in raw HTML, which also matches comments so they
+#: can be skipped
+HREF_RE = re.compile(
+    rb"""<!--.*?(?:-->|\Z)
+         |<a\s[^>]*?(?<![-\w])href\s*=\s*
+         (?:"([^"]*)"|'([^']*)'|([^\s"'>]+))""",
+    re.DOTALL | re.IGNORECASE | re.VERBOSE)
+
+
+def scan_hrefs(content: bytes, charset: str) -> Iterator[str]:
+    """Extract link targets from HTML without parsing it.
+
+    Args:
+        content: HTML to scan
+        charset: Character set for content
+
+    Returns:
+        ``href`` values of ``a`` elements outside of comments, in document
+        order
+    """
+    if isinstance(content, str):
+        content = content.encode(charset, 'replace')
+    for match in HREF_RE.finditer(content):
+        value = match.group(1)
+        if value is None:
+            value = match.group(2)
+            if value is None:
+                value = match.group(3)
+                if value is None:
+                    continue
+        value = value.decode(charset, 'replace')
+        yield html.unescape(value) if '&' in value else value
+
+
+@lru_cache(maxsize=None)
+def compile_selector(selector: str, select: str
+                     ) -> Callable[['etree._Element'], List['etree._Element']]:
+    """Compile a CSS or XPath selector.
+
+    Compiled selectors are cached for the life of the process, as many sites
+    share the same selectors.
+
+    Args:
+        selector: Selector type, ``css`` or ``xpath``
+        select: Selector expression
+
+    Returns:
+        Compiled selector, which returns matching elements when called with a
+        document or element
+    """
+    from cssselect import SelectorError
+    from lxml import etree
+    from lxml.cssselect import CSSSelector
+
+    try:
+        if selector == 'css':
+            return CSSSelector(select, translator='html')
+        elif selector == 'xpath':
+            return etree.XPath(select)
+    # cssselect raises SyntaxError subclasses for unparsable selectors, but
+    # RuntimeError subclasses for unsupported ones
+    except (SyntaxError, SelectorError, etree.XPathError) as error:
+        raise ValueError(f'Invalid {selector} selector {select!r} ({error})')
+    raise ValueError(f'Invalid selector type {selector!r}')
+
+
+def streamable(selector: str, select: str) -> bool:
+    """Check whether a selector can be evaluated by :func:`stream_select`.
+
+    Selectors that depend on an element’s siblings or position can’t be used,
+    as previously processed elements are discarded.
+
+    Args:
+        selector: Selector type, ``css`` or ``xpath``
+        select: Selector expression
+    """
+    if selector == 'css':
+        unsafe = r'[+~]|:(?:first|last|nth|only)-|:(?:empty|contains)'
+    else:
+        unsafe = r'\[\s*\d|position\(|last\(|count\(|preceding|following'
+    return not re.search(unsafe, select)
+
+
+def stream_select(content: bytes,
+                  selector: Callable[['etree._Element'],
+                                     List['etree._Element']],
+                  chunk_size: int = 65536) -> Iterator['etree._Element']:
+    """Select elements from HTML content incrementally.
+
+    Content is fed to the parser in chunks, and after each chunk the selector
+    is evaluated over the partial document.  Only elements that have been
+    completely parsed are returned, and they are then removed from the tree
+    so memory use doesn’t grow with the size of the document.
+
+    Args:
+        content: HTML to parse
+        selector: Compiled CSS or XPath selector
+        chunk_size: Amount of content to parse in each step
+
+    Returns:
+        Matching elements, in document order
+    """
+    from lxml import etree
+
+    parser = etree.HTMLPullParser(events=('start', 'end'))
+    view = memoryview(content) if isinstance(content, bytes) else content
+    root = None
+    for offset in range(0, len(content) + chunk_size, chunk_size):
+        chunk = view[offset:offset + chunk_size]
+        if chunk:
+            parser.feed(bytes(chunk) if isinstance(chunk, memoryview)
+                        else chunk)
+        else:
+            parser.close()
+        ended = set()
+        for event, element in parser.read_events():
+            if root is None:
+                root = element.getroottree().getroot()
+            if event == 'end':
+                ended.add(element)
+        if root is None:
+            continue
+        for element in selector(root):
+            if element in ended:
+                yield element
+        for element in ended:
+            parent = element.getparent()
+            if parent is not None:
+                parent.remove(element)
 
 
 def term_link(__target: str, name: Optional[str] = None):
@@ -122,7 +668,7 @@ def term_link(__target: str, name: Optional[str] = None):
     return f'\033]8;;{__target}\007{name}\033]8;;\007'
 
 
-def charset_from_headers(headers: httplib2.Response) -> str:
+def charset_from_headers(headers: 'httplib2.Response') -> str:
     """Parse charset from headers.
 
     Args:
@@ -139,24 +685,195 @@ def charset_from_headers(headers: httplib2.Response) -> str:
     return charset
 
 
-def maybe_profile() -> ContextManager:  # pragma: no cover
+#: Profiling modes supported by :func:`maybe_profile`
+PROFILE_MODES = ('bprofile', 'cprofile', 'tracemalloc', 'sites')
+
+#: Number of entries written in ``tracemalloc`` and ``sites`` reports
+PROFILE_LIMIT = 25
+
+#: CPU and wall clock time for each site, while ``sites`` profiling
+_site_costs = None
+_site_costs_lock = threading.Lock()
+
+
+def parse_profile(spec: str) -> Tuple[str, str]:
+    """Parse profiling specification.
+
+    Specifications are of the form ``mode:filename``, where mode is one of
+    :data:`PROFILE_MODES`.  Values without a mode select ``bprofile``, for
+    compatibility with earlier releases.
+
+    Args:
+        spec: Profiling specification
+
+    Returns:
+        Profiling mode and output filename
+    """
+    mode, sep, filename = spec.partition(':')
+    if sep and mode in PROFILE_MODES:
+        if not filename:
+            raise ValueError(f'Missing profile output filename for {mode}')
+        return mode, filename
+    return 'bprofile', spec
+
+
+@contextmanager
+def _cprofile(filename: str) -> Iterator[None]:
+    """Profile block with :mod:`cProfile`.
+
+    Threads started within the block are profiled too, and their results
+    are merged into a single :mod:`pstats` file.
+
+    Args:
+        filename: File to write statistics to
+    """
+    import cProfile
+    import pstats
+
+    profiles = []
+
+    def thread_profile(frame, event, arg):
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Newer Python versions profile all threads from the first
+            # profiler
+            sys.setprofile(None)
+            return
+        profiles.append(profile)
+
+    main = cProfile.Profile()
+    threading.setprofile(thread_profile)
+    main.enable()
+    try:
+        yield
+    finally:
+        main.disable()
+        threading.setprofile(None)
+        stats = pstats.Stats(main)
+        for profile in profiles:
+            profile.disable()
+            stats.add(profile)
+        stats.dump_stats(filename)
+
+
+@contextmanager
+def _tracemalloc(filename: str) -> Iterator[None]:
+    """Report largest memory allocations made within block.
+
+    Args:
+        filename: File to write report to
+    """
+    import tracemalloc
+
+    tracemalloc.start()
+    try:
+        yield
+    finally:
+        snapshot = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        stats = snapshot.statistics('lineno')
+        with open(filename, 'w') as f:
+            f.write(f'Current {current} bytes, peak {peak} bytes\n')
+            for stat in stats[:PROFILE_LIMIT]:
+                f.write(f'{stat}\n')
+
+
+@contextmanager
+def _site_profile(filename: str) -> Iterator[None]:
+    """Report CPU usage for each site checked within block.
+
+    See :func:`profile_site` for details of how usage is measured.
+
+    Args:
+        filename: File to write report to
+    """
+    global _site_costs
+
+    _site_costs = {}
+    try:
+        yield
+    finally:
+        costs, _site_costs = _site_costs, None
+        ranked = sorted(costs.items(), key=lambda item: item[1][0],
+                        reverse=True)
+        with open(filename, 'w') as f:
+            f.write(f'{"CPU":>10} {"Wall":>10}  Site\n')
+            for name, (cpu, wall) in ranked[:PROFILE_LIMIT]:
+                f.write(f'{cpu:10.4f} {wall:10.4f}  {name}\n')
+
+
+def profile_site(name: str) -> ContextManager:
+    """Measure CPU usage for a site, when ``sites`` profiling is enabled.
+
+    The CPU time is that used by the current thread, so it is only accurate
+    when the block doesn’t yield to other :mod:`asyncio` tasks.  Usage from
+    repeated blocks for the same site is summed.
+
+    Args:
+        name: Site name
+    """
+    if _site_costs is None:
+        return nullcontext()
+    return _measure_site(name)
+
+
+@contextmanager
+def _measure_site(name: str) -> Iterator[None]:
+    """Add CPU and wall clock time for block to site’s costs.
+
+    Args:
+        name: Site name
+    """
+    import time
+
+    cpu = time.thread_time()
+    wall = time.perf_counter()
+    try:
+        yield
+    finally:
+        cpu = time.thread_time() - cpu
+        wall = time.perf_counter() - wall
+        with _site_costs_lock:
+            if _site_costs is not None:
+                old_cpu, old_wall = _site_costs.get(name, (0, 0))
+                _site_costs[name] = (old_cpu + cpu, old_wall + wall)
+
+
+def maybe_profile(spec: Optional[str] = None) -> ContextManager:
     """Profile the wrapped code block.
 
-    When :envvar:`CUPAGE_PROFILE` is set execute the enclosed block under
-    bprofile_.  The envvar’s value should be the name of the output file to
-    generate.
+    The profiling mode is chosen with ``spec``, see :func:`parse_profile`,
+    which defaults to the value of :envvar:`CUPAGE_PROFILE`.  The modes are:
+
+    ``bprofile``
+        Call graph generated by bprofile_
+    ``cprofile``
+        :mod:`cProfile` statistics, for use with :mod:`pstats`
+    ``tracemalloc``
+        Largest memory allocations, from :mod:`tracemalloc`
+    ``sites``
+        Sites that used the most CPU time during checks
 
-    When :envvar:`CUPAGE_PROFILE` is unset, this is just a no-op.
+    When no profiling is requested this is just a no-op.
 
     .. _bprofile: https://pypi.org/project/bprofile/
+
+    Args:
+        spec: Profiling specification
     """
-    profile = os.getenv('CUPAGE_PROFILE')
-    if profile:
+    if spec is None:
+        spec = os.getenv('CUPAGE_PROFILE')
+    if not spec:
+        return nullcontext()
+    mode, filename = parse_profile(spec)
+    if mode == 'bprofile':  # pragma: no cover
         from bprofile import BProfile
-        profiler = BProfile(profile)
-    else:
-        @contextmanager
-        def noop():
-            yield
-        profiler = noop()
-    return profiler
+        return BProfile(filename)
+    return {
+        'cprofile': _cprofile,
+        'tracemalloc': _tracemalloc,
+        'sites': _site_profile,
+    }[mode](filename)
@@ -56,10 +56,14 @@ def parse_requires(file: str) -> List[str]:
 # and doesn’t support pip’s inclusion mechanism
 install_requires = parse_requires('requirements.txt')
 tests_require = parse_requires('requirements-test.txt')
+extras_require = {
+    'async': parse_requires('requirements-async.txt'),
+}
 
 if __name__ == '__main__':
     setup(
         install_requires=install_requires,
         tests_require=tests_require,
+        extras_require=extras_require,
         cmdclass={'test': PytestTest},
     )
@@ -18,12 +18,19 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import datetime
+import json
+import os
 import re
-from typing import List
+import threading
+import time
+from typing import Dict, List
 
-from pytest import mark
+from pytest import mark, raises
 
-from cupage import Site
+from cupage import Site, Sites, _version, utils
+from cupage.database import open_database
+from cupage.scheduler import HostLimits
 
 
 @mark.parametrize('name, ext, pkgs, pattern', [
@@ -42,3 +49,408 @@ def test_package_re(name: str, ext: str, pkgs: List[str], pattern: str):
     for pkg in pkgs:
         assert re.match(c, pkg).group() == pkg
     assert c.pattern == pattern
+
+
+def test_sites_check_order(monkeypatch):
+    """Test concurrent checks are reported in name order."""
+    def check(self, **kwargs):
+        # Make later sites finish first
+        time.sleep(0.01 * (5 - int(self.name[-1])))
+        return [self.name]
+
+    monkeypatch.setattr(Site, 'check', check)
+    sites = Sites(
+        Site(f'site{i}', f'http://example.com/{i}', options={})
+        for i in reversed(range(5)))
+    results = [(site.name, matches) for site, matches in sites.check(jobs=5)]
+    assert results == [(f'site{i}', [f'site{i}']) for i in range(5)]
+
+
+def test_sites_check_host_concurrency(monkeypatch):
+    """Test checks for a single host run concurrently up to its limit."""
+    lock = threading.Lock()
+    running = []
+    peak = []
+
+    def check(self, **kwargs):
+        with lock:
+            running.append(self.name)
+            peak.append(len(running))
+        time.sleep(0.02)
+        with lock:
+            running.remove(self.name)
+        return []
+
+    monkeypatch.setattr(Site, 'check', check)
+    sites = Sites(
+        Site(f'site{i}', f'http://example.com/{i}', options={})
+        for i in range(6))
+    list(sites.check(jobs=6, limits=HostLimits(concurrency=3)))
+    assert max(peak) == 3
+
+
+def test_sites_check_pages(monkeypatch):
+    """Test checks can be restricted to named sites."""
+    monkeypatch.setattr(Site, 'check', lambda self, **kwargs: [])
+    sites = Sites(
+        Site(f'site{i}', f'http://example.com/{i}', options={})
+        for i in range(5))
+    names = [site.name for site, _ in sites.check(pages=['site3', 'site1'])]
+    assert names == ['site1', 'site3']
+
+
+def test_sites_watch(monkeypatch):
+    """Test sites are checked in due order, and rescheduled."""
+    def check(self, **kwargs):
+        self.checked = utils.utcnow()
+        return [self.name]
+
+    monkeypatch.setattr(Site, 'check', check)
+    now = utils.utcnow()
+    sites = Sites([
+        Site('recent', 'http://example.com/recent', options={},
+             checked=now),
+        Site('old', 'http://example.com/old', options={},
+             checked=now - datetime.timedelta(days=2)),
+        Site('new', 'http://example.com/new', options={}),
+        Site('frequent', 'http://example.com/frequent', options={},
+             frequency=datetime.timedelta(seconds=0.05), checked=now),
+    ])
+    stop = threading.Event()
+    names = []
+    idle = []
+    for site, matches in sites.watch(stop=stop,
+                                     idle=lambda: idle.append(len(names))):
+        assert matches == [site.name]
+        names.append(site.name)
+        if len(names) == 4:
+            stop.set()
+    assert names[:2] == ['new', 'old']
+    assert names[2:] == ['frequent', 'frequent']
+    # Idle only once the due sites have been checked
+    assert idle[:2] == [2, 3]
+
+
+@mark.parametrize('status, result', [
+    (200, ['test-0.2.tar.gz']),
+    (304, None),
+    (404, False),
+])
+def test_process(status: int, result):
+    """Test response processing."""
+    site = Site('test', 'http://example.com/', options={'match_type': 'tar',
+                                                        'selector': 'css',
+                                                        'select': 'a'},
+                matches=['test-0.1.tar.gz'])
+    content = b"""<a href='test-0.1.tar.gz'>old</a>
+                  <a href='test-0.2.tar.gz'>new</a>"""
+    assert site.process(status, {}, content, site.url) == result
+
+
+def test_process_releases():
+    """Test release times are only recorded after the first check."""
+    site = Site('test', 'http://example.com/', options={'match_type': 'tar',
+                                                        'selector': 'css',
+                                                        'select': 'a'})
+    content = b"<a href='test-0.1.tar.gz'>old</a>"
+    site.process(200, {}, content, site.url)
+    assert site.releases == []
+    site.process(200, {}, content, site.url)
+    assert site.releases == []
+    content += b"<a href='test-0.2.tar.gz'>new</a>"
+    site.process(200, {}, content, site.url)
+    assert site.releases == [site.checked]
+
+
+@mark.parametrize('options, adaptive', [
+    ({}, None),
+    ({'adaptive': 'yes'},
+     (datetime.timedelta(days=1), datetime.timedelta(weeks=1))),
+    ({'adaptive': 'yes', 'max_frequency': '1m'},
+     (datetime.timedelta(days=1), datetime.timedelta(weeks=4))),
+])
+def test_parse_adaptive(options: Dict[str, str], adaptive):
+    """Test adaptive frequency options."""
+    options.update({'url': 'http://example.com/', 'select': 'a'})
+    assert Site.parse('test', options, {}).adaptive == adaptive
+
+
+@mark.parametrize('options', [
+    {'adaptive': 'maybe'},
+    {'adaptive': 'yes', 'min_frequency': 'soon'},
+    {'adaptive': 'yes', 'min_frequency': '2w', 'max_frequency': '1w'},
+])
+def test_parse_adaptive_invalid(options: Dict[str, str]):
+    """Test invalid adaptive frequency options are rejected."""
+    options.update({'url': 'http://example.com/', 'select': 'a'})
+    with raises(ValueError, match='for test'):
+        Site.parse('test', options, {})
+
+
+def test_interval():
+    """Test adaptive frequency falls back until there is history."""
+    site = Site('test', 'http://example.com/', options={},
+                frequency=datetime.timedelta(days=3),
+                adaptive=(datetime.timedelta(days=1),
+                          datetime.timedelta(weeks=1)))
+    assert site.interval == datetime.timedelta(days=3)
+    site.releases = [utils.utcnow() - datetime.timedelta(days=8)]
+    assert site.interval - datetime.timedelta(days=2) \
+        < datetime.timedelta(seconds=1)
+
+
+def test_process_validators():
+    """Test cache validators are stored for conditional requests."""
+    site = Site('test', 'http://example.com/', options={'match_type': 'tar',
+                                                        'selector': 'css',
+                                                        'select': 'a'})
+    assert 'If-None-Match' not in site.request_headers()
+    site.process(200, {'etag': '"abc"',
+                       'last-modified': 'Wed, 01 Jan 2014 00:00:00 GMT'},
+                 b"<a href='test-0.1.tar.gz'>old</a>", site.url)
+    headers = site.request_headers()
+    assert headers['If-None-Match'] == '"abc"'
+    assert headers['If-Modified-Since'] == 'Wed, 01 Jan 2014 00:00:00 GMT'
+
+    checked = site.checked
+    assert site.process(304, {}, b'', site.url) is None
+    assert site.checked > checked
+    assert site.matches == ['test-0.1.tar.gz']
+
+
+def test_process_unchanged(monkeypatch):
+    """Test identical bodies aren’t matched again."""
+    site = Site('test', 'http://example.com/', options={'match_type': 'tar',
+                                                        'selector': 'css',
+                                                        'select': 'a'})
+    content = b"<a href='test-0.1.tar.gz'>old</a>"
+    assert site.process(200, {}, content, site.url) == ['test-0.1.tar.gz']
+    assert not site.unchanged
+
+    def fail(self, content, charset):
+        raise AssertionError('Unchanged page parsed')
+
+    monkeypatch.setattr(Site, 'find_default_matches', fail)
+    assert site.process(200, {}, content, site.url) == []
+    assert site.unchanged
+    assert site.matches == ['test-0.1.tar.gz']
+
+    site.options = dict(site.options, match='changed')
+    with raises(AssertionError):
+        site.process(200, {}, content, site.url)
+
+
+def test_sites_check_stats(monkeypatch):
+    """Test unchanged pages are counted."""
+    def check(self, **kwargs):
+        self.unchanged = self.name != 'site0'
+        return []
+
+    monkeypatch.setattr(Site, 'check', check)
+    sites = Sites(
+        Site(f'site{i}', f'http://example.com/{i}', options={})
+        for i in range(3))
+    list(sites.check())
+    assert sites.stats['unchanged'] == 2
+
+
+def test_request_headers_changed():
+    """Test validators are ignored when site options change."""
+    site = Site('test', 'http://example.com/', options={'match_type': 'tar'},
+                validators={'etag': '"abc"', 'fingerprint': 'stale'})
+    assert 'If-None-Match' not in site.request_headers()
+    site.validators['fingerprint'] = site.fingerprint
+    assert site.request_headers()['If-None-Match'] == '"abc"'
+    site.url = 'http://example.com/moved/'
+    assert 'If-None-Match' not in site.request_headers()
+
+
+def test_parse_invalid_selector():
+    """Test invalid selectors are rejected when loading config."""
+    with raises(ValueError, match='for test'):
+        Site.parse('test', {'url': 'http://example.com/', 'select': 'td['},
+                   {})
+
+
+@mark.parametrize('options, match_func', [
+    ({}, 'default'),
+    ({'match_func': 'anchor'}, 'anchor'),
+])
+def test_parse_anchor(options: Dict[str, str], match_func: str):
+    """Test link scanning is only used when requested."""
+    options.update({'url': 'http://example.com/', 'select': 'td a'})
+    site = Site.parse('test', options, {})
+    assert site.match_func == match_func
+
+
+def test_find_anchor_matches():
+    """Test link scanning skips comments, but ignores the selector."""
+    content = b"""<!-- <a href="foo-9.9.tar.gz">9.9</a> -->
+                  <p><a href="foo-8.0.tar.gz">8.0</a></p>
+                  <table><tr><td><a href="foo-1.0.tar.gz">1.0</a></td></tr>
+                  </table>"""
+    site = Site('foo', 'http://example.com/',
+                options={'select': 'td a', 'match_type': 'tar'})
+    assert site.find_default_matches(content, 'utf-8') == ['foo-1.0.tar.gz']
+    assert site.find_anchor_matches(content, 'utf-8') \
+        == ['foo-1.0.tar.gz', 'foo-8.0.tar.gz']
+
+
+SITES_CONFIG = """\
+[foo]
+url = http://example.com/foo/
+select = td a
+
+[bar]
+url = http://example.com/bar/
+select = td a
+"""
+
+
+@mark.parametrize('database', ['sites.db', 'sites.sqlite'])
+def test_sites_load_pages(tmpdir, database: str):
+    """Test only requested sites are parsed."""
+    config = tmpdir.join('sites.conf')
+    config.write(SITES_CONFIG)
+    database = tmpdir.join(database).strpath
+    sites = Sites()
+    sites.load(config.strpath, database)
+    sites.save(database)
+
+    sites = Sites()
+    sites.load(config.strpath, database, ['foo'])
+    assert [site.name for site in sites] == ['foo']
+    assert sites.get('bar').name == 'bar'
+    assert [site.name for site in sites] == ['foo', 'bar']
+    assert sites.get('baz') is None
+
+
+def test_sites_save_untouched(tmpdir):
+    """Test records for unparsed sites are preserved."""
+    config = tmpdir.join('sites.conf')
+    config.write(SITES_CONFIG)
+    database = tmpdir.join('sites.db')
+    record = {'checked': 1256677592.0, 'matches': ['bar-1.0.tar.gz']}
+    database.write(json.dumps({'bar': record}))
+    sites = Sites()
+    sites.load(config.strpath, database.strpath, ['foo'])
+    sites.save(database.strpath)
+    assert json.loads(database.read())['bar'] == record
+
+
+@mark.parametrize('cache', [False, True])
+def test_sites_urls(tmpdir, cache: bool):
+    """Test URLs are found for unparsed sites."""
+    config = tmpdir.join('sites.conf')
+    config.write(SITES_CONFIG)
+    cache = tmpdir.join('config.pickle').strpath if cache else None
+    sites = Sites()
+    sites.load(config.strpath, pages=['foo'], cache=cache)
+    assert sites.urls() == {
+        'http://example.com/foo/',
+        'http://example.com/bar/',
+        'http://example.com/robots.txt',
+    }
+    assert [site.name for site in sites] == ['foo']
+
+
+def test_sites_load_cache(tmpdir, monkeypatch):
+    """Test validated definitions are reused until the config changes."""
+    config = tmpdir.join('sites.conf')
+    config.write(SITES_CONFIG)
+    cache = tmpdir.join('cache', 'config.pickle').strpath
+    Sites().load(config.strpath, cache=cache)
+
+    def parse_options(name, options):
+        raise AssertionError('Cached definitions not used')
+
+    monkeypatch.setattr(Site, 'parse_options', staticmethod(parse_options))
+    sites = Sites()
+    sites.load(config.strpath, cache=cache)
+    assert sorted(site.name for site in sites) == ['bar', 'foo']
+
+    config.write(SITES_CONFIG.replace('bar', 'baz'))
+    os.utime(config.strpath, ns=(0, 0))
+    with raises(AssertionError):
+        Sites().load(config.strpath, cache=cache)
+
+
+def test_sites_load_cache_version(tmpdir, monkeypatch):
+    """Test upgrades invalidate cached definitions."""
+    config = tmpdir.join('sites.conf')
+    config.write(SITES_CONFIG)
+    cache = tmpdir.join('config.pickle').strpath
+    Sites().load(config.strpath, cache=cache)
+
+    parsed = []
+    parse_options = Site.parse_options
+
+    def record(name, options):
+        parsed.append(name)
+        return parse_options(name, options)
+
+    monkeypatch.setattr(Site, 'parse_options', staticmethod(record))
+    monkeypatch.setattr(_version, 'dotted', '99.0.0')
+    Sites().load(config.strpath, cache=cache)
+    assert sorted(parsed) == ['bar', 'foo']
+
+
+def test_site_shared_options():
+    """Test sites from the same template share their options."""
+    first = Site.parse('first', {'site': 'rubygems'}, {})
+    second = Site.parse('second', {'site': 'rubygems'}, {})
+    assert first.options is second.options
+    with raises(TypeError):
+        first.options['select'] = 'a'
+    with raises(AttributeError):
+        first.unknown = True
+
+
+def test_sites_save_unchanged(tmpdir):
+    """Test compact matches are compared with saved state."""
+    config = tmpdir.join('sites.conf')
+    config.write('[test]\nurl = http://example.com/\nselect = a\n')
+    database = tmpdir.join('sites.json').strpath
+    sites = Sites()
+    sites.load(config.strpath, database)
+    sites[0].matches = ['test-0.1.tar.gz']
+    sites.save(database)
+
+    sites = Sites()
+    sites.load(config.strpath, database)
+    site = sites[0]
+    assert site.matches == ['test-0.1.tar.gz']
+    assert sites._snapshot(site) == sites._saved['test']
+    site.matches = ['test-0.1.tar.gz', 'test-0.2.tar.gz']
+    assert sites._snapshot(site) != sites._saved['test']
+
+
+def test_sites_load_invalid_host_limits(tmpdir):
+    """Test invalid host sections are rejected when loading."""
+    config = tmpdir.join('sites.conf')
+    config.write('[host:example.com]\nconcurrency = 0\n\n'
+                 '[test]\nurl = http://example.com/\nselect = a\n')
+    with raises(ValueError, match='example.com'):
+        Sites().load(config.strpath)
+
+
+@mark.parametrize('database', ['sites.json', 'sites.sqlite'])
+def test_sites_save_removed(tmpdir, database: str):
+    """Test stored state for removed sites is dropped."""
+    config = tmpdir.join('sites.conf')
+    database = tmpdir.join(database).strpath
+    config.write('[one]\nurl = http://example.com/1\nselect = a\n\n'
+                 '[two]\nurl = http://example.com/2\nselect = a\n')
+    sites = Sites()
+    sites.load(config.strpath, database)
+    for site in sites:
+        site.checked = utils.utcnow()
+    sites.save(database)
+    assert sorted(open_database(database).load()) == ['one', 'two']
+
+    config.write('[one]\nurl = http://example.com/1\nselect = a\n\n'
+                 '[three]\nurl = http://example.com/3\nselect = a\n')
+    sites = Sites()
+    sites.load(config.strpath, database, ['one'])
+    sites.save(database)
+    assert sorted(open_database(database).load()) == ['one']
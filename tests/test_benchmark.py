@@ -0,0 +1,86 @@
+#
+"""test_benchmark - Tests for cupage benchmarks."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from typing import Any, Dict
+
+from pytest import mark, raises
+
+from cupage import benchmark
+
+
+@mark.parametrize('size, expected', [
+    (1024, '1KB'),
+    (100 * 1024, '100KB'),
+    (10 * 1024 ** 2, '10MB'),
+])
+def test_size_label(size: int, expected: str):
+    """Test human-readable page sizes."""
+    assert benchmark.size_label(size) == expected
+
+
+def test_cases():
+    """Test selecting cases by pattern."""
+    names = [case for case, _ in benchmark.cases('quick', ['Sites.load/*'])]
+    assert names == ['Sites.load/10', 'Sites.load/1000']
+
+
+@mark.parametrize('case', [
+    'Site.find_*_matches/1KB',
+    'Site.parse',
+    'Sites.*/10',
+])
+def test_cases_run(case: str):
+    """Test selected benchmark cases run."""
+    cases = list(benchmark.cases('quick', [case]))
+    assert cases
+    for _, bench in cases:
+        with bench as func:
+            result = func()
+            if case.startswith('Site.find'):
+                assert result
+
+
+def test_run():
+    """Test timing results."""
+    results = benchmark.run(patterns=['utils.charset_from_headers'],
+                            repeat=2)
+    assert results['format'] == benchmark.FORMAT
+    result = results['results']['utils.charset_from_headers']
+    assert result['repeat'] == 2
+    assert 0 < result['min'] <= result['median']
+
+
+def test_compare():
+    """Test comparisons flag regressions in shared cases."""
+    def results(**timings: float) -> Dict[str, Any]:
+        return {
+            'format': benchmark.FORMAT,
+            'results': {k: {'median': v} for k, v in timings.items()},
+        }
+
+    rows = benchmark.compare(results(a=1.0, b=1.0, c=1.0),
+                             results(a=1.05, b=1.2, d=1.0))
+    assert rows == [('a', 1.0, 1.05, False), ('b', 1.0, 1.2, True)]
+
+
+def test_compare_format():
+    """Test comparing results in unknown formats."""
+    with raises(ValueError, match='Unsupported'):
+        benchmark.compare({'format': 0}, {'format': benchmark.FORMAT})
@@ -0,0 +1,135 @@
+#
+"""test_cache - Tests for cupage page cache."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import os
+from typing import List
+
+import py
+from pytest import mark, raises
+
+from cupage.cache import (CacheManager, CompressedFileCache, FileCache,
+                          cache_key)
+
+
+def fill(cache: FileCache, urls: List[str], size: int = 10):
+    """Add entries to cache, oldest first."""
+    for age, url in enumerate(urls):
+        cache.set(url, b'x' * size)
+        os.utime(cache.path(url), (age, age))
+
+
+def test_cache_key(tmpdir: py.path.local):
+    """Test cache keys match httplib2 entry names."""
+    cache = FileCache(tmpdir.join('unused').strpath, no_write=True)
+    assert cache_key('http://example.com/a?b') \
+        == os.path.basename(cache.path('http://example.com/a?b'))
+    assert not tmpdir.join('unused').exists()
+
+
+def test_file_cache_touch(tmpdir: py.path.local):
+    """Test entries are touched when read."""
+    cache = FileCache(tmpdir.strpath)
+    fill(cache, ['http://example.com/'])
+    assert cache.get('http://example.com/') == b'x' * 10
+    assert os.stat(cache.path('http://example.com/')).st_mtime > 0
+    assert cache.get('http://example.com/missing') is None
+
+
+def test_file_cache_no_write(tmpdir: py.path.local):
+    """Test read-only caches aren’t written to."""
+    cache = FileCache(tmpdir.strpath, no_write=True)
+    cache.set('http://example.com/', b'data')
+    assert cache.get('http://example.com/') is None
+    assert not tmpdir.join('CACHEDIR.TAG').exists()
+
+
+def test_prune_orphans(tmpdir: py.path.local):
+    """Test entries for unused locations are removed."""
+    cache = FileCache(tmpdir.strpath)
+    fill(cache, ['http://example.com/a', 'http://example.com/b'])
+    manager = CacheManager(tmpdir.strpath)
+    assert manager.prune(urls=['http://example.com/b']) == (1, 10)
+    assert cache.get('http://example.com/a') is None
+    assert cache.get('http://example.com/b') is not None
+
+
+def test_prune_lru(tmpdir: py.path.local):
+    """Test least recently used entries are evicted first."""
+    urls = [f'http://example.com/{n}' for n in range(5)]
+    cache = FileCache(tmpdir.strpath)
+    fill(cache, urls)
+    manager = CacheManager(tmpdir.strpath)
+    assert manager.prune(max_bytes=25) == (3, 30)
+    assert [cache.get(url) is not None for url in urls] \
+        == [False, False, False, True, True]
+    assert manager.prune(max_entries=1) == (1, 10)
+    assert manager.stats() == (1, 10)
+
+
+def test_clear(tmpdir: py.path.local):
+    """Test clearing cache leaves other files alone."""
+    cache = FileCache(tmpdir.strpath)
+    fill(cache, ['http://example.com/a', 'http://example.com/b'])
+    tmpdir.join('robots.json').write('{}')
+    tmpdir.join('config.pickle').write('')
+    assert CacheManager(tmpdir.strpath).clear() == (2, 20)
+    assert sorted(os.listdir(tmpdir.strpath)) \
+        == ['CACHEDIR.TAG', 'config.pickle', 'robots.json']
+
+
+@mark.parametrize('method', ['zlib', 'lzma'])
+def test_compressed_file_cache(tmpdir: py.path.local, method: str):
+    """Test compressed entries round trip."""
+    cache = CompressedFileCache(tmpdir.strpath, method)
+    value = b'<a href="foo-0.1.tar.gz">foo-0.1.tar.gz</a>\n' * 100
+    cache.set('http://example.com/', value)
+    assert cache.get('http://example.com/') == value
+    assert os.path.getsize(cache.path('http://example.com/')) < len(value)
+    assert cache.stats['raw'] == len(value)
+    assert 0 < cache.ratio < 1
+
+
+def test_compressed_file_cache_raw_entries(tmpdir: py.path.local):
+    """Test uncompressed entries are still read."""
+    FileCache(tmpdir.strpath).set('http://example.com/', b'data')
+    cache = CompressedFileCache(tmpdir.strpath)
+    assert cache.get('http://example.com/') == b'data'
+
+
+def test_compressed_file_cache_corrupt(tmpdir: py.path.local):
+    """Test corrupt entries are treated as missing."""
+    cache = CompressedFileCache(tmpdir.strpath)
+    FileCache(tmpdir.strpath).set('http://example.com/', b'\0zlib\0bad')
+    assert cache.get('http://example.com/') is None
+
+
+def test_compressed_file_cache_no_write(tmpdir: py.path.local):
+    """Test read-only compressed caches aren’t written to."""
+    cache = CompressedFileCache(tmpdir.strpath, no_write=True)
+    cache.set('http://example.com/', b'data')
+    assert cache.get('http://example.com/') is None
+    assert cache.ratio == 0.0
+
+
+def test_compressed_file_cache_invalid(tmpdir: py.path.local):
+    """Test unknown compression methods are rejected."""
+    with raises(ValueError, match='Unknown compression'):
+        CompressedFileCache(tmpdir.strpath, 'bz2')
@@ -0,0 +1,273 @@
+#
+"""test_cmdline - Tests for cupage command line interface."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import atexit
+import json
+import os
+import signal
+import subprocess
+import sys
+import threading
+from typing import Dict, Iterator, List
+
+import py
+from click.testing import CliRunner, Result
+from pytest import MonkeyPatch, fixture, mark
+
+from cupage import cmdline, loadtest
+from cupage.cache import CacheManager, FileCache
+from cupage.cmdline import cli
+from cupage.database import open_database
+from cupage.utils import parse_datetime
+
+#: Modules that should only be imported when sites are checked or parsed
+HEAVY_MODULES = (
+    'asyncio',
+    'concurrent.futures',
+    'email.utils',
+    'http.client',
+    'httplib2',
+    'jnrbase.json_datetime',
+    'lxml',
+    'sqlite3',
+    'ssl',
+    'urllib.robotparser',
+)
+
+
+@mark.parametrize('module', ['cupage', 'cupage.cmdline'])
+def test_import_deferred(module: str):
+    """Test start up doesn’t load the networking and parsing stacks."""
+    output = subprocess.check_output([
+        sys.executable, '-c',
+        f'import sys, {module}; print(*sorted(sys.modules), sep="\\n")'
+    ], universal_newlines=True)
+    assert not set(output.splitlines()).intersection(HEAVY_MODULES)
+
+
+@fixture
+def server() -> Iterator[loadtest.StandInServer]:
+    """Start a stand-in server for site checks."""
+    server = loadtest.StandInServer(page_size=1024, seed=1)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@fixture
+def config(server: loadtest.StandInServer,
+           tmpdir: py.path.local) -> py.path.local:
+    """Config file for sites on the stand-in server."""
+    config = tmpdir.join('sites.conf')
+    config.write(loadtest.sites_config(3, server.base))
+    return config
+
+
+def run(monkeypatch: MonkeyPatch, *args: str) -> Result:
+    """Run command, followed by any exit handlers it registers."""
+    handlers = []
+    monkeypatch.setattr(atexit, 'register',
+                        lambda func, *params: handlers.append((func, params)))
+    result = CliRunner().invoke(cli, args, catch_exceptions=False)
+    for func, params in handlers:
+        func(*params)
+    return result
+
+
+def test_check_jobs(config: py.path.local, tmpdir: py.path.local,
+                    monkeypatch: MonkeyPatch):
+    """Test concurrent checks report and store every site."""
+    result = run(monkeypatch, 'check', '-j', '3', '-f', config.strpath,
+                 '-c', tmpdir.join('cache').strpath)
+    assert result.exit_code == 0
+    assert result.output.splitlines()[:2] == ['pkg000000-0.0.0.tar.gz',
+                                              'pkg000000-0.0.1.tar.gz']
+    states = open_database(tmpdir.join('sites.db').strpath).load()
+    assert sorted(states) == ['pkg000000', 'pkg000001', 'pkg000002']
+    assert states['pkg000002']['matches'][0] == '0.0.0'
+
+
+def test_check_async(config: py.path.local, tmpdir: py.path.local,
+                     monkeypatch: MonkeyPatch):
+    """Test checks with the asyncio engine store every site."""
+    result = run(monkeypatch, '-v', 'check', '-e', 'async', '-f',
+                 config.strpath, '-c', tmpdir.join('cache').strpath)
+    assert result.exit_code == 0
+    assert 'pkg000002 has new matches' in result.output
+    states = open_database(tmpdir.join('sites.db').strpath).load()
+    assert len(states) == 3
+    assert all(state['matches'] for state in states.values())
+    assert tmpdir.join('cache', 'robots.json').exists()
+
+
+def test_check_metrics_file(config: py.path.local, tmpdir: py.path.local,
+                            monkeypatch: MonkeyPatch):
+    """Test check metrics are written in the format chosen by extension."""
+    run(monkeypatch, 'check', '-f', config.strpath, '-c',
+        tmpdir.join('cache').strpath, '--metrics-file',
+        tmpdir.join('metrics.json').strpath)
+    data = json.loads(tmpdir.join('metrics.json').read())
+    assert data['summary']['sites'] == 3
+    assert sorted(data['sites']) == ['pkg000000', 'pkg000001', 'pkg000002']
+
+    run(monkeypatch, 'check', '--force', '-f', config.strpath, '-c',
+        tmpdir.join('cache').strpath, '--metrics-file',
+        tmpdir.join('metrics.prom').strpath)
+    assert '\ncupage_phase_seconds{phase="fetch"} ' \
+        in tmpdir.join('metrics.prom').read()
+
+
+def test_check_profile(config: py.path.local, tmpdir: py.path.local,
+                       monkeypatch: MonkeyPatch):
+    """Test per-site profiles are written when the command ends."""
+    profile = tmpdir.join('profile.txt')
+    result = run(monkeypatch, '--profile', f'sites:{profile.strpath}',
+                 'check', '-f', config.strpath, '-c',
+                 tmpdir.join('cache').strpath)
+    assert result.exit_code == 0
+    lines = profile.read().splitlines()
+    assert lines[0].split() == ['CPU', 'Wall', 'Site']
+    assert sorted(line.split()[-1] for line in lines[1:]) \
+        == ['pkg000000', 'pkg000001', 'pkg000002']
+
+
+def test_check_no_write(config: py.path.local, tmpdir: py.path.local,
+                        monkeypatch: MonkeyPatch):
+    """Test checks without writing leave no cache or database."""
+    result = run(monkeypatch, 'check', '--no-write', '-f', config.strpath,
+                 '-c', tmpdir.join('cache').strpath)
+    assert result.exit_code == 0
+    assert 'pkg000000-0.0.0.tar.gz' in result.output
+    assert not tmpdir.join('cache').exists()
+    assert not tmpdir.join('sites.db').exists()
+
+
+@mark.parametrize('args, count', [
+    ([], 5),
+    (['--prune-orphans'], 4),
+])
+def test_check_prune_orphans(args: List[str], count: int,
+                             config: py.path.local, tmpdir: py.path.local,
+                             monkeypatch: MonkeyPatch):
+    """Test checks only remove orphaned cache entries on request."""
+    cache = tmpdir.join('cache').strpath
+    FileCache(cache).set('http://example.com/removed', b'data')
+    result = run(monkeypatch, 'check', '-f', config.strpath, '-c', cache,
+                 *args)
+    assert result.exit_code == 0
+    assert CacheManager(cache).stats()[0] == count
+
+
+def test_cache_commands(config: py.path.local, tmpdir: py.path.local,
+                        monkeypatch: MonkeyPatch):
+    """Test page cache management commands."""
+    cache = tmpdir.join('cache').strpath
+    run(monkeypatch, 'check', '-f', config.strpath, '-c', cache)
+    FileCache(cache).set('http://example.com/removed', b'data')
+    # The database isn’t needed to find the locations in use
+    tmpdir.join('sites.db').write('invalid')
+
+    result = run(monkeypatch, 'cache', 'stats', '-c', cache)
+    assert result.output.startswith('5 entries using ')
+    result = run(monkeypatch, '-v', 'cache', 'prune', '-f', config.strpath,
+                 '-c', cache)
+    assert result.output == 'Removed 1 entries (4 bytes)\n'
+    assert CacheManager(cache).stats()[0] == 4
+    result = run(monkeypatch, '-v', 'cache', 'clear', '-c', cache)
+    assert result.output.startswith('Removed 4 entries ')
+    assert CacheManager(cache).stats() == (0, 0)
+
+
+def test_migrate(config: py.path.local, tmpdir: py.path.local,
+                 monkeypatch: MonkeyPatch):
+    """Test migrating to SQLite and back preserves site data."""
+    run(monkeypatch, 'check', '-f', config.strpath, '-c',
+        tmpdir.join('cache').strpath)
+    source = tmpdir.join('sites.db').strpath
+    sqlite = tmpdir.join('sites.sqlite').strpath
+    copy = tmpdir.join('copy.db').strpath
+
+    result = run(monkeypatch, '-v', 'migrate', source, sqlite)
+    assert result.output == f'Copied 3 sites from {source} to {sqlite}\n'
+    run(monkeypatch, 'migrate', sqlite, copy)
+
+    def load(database: str) -> Dict[str, Dict]:
+        # Formats differ in how they write time zones
+        return {name: dict(state, checked=parse_datetime(state['checked']))
+                for name, state in open_database(database).load().items()}
+
+    assert load(sqlite) == load(source)
+    assert load(copy) == load(source)
+
+
+def test_daemon_interrupt(config: py.path.local, tmpdir: py.path.local,
+                          monkeypatch: MonkeyPatch):
+    """Test the daemon saves its results when interrupted."""
+    report = cmdline.report
+
+    def interrupt(*args):
+        report(*args)
+        os.kill(os.getpid(), signal.SIGINT)
+
+    monkeypatch.setattr(cmdline, 'report', interrupt)
+    handlers = {signum: signal.getsignal(signum)
+                for signum in (signal.SIGINT, signal.SIGTERM)}
+    try:
+        result = run(monkeypatch, 'daemon', '-f', config.strpath, '-c',
+                     tmpdir.join('cache').strpath)
+    finally:
+        for signum, handler in handlers.items():
+            signal.signal(signum, handler)
+    assert result.exit_code == 0
+    states = open_database(tmpdir.join('sites.db').strpath).load()
+    assert states['pkg000000']['matches'] == result.output.splitlines()
+
+
+def test_benchmark(tmpdir: py.path.local, monkeypatch: MonkeyPatch):
+    """Test benchmark results can be stored and compared."""
+    baseline = tmpdir.join('baseline.json')
+    result = run(monkeypatch, 'benchmark', 'run', '-r', '1', '-o',
+                 baseline.strpath, 'utils.charset_from_headers')
+    assert result.output.startswith('utils.charset_from_headers ')
+
+    result = run(monkeypatch, 'benchmark', 'compare', baseline.strpath,
+                 baseline.strpath)
+    assert result.exit_code == 0
+    data = json.loads(baseline.read())
+    data['results']['utils.charset_from_headers']['median'] *= 2
+    current = tmpdir.join('current.json')
+    current.write(json.dumps(data))
+    result = run(monkeypatch, 'benchmark', 'compare', baseline.strpath,
+                 current.strpath)
+    assert result.exit_code == 1
+    assert result.output.endswith('(+100%)\n1 regressions found\n')
+
+
+def test_benchmark_load(tmpdir: py.path.local, monkeypatch: MonkeyPatch):
+    """Test load test results are reported for each pass."""
+    output = tmpdir.join('load.json')
+    result = run(monkeypatch, 'benchmark', 'load', '-n', '3', '-j', '2',
+                 '-o', output.strpath)
+    assert result.exit_code == 0
+    assert result.output.startswith('Pass 1: 3 sites in ')
+    assert '\nPass 2: 3 sites in ' in result.output
+    assert len(json.loads(output.read())['passes']) == 2
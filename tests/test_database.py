@@ -0,0 +1,92 @@
+#
+"""test_database - Tests for cupage state storage."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import datetime
+import sqlite3
+
+from pytest import mark
+
+from cupage.database import (JSONDatabase, SQLiteDatabase, migrate,
+                             open_database)
+
+CHECKED = datetime.datetime(2014, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+@mark.parametrize('name, backend', [
+    ('state.db', JSONDatabase),
+    ('state.sqlite', SQLiteDatabase),
+    ('state.sqlite3', SQLiteDatabase),
+])
+def test_open_database(tmpdir, name: str, backend: type):
+    """Test backend selection by extension."""
+    assert isinstance(open_database(tmpdir.join(name).strpath), backend)
+
+
+def test_open_database_sniff(tmpdir):
+    """Test SQLite detection from file contents."""
+    path = tmpdir.join('state.db').strpath
+    SQLiteDatabase(path).save({'foo': {'checked': None, 'matches': []}})
+    assert isinstance(open_database(path), SQLiteDatabase)
+
+
+def test_sqlite_round_trip(tmpdir):
+    """Test state survives storage."""
+    db = SQLiteDatabase(tmpdir.join('state.sqlite').strpath)
+    db.save({
+        'foo': {'checked': CHECKED, 'matches': ['foo-1.0.tar.gz']},
+        'bar': {'checked': None, 'matches': []},
+    })
+    states = db.load()
+    assert states['foo'] == {'checked': CHECKED.isoformat(),
+                             'matches': ['foo-1.0.tar.gz']}
+    assert states['bar'] == {'checked': None, 'matches': []}
+
+
+def test_sqlite_changed_only(tmpdir):
+    """Test only changed sites are written."""
+    path = tmpdir.join('state.sqlite').strpath
+    db = SQLiteDatabase(path)
+    db.save({'foo': {'checked': None, 'matches': []},
+             'bar': {'checked': None, 'matches': []}})
+    db.save({'foo': {'checked': CHECKED, 'matches': ['foo-1.0.tar.gz']},
+             'bar': {'checked': CHECKED, 'matches': ['bar-1.0.tar.gz']}},
+            ['foo'])
+    rows = dict(sqlite3.connect(path).execute(
+        'SELECT name, checked FROM sites'))
+    assert rows == {'foo': CHECKED.isoformat(), 'bar': None}
+
+
+def test_migrate(tmpdir):
+    """Test conversion between backends."""
+    source = tmpdir.join('state.db').strpath
+    dest = tmpdir.join('state.sqlite').strpath
+    JSONDatabase(source).save({'foo': {'checked': None, 'matches': ['a']}})
+    assert migrate(source, dest) == 1
+    assert SQLiteDatabase(dest).load() == {
+        'foo': {'checked': None, 'matches': ['a']}
+    }
+
+
+def test_sqlite_load_names(tmpdir):
+    """Test reading a subset of sites."""
+    db = SQLiteDatabase(tmpdir.join('state.sqlite').strpath)
+    db.save({'foo': {'checked': None, 'matches': []},
+             'bar': {'checked': None, 'matches': []}})
+    assert list(db.load(['bar'])) == ['bar']
@@ -0,0 +1,124 @@
+#
+"""test_loadtest - Tests for cupage load testing."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import asyncio
+import threading
+import urllib.error
+import urllib.request
+from typing import Callable, Iterator, List
+
+import py
+from pytest import fixture, mark, raises
+
+from cupage import Sites, loadtest
+from cupage.scheduler import HostLimits
+
+
+@fixture
+def server() -> Iterator[Callable[..., loadtest.StandInServer]]:
+    """Start stand-in servers, and shut them down after the test."""
+    def make(**kwargs) -> loadtest.StandInServer:
+        server = loadtest.StandInServer(**kwargs)
+        thread = threading.Thread(target=server.serve_forever, daemon=True)
+        thread.start()
+        servers.append(server)
+        return server
+
+    servers: List[loadtest.StandInServer] = []
+    yield make
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+@mark.parametrize('percent, expected', [
+    (50, 5),
+    (99, 10),
+    (100, 10),
+    (1, 1),
+])
+def test_percentile(percent: float, expected: float):
+    """Test percentiles of unsorted timings."""
+    assert loadtest.percentile(list(range(10, 0, -1)), percent) == expected
+
+
+def test_sites_config(tmpdir: py.path.local):
+    """Test generated configurations cycle through site types."""
+    config = tmpdir.join('sites.conf')
+    config.write(loadtest.sites_config(6, 'http://127.0.0.1:1'))
+    sites = Sites()
+    sites.load(config.strpath)
+    assert [site.match_func for site in sites] \
+        == ['default', 'github', 'rubygems'] * 2
+
+
+def test_server_pages(server: Callable[..., loadtest.StandInServer]):
+    """Test stand-in listing pages."""
+    base = server(page_size=1024).base
+    with urllib.request.urlopen(f'{base}/listing/foo/') as response:
+        assert b'foo-0.0.1.tar.gz' in response.read()
+        etag = response.headers['ETag']
+    request = urllib.request.Request(f'{base}/listing/foo/',
+                                     headers={'If-None-Match': etag})
+    with urllib.request.urlopen(request) as response:
+        assert response.status == 200
+
+
+def test_server_not_modified(server: Callable[..., loadtest.StandInServer]):
+    """Test stand-in server honours conditional requests."""
+    stand_in = server(not_modified=1)
+    request = urllib.request.Request(f'{stand_in.base}/github/foo/tags',
+                                     headers={'If-None-Match': '"github-foo"'})
+    with raises(urllib.error.HTTPError, match='304'):
+        urllib.request.urlopen(request)
+    assert stand_in.stats['not_modified'] == 1
+
+
+def test_server_errors(server: Callable[..., loadtest.StandInServer]):
+    """Test stand-in server error injection."""
+    stand_in = server(error_rate=1)
+    with raises(urllib.error.HTTPError, match='404'):
+        urllib.request.urlopen(f'{stand_in.base}/rubygems/foo.json')
+    assert stand_in.stats == {'requests': 1, 'errors': 1}
+
+
+def test_run():
+    """Test load test results across passes."""
+    results = loadtest.run(6, passes=2, jobs=2, not_modified=1)
+    first, second = results['passes']
+    assert first['sites'] == second['sites'] == 6
+    assert first['server'] == {'requests': 7}
+    assert second['server']['not_modified'] == 6
+    assert second['unchanged'] == 6
+
+
+def test_check_async_queued(server: Callable[..., loadtest.StandInServer],
+                            tmpdir: py.path.local):
+    """Test queued async checks don’t count towards the request timeout."""
+    stand_in = server(page_size=1024, latency=0.3, seed=1)
+    config = tmpdir.join('sites.conf')
+    config.write(loadtest.sites_config(20, stand_in.base))
+    sites = Sites()
+    sites.load(config.strpath)
+    results = asyncio.run(
+        sites.check_async(timeout=1.5, jobs=2, limits=HostLimits(20)))
+    assert all(matches for _, matches in results)
+    assert max(sites.durations.values()) < 1.5
@@ -0,0 +1,99 @@
+#
+"""test_matches - Tests for cupage match storage."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+from typing import List, Optional
+
+from pytest import mark
+
+from cupage.matches import Matches
+
+
+@mark.parametrize('matches', [
+    [],
+    ['pkg-0.1.tar.gz'],
+    ['pkg-0.1.tar.gz', 'pkg-0.2.tar.gz', 'pkg-0.10.tar.gz'],
+    ['a', 'ab', 'b'],
+    ['1.0', '1.0', ''],
+    ['bad\0match', 'match'],
+])
+def test_matches_roundtrip(matches: List[str]):
+    """Test stored matches are returned unchanged."""
+    stored = Matches(matches)
+    assert list(stored) == matches
+    assert len(stored) == len(matches)
+    assert stored == matches
+    assert stored == Matches(stored)
+    for match in matches:
+        assert match in stored
+
+
+def test_matches_shared_affixes():
+    """Test common prefixes and suffixes are stored once."""
+    stored = Matches(['pkg-0.1.tar.gz', 'pkg-0.2.tar.gz'])
+    assert stored._prefix == 'pkg-0.'
+    assert stored._suffix == '.tar.gz'
+    assert stored._suffix is Matches(['a.tar.gz', 'b.tar.gz'])._suffix
+
+
+@mark.parametrize('match', [
+    'pkg-0.3.tar.gz',
+    'pkg-0.1.tar',
+    'pkg-0.tar.gz',
+    '0.1',
+    'pkg-0.1.tar.gz\0pkg-0.2.tar.gz',
+    None,
+])
+def test_matches_missing(match: Optional[str]):
+    """Test searching for unknown matches."""
+    assert match not in Matches(['pkg-0.1.tar.gz', 'pkg-0.2.tar.gz'])
+
+
+def test_matches_index():
+    """Test fetching matches by position."""
+    stored = Matches(['v1', 'v2', 'v3'])
+    assert stored[0] == 'v1'
+    assert stored[-1] == 'v3'
+    assert stored[1:] == ['v2', 'v3']
+
+
+def test_matches_compare():
+    """Test comparing and hashing matches."""
+    stored = Matches(['v1', 'v2'])
+    assert stored == ('v1', 'v2')
+    assert stored != ['v2', 'v1']
+    assert stored != 'v1v2'
+    assert hash(stored) == hash(Matches(['v1', 'v2']))
+
+
+@mark.parametrize('stored, matches, expected', [
+    ([], ['v1', 'v2'], ['v1', 'v2']),
+    (['v1', 'v2'], ['v1', 'v2', 'v3'], ['v3']),
+    (['pkg-0.1.tar.gz', 'pkg-0.2.tar.gz'],
+     ['pkg-0.1.tar.gz', 'pkg-0.1.1.tar.gz', 'pkg-0.2.tar.gz', 'pkg-0.2.zip'],
+     ['pkg-0.1.1.tar.gz', 'pkg-0.2.zip']),
+    (['pkg-0.1.tar.gz', 'pkg-0.2.tar.gz'], ['0.1', 'pkg-0.tar.gz'],
+     ['0.1', 'pkg-0.tar.gz']),
+    (['bad\0match', 'match'], ['match', 'other'], ['other']),
+])
+def test_matches_difference(stored: List[str], matches: List[str],
+                            expected: List[str]):
+    """Test finding matches that aren’t stored."""
+    assert Matches(stored).difference(matches) == expected
+    assert [match for match in matches if match not in stored] == expected
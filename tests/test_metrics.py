@@ -0,0 +1,114 @@
+#
+"""test_metrics - Tests for cupage check metrics."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+
+import json
+import os
+import threading
+import time
+
+import py
+
+from cupage import Site, metrics
+
+
+def test_phase_disabled():
+    """Test phases and notes are ignored outside of site checks."""
+    with metrics.phase('fetch'):
+        metrics.note(status=200)
+    assert not metrics.recording()
+
+
+def test_phase_exclusive():
+    """Test nested phase time is only counted once."""
+    recorder = metrics.Recorder()
+    with recorder.site('test'):
+        assert metrics.recording()
+        with metrics.phase('fetch'):
+            time.sleep(0.01)
+            with metrics.phase('dns'):
+                time.sleep(0.02)
+    record = recorder.sites['test']
+    assert 0.01 <= record.phases['fetch'] < 0.02
+    assert record.phases['dns'] >= 0.02
+    assert record.duration >= 0.03
+
+
+def test_recorder_threads():
+    """Test checks in separate threads are recorded separately."""
+    recorder = metrics.Recorder()
+
+    def check(name: str):
+        with recorder.site(name):
+            metrics.note(status=200, bytes=len(name))
+
+    threads = [
+        threading.Thread(target=check, args=(f'site{i}', ))
+        for i in range(4)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    summary = recorder.summary()
+    assert summary['sites'] == 4
+    assert summary['bytes'] == 20
+    assert summary['status'] == {'200': 4}
+
+
+def test_process_phases():
+    """Test parsing and matching phases are recorded."""
+    site = Site('test', 'http://example.com/', options={'match_type': 'tar',
+                                                        'selector': 'css',
+                                                        'select': 'td a'})
+    recorder = metrics.Recorder()
+    with recorder.site('test'):
+        site.process(200, {}, b"<td><a href='test-0.1.tar.gz'>0.1</a></td>",
+                     site.url)
+    assert set(recorder.sites['test'].phases) == {'parse', 'match'}
+
+
+def test_write_json(tmpdir: py.path.local):
+    """Test writing metrics as JSON."""
+    recorder = metrics.Recorder()
+    with recorder.site('test'):
+        metrics.note(status=304, cache='not_modified')
+    path = tmpdir.join('metrics.json').strpath
+    recorder.write(path)
+    with open(path) as f:
+        data = json.load(f)
+    assert data['summary']['cache'] == {'not_modified': 1}
+    assert data['sites']['test']['status'] == 304
+
+
+def test_write_prometheus(tmpdir: py.path.local):
+    """Test writing metrics in the Prometheus text format."""
+    recorder = metrics.Recorder()
+    with recorder.site('say "hi"'):
+        with metrics.phase('fetch'):
+            metrics.note(status=200, bytes=42)
+    path = tmpdir.join('cupage.prom').strpath
+    recorder.write(path)
+    with open(path) as f:
+        lines = f.read().splitlines()
+    assert 'cupage_site_bytes{site="say \\"hi\\""} 42' in lines
+    assert 'cupage_site_http_status{site="say \\"hi\\""} 200' in lines
+    assert '# TYPE cupage_phase_seconds gauge' in lines
+    assert os.stat(path).st_mode & 0o777 == 0o644
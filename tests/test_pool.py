@@ -0,0 +1,64 @@
+#
+"""test_pool - Tests for cupage connection pool."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Iterator
+
+from pytest import fixture
+
+from cupage.pool import ConnectionPool
+
+
+class KeepAliveHandler(BaseHTTPRequestHandler):
+    """Respond to every request over persistent connections."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self) -> None:
+        """Handle GET requests."""
+        self.send_response(200)
+        self.send_header('Content-Length', '2')
+        self.end_headers()
+        self.wfile.write(b'ok')
+
+    def log_message(self, *args) -> None:
+        """Suppress request logging."""
+
+
+@fixture
+def server() -> Iterator[str]:
+    """Run a local keep-alive server, and return its base URL."""
+    httpd = ThreadingHTTPServer(('127.0.0.1', 0), KeepAliveHandler)
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield f'http://127.0.0.1:{httpd.server_port}'
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def test_connection_reuse(server: str):
+    """Test connections are reused between requests."""
+    pool = ConnectionPool()
+    for i in range(3):
+        headers, content = pool.request(f'{server}/{i}')
+        assert content == b'ok'
+    pool.close()
+    assert pool.stats == {'requests': 3, 'reused': 2}
+    assert pool.reuse_ratio == 2 / 3
@@ -0,0 +1,76 @@
+#
+"""test_scheduler - Tests for cupage request scheduling."""
+# Copyright © 2009-2014  James Rowe <jnrowe@gmail.com>
+#
+# SPDX-License-Identifier: GPL-3.0-or-later
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+from typing import Dict
+
+from pytest import mark, raises
+
+from cupage.scheduler import HostGate, HostLimits, host_key
+
+
+@mark.parametrize('url, key', [
+    ('http://example.com/foo', 'example.com'),
+    ('https://EXAMPLE.com:8080/', 'example.com:8080'),
+])
+def test_host_key(url: str, key: str):
+    """Test host extraction."""
+    assert host_key(url) == key
+
+
+def test_host_limits():
+    """Test per-host overrides."""
+    limits = HostLimits(4, 0, {'Example.com': {'delay': '2'}})
+    assert limits.for_host('example.com') == (4, 2.0)
+    assert limits.for_host('example.org') == (4, 0)
+
+
+@mark.parametrize('options', [
+    {'concurrency': 'many'},
+    {'concurrency': '0'},
+    {'delay': '-1'},
+])
+def test_host_limits_invalid(options: Dict[str, str]):
+    """Test invalid per-host overrides."""
+    with raises(ValueError, match='example.com'):
+        HostLimits(overrides={'example.com': options})
+
+
+@mark.parametrize('concurrency, delay', [
+    (0, 0),
+    (1, -0.5),
+])
+def test_host_limits_invalid_defaults(concurrency: int, delay: float):
+    """Test invalid default limits."""
+    with raises(ValueError, match='Invalid host limits'):
+        HostLimits(concurrency, delay)
+
+
+def test_host_gate_delay():
+    """Test minimum delay between requests."""
+    gate = HostGate(HostLimits(delay=0.05))
+    start = time.monotonic()
+    for _ in range(3):
+        with gate.acquire('example.com'):
+            pass
+    with gate.acquire('example.org'):
+        pass
+    assert 0.1 <= time.monotonic() - start < 0.15
+    assert gate.wait_time('example.com') > 0
@@ -18,17 +18,37 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-from typing import Dict, List
+import asyncio
+import datetime
+import pstats
+import threading
+from contextlib import nullcontext
+from typing import Dict, List, Optional, Tuple
 
-from pytest import mark
+import py
+from lxml import html
+from lxml.cssselect import CSSSelector
+from pytest import MonkeyPatch, mark, raises
 
-from cupage.utils import (charset_from_headers, sort_packages)
+from cupage.utils import (RobotsCache, adaptive_frequency, cache_expiry,
+                          charset_from_headers, compile_selector,
+                          maybe_profile, parse_profile, profile_site,
+                          robots_test_async, scan_hrefs, sort_packages,
+                          stream_select, streamable, utcnow)
 
 
 @mark.parametrize('input, ordered', [
     (['pkg-0.1.tar.gz', 'pkg-0.2.1.tar.gz', 'pkg-0.2.tar.gz'
       ], ['pkg-0.1.tar.gz', 'pkg-0.2.tar.gz', 'pkg-0.2.1.tar.gz']),
     (['v0.1.0', 'v0.11.0', 'v0.1.2'], ['v0.1.0', 'v0.1.2', 'v0.11.0']),
+    (['pkg-0.10.tar.gz', 'pkg-0.9.tar.gz'], ['pkg-0.9.tar.gz',
+                                             'pkg-0.10.tar.gz']),
+    (['pkg-1.0.zip', 'pkg-1.0-rc2.zip', 'pkg-1.0_pre1.zip', 'pkg-0.9.zip'], [
+        'pkg-0.9.zip', 'pkg-1.0_pre1.zip', 'pkg-1.0-rc2.zip', 'pkg-1.0.zip'
+    ]),
+    (['py3k_1.2-10.debian.tar.xz', 'py3k_1.2-9.debian.tar.xz'], [
+        'py3k_1.2-9.debian.tar.xz', 'py3k_1.2-10.debian.tar.xz'
+    ]),
 ])
 def test_sort_packages(input: List[str], ordered: List[str]):
     """Test package sorting functionality."""
@@ -47,3 +67,212 @@ def test_sort_packages(input: List[str], ordered: List[str]):
 def test_charset_header(headers: Dict[str, str], charset: str):
     """Test character set header functionality."""
     assert charset_from_headers(headers) == charset
+
+
+@mark.parametrize('headers, expected', [
+    ({}, datetime.timedelta(days=1)),
+    ({
+        'cache-control': 'public, max-age=3600'
+    }, datetime.timedelta(hours=1)),
+])
+def test_cache_expiry(headers: Dict[str, str], expected: datetime.timedelta):
+    """Test cache lifetime calculation."""
+    expires = cache_expiry(headers, datetime.timedelta(days=1))
+    assert abs(expires - utcnow() - expected) < datetime.timedelta(seconds=5)
+
+
+def test_robots_cache(tmpdir):
+    """Test robots.txt cache persistence."""
+    file = tmpdir.join('robots.json').strpath
+    cache = RobotsCache(file=file)
+    cache.set('http://a.example/robots.txt', {},
+              ['User-agent: *', 'Disallow: /private'])
+    cache.set('http://b.example/robots.txt', {}, None)
+    cache.set('http://c.example/robots.txt', {'cache-control': 'max-age=0'},
+              [])
+    cache.save()
+
+    cache = RobotsCache(file=file)
+    found, robots = cache.get('http://a.example/robots.txt')
+    assert found
+    assert not robots.can_fetch('*', 'http://a.example/private/')
+    assert cache.get('http://b.example/robots.txt') == (True, None)
+    assert cache.get('http://c.example/robots.txt') == (False, None)
+
+
+def test_robots_test_async_shared():
+    """Test concurrent async checks for a host fetch robots.txt once."""
+    fetched = []
+
+    class Response:
+        """Stand-in for :class:`aiohttp.ClientResponse`."""
+        status = 200
+        headers: Dict[str, str] = {}
+
+        async def __aenter__(self) -> 'Response':
+            await asyncio.sleep(0.01)
+            return self
+
+        async def __aexit__(self, *args) -> None:
+            pass
+
+        async def read(self) -> bytes:
+            return b'User-agent: *\nDisallow: /private\n'
+
+    class Session:
+        """Stand-in for :class:`aiohttp.ClientSession`."""
+        def get(self, location: str) -> Response:
+            fetched.append(location)
+            return Response()
+
+    async def check() -> List[bool]:
+        cache = RobotsCache()
+        return await asyncio.gather(*(
+            robots_test_async(Session(), f'http://example.com/{path}',
+                              'test', cache=cache)
+            for path in ('a', 'b', 'private/c')))
+
+    assert asyncio.run(check()) == [True, True, False]
+    assert fetched == ['http://example.com/robots.txt']
+
+
+@mark.parametrize('selector, select, result', [
+    ('css', 'table.listing td a', True),
+    ('css', 'td + td a', False),
+    ('css', 'tr:nth-child(2) a', False),
+    ('xpath', '//td/a', True),
+    ('xpath', '//tr[2]/td/a', False),
+])
+def test_streamable(selector: str, select: str, result: bool):
+    """Test detection of selectors that support streaming."""
+    assert streamable(selector, select) == result
+
+
+def test_stream_select():
+    """Test incremental selection matches full document parsing."""
+    rows = b''.join(b'<tr><td><a href="pkg-0.%d.tar.gz">pkg</a></td>'
+                    b'<td>%d</td></tr>' % (i, i) for i in range(500))
+    content = (b'<html><body><a href="pkg-1.0.tar.gz">outside</a><table>' +
+               rows + b'</table></body></html>')
+    selector = CSSSelector('td a', translator='html')
+    expected = [e.get('href') for e in selector(html.fromstring(content))]
+    assert [e.get('href')
+            for e in stream_select(content, selector, 100)] == expected
+
+
+def test_compile_selector():
+    """Test compiled selectors are shared."""
+    assert compile_selector('css', 'td a') is compile_selector('css', 'td a')
+    assert compile_selector('css', 'a') is not compile_selector('xpath', 'a')
+
+
+@mark.parametrize('selector, select', [
+    ('css', 'td['),
+    ('css', 'a::before'),
+    ('css', 'a:nth-child(x)'),
+    ('xpath', '//td['),
+    ('xpath', 'a::before'),
+    ('jquery', 'td a'),
+])
+def test_compile_selector_invalid(selector: str, select: str):
+    """Test invalid selectors are rejected."""
+    with raises(ValueError, match='Invalid'):
+        compile_selector(selector, select)
+
+
+def test_scan_hrefs():
+    """Test link scanning matches parsed attribute values."""
+    content = b"""<A HREF="one.tar.gz">1</A> <a class=x href='two.zip'>2</a>
+                  <a href=three?a=1&amp;b=2>3</a> <a data-href="no">4</a>
+                  <link href="style.css"> <a\nhref = "four">5</a>
+                  <!-- <a href="five">6</a> --> <a href="six">7</a>
+                  <!-- <a href="seven">8</a>"""
+    expected = [e.get('href', '')
+                for e in html.fromstring(content).iter('a')
+                if e.get('href')]
+    assert list(scan_hrefs(content, 'utf-8')) == expected
+
+
+@mark.parametrize('gaps, quiet, expected', [
+    ([], None, None),
+    ([], 8, 2),
+    ([4, 8, 100], 0, 2),
+    ([4, 8, 100], 20, 5),
+    ([1, 1, 1], 0, 1),
+    ([100, 100], 0, 7),
+])
+def test_adaptive_frequency(gaps: List[int], quiet: Optional[int],
+                            expected: Optional[int]):
+    """Test frequency learned from release gaps."""
+    now = datetime.datetime(2014, 1, 1, tzinfo=datetime.timezone.utc)
+    releases = []
+    if quiet is not None:
+        releases.append(now - datetime.timedelta(days=quiet))
+        for gap in reversed(gaps):
+            releases.insert(0, releases[0] - datetime.timedelta(days=gap))
+    result = adaptive_frequency(releases, now, datetime.timedelta(days=1),
+                                datetime.timedelta(days=7))
+    if expected is None:
+        assert result is None
+    else:
+        assert result == datetime.timedelta(days=expected)
+
+
+@mark.parametrize('spec, expected', [
+    ('cprofile:out.prof', ('cprofile', 'out.prof')),
+    ('sites:costs.txt', ('sites', 'costs.txt')),
+    ('out.prof', ('bprofile', 'out.prof')),
+    ('C:/out.prof', ('bprofile', 'C:/out.prof')),
+])
+def test_parse_profile(spec: str, expected: Tuple[str, str]):
+    """Test parsing profiling specifications."""
+    assert parse_profile(spec) == expected
+
+
+def test_parse_profile_missing_filename():
+    """Test profiling specifications require a filename."""
+    with raises(ValueError, match='Missing profile output filename'):
+        parse_profile('tracemalloc:')
+
+
+def test_maybe_profile_disabled(monkeypatch: MonkeyPatch):
+    """Test profiling is a no-op when disabled."""
+    monkeypatch.delenv('CUPAGE_PROFILE', raising=False)
+    assert isinstance(maybe_profile(), nullcontext)
+    assert isinstance(profile_site('site'), nullcontext)
+
+
+def test_maybe_profile_cprofile(tmpdir: py.path.local):
+    """Test cProfile output includes worker threads."""
+    output = tmpdir.join('out.prof')
+    with maybe_profile(f'cprofile:{output}'):
+        thread = threading.Thread(target=sort_packages, args=(['v1', 'v0'], ))
+        thread.start()
+        thread.join()
+    stats = pstats.Stats(str(output))
+    assert any(func[2] == 'sort_packages' for func in stats.stats)
+
+
+def test_maybe_profile_tracemalloc(tmpdir: py.path.local):
+    """Test tracemalloc reports allocation sites."""
+    output = tmpdir.join('allocations.txt')
+    with maybe_profile(f'tracemalloc:{output}'):
+        data = [bytearray(1024) for _ in range(100)]
+    assert len(data) == 100
+    lines = output.read().splitlines()
+    assert lines[0].startswith('Current ')
+    assert 'test_utils.py' in lines[1]
+
+
+def test_maybe_profile_sites(tmpdir: py.path.local):
+    """Test per-site profiles are ordered by CPU time."""
+    output = tmpdir.join('sites.txt')
+    with maybe_profile(f'sites:{output}'):
+        with profile_site('slow'):
+            sum(range(500_000))
+        with profile_site('fast'):
+            pass
+    lines = output.read().splitlines()
+    assert lines[0].split() == ['CPU', 'Wall', 'Site']
+    assert [line.split()[-1] for line in lines[1:]] == ['slow', 'fast']
+    assert isinstance(profile_site('slow'), nullcontext)